@@ -0,0 +1,232 @@
+# Boilerplate_Lib.py
+#########################################
+# Boilerplate Detection Library
+# Finds the passages an uploader repeats in every episode (sponsor reads, intros, outros), so they can be stripped
+#   before chunking and summarization instead of being summarized again for each episode.
+#
+# Each transcript is reduced to word shingles (runs of BOILERPLATE_SHINGLE_WORDS normalized words), hashed with a
+#   polynomial rolling hash in one pass. The index (BoilerplateShingles in the media database) counts, per uploader,
+#   how many earlier episodes contained each shingle, and is updated incrementally as episodes are ingested. Words
+#   covered by shingles seen in at least BOILERPLATE_MIN_EPISODES earlier episodes are flagged; runs of at least
+#   BOILERPLATE_MIN_WORDS flagged words are reported as boilerplate spans.
+#
+# Settings (environment / .env):
+#   BOILERPLATE_DETECTION    - 'true' (default) to index transcripts and flag repeated passages per uploader
+#   BOILERPLATE_STRIP        - 'true' to also remove flagged passages before summarization (default false)
+#   BOILERPLATE_SHINGLE_WORDS, BOILERPLATE_MIN_EPISODES, BOILERPLATE_MIN_WORDS - see above (8, 2, 20)
+#
+####
+import logging
+import os
+import re
+import zlib
+from typing import List, Tuple, Dict, Any, Optional
+
+from App_Function_Libraries.SQLite_DB import db, DatabaseError
+
+####################
+# Function List
+#
+# 1. shingle_hashes(text, shingle_words=8)
+# 2. find_boilerplate_spans(text, uploader, min_episodes=2, min_words=20)
+# 3. is_recorded(uploader, document_key)
+# 4. record_transcript(text, uploader, document_key)
+# 5. strip_spans(text, spans)
+# 6. remove_boilerplate_segments(segments, uploader, document_key, strip=None)
+#
+####################
+
+
+#######################################################################################################################
+# Function Definitions
+#
+
+BOILERPLATE_SHINGLE_WORDS = int(os.getenv('BOILERPLATE_SHINGLE_WORDS', '8'))
+BOILERPLATE_MIN_EPISODES = int(os.getenv('BOILERPLATE_MIN_EPISODES', '2'))
+BOILERPLATE_MIN_WORDS = int(os.getenv('BOILERPLATE_MIN_WORDS', '20'))
+
+# Rolling hash modulus (a Mersenne prime, so hashes fit SQLite's signed 64-bit integers) and base
+HASH_MODULUS = (1 << 61) - 1
+HASH_BASE = 1_000_003
+# Shingle hashes per query, under SQLite's bound-parameter limit
+LOOKUP_BATCH_SIZE = 500
+
+WORD_PATTERN = re.compile(r'\S+')
+NON_WORD_CHARACTERS = re.compile(r'[^\w]+')
+
+
+def _env_flag(name: str, default: str) -> bool:
+    return os.getenv(name, default).lower() in ('true', '1', 'yes')
+
+
+def _words(text: str) -> Tuple[List[Tuple[int, int]], List[int]]:
+    """Character spans and hashes of the words of `text`; case and punctuation do not change a word's hash."""
+    spans = []
+    hashes = []
+    for match in WORD_PATTERN.finditer(text):
+        word = NON_WORD_CHARACTERS.sub('', match.group().lower())
+        if word:
+            spans.append(match.span())
+            hashes.append(zlib.crc32(word.encode('utf-8')) + 1)
+    return spans, hashes
+
+
+def _rolling_hashes(word_hashes: List[int], shingle_words: int) -> List[int]:
+    """Hash of every run of `shingle_words` words, each computed from the previous one in constant time."""
+    if len(word_hashes) < shingle_words:
+        return []
+    top_power = pow(HASH_BASE, shingle_words - 1, HASH_MODULUS)
+    value = 0
+    for word_hash in word_hashes[:shingle_words]:
+        value = (value * HASH_BASE + word_hash) % HASH_MODULUS
+    hashes = [value]
+    for i in range(shingle_words, len(word_hashes)):
+        value = ((value - word_hashes[i - shingle_words] * top_power) * HASH_BASE + word_hashes[i]) % HASH_MODULUS
+        hashes.append(value)
+    return hashes
+
+
+def shingle_hashes(text: str, shingle_words: int = BOILERPLATE_SHINGLE_WORDS) -> List[int]:
+    return _rolling_hashes(_words(text)[1], shingle_words)
+
+
+def _episode_counts(uploader: str, hashes: List[int]) -> Dict[int, int]:
+    """Number of indexed episodes of `uploader` containing each of `hashes` (absent: none)."""
+    counts = {}
+    unique = list(set(hashes))
+    with db.get_connection() as conn:
+        for start in range(0, len(unique), LOOKUP_BATCH_SIZE):
+            batch = unique[start:start + LOOKUP_BATCH_SIZE]
+            rows = conn.execute(
+                f"SELECT shingle_hash, document_count FROM BoilerplateShingles "
+                f"WHERE uploader = ? AND shingle_hash IN ({','.join('?' * len(batch))})", (uploader, *batch))
+            counts.update(rows.fetchall())
+    return counts
+
+
+def find_boilerplate_spans(text: str, uploader: str, min_episodes: int = BOILERPLATE_MIN_EPISODES,
+                           min_words: int = BOILERPLATE_MIN_WORDS,
+                           shingle_words: int = BOILERPLATE_SHINGLE_WORDS) -> List[Tuple[int, int]]:
+    """
+    Character spans of `text` that recur in earlier indexed episodes of the same uploader.
+
+    :param text: The transcript
+    :param uploader: The channel / uploader the index is kept for (info_dict['uploader'])
+    :param min_episodes: Earlier episodes a passage must appear in to count as boilerplate
+    :param min_words: Shortest passage reported, so common phrases are not flagged
+    """
+    word_spans, word_hashes = _words(text)
+    hashes = _rolling_hashes(word_hashes, shingle_words)
+    if not hashes:
+        return []
+    counts = _episode_counts(uploader, hashes)
+
+    # Flagged shingle i covers words [i, i + shingle_words); merge the covered words into runs
+    spans = []
+    run_start = run_end = None
+    for i, shingle_hash in enumerate(hashes):
+        if counts.get(shingle_hash, 0) < min_episodes:
+            continue
+        if run_end is not None and i <= run_end:
+            run_end = i + shingle_words
+        else:
+            if run_end is not None and run_end - run_start >= min_words:
+                spans.append((word_spans[run_start][0], word_spans[run_end - 1][1]))
+            run_start, run_end = i, i + shingle_words
+    if run_end is not None and run_end - run_start >= min_words:
+        spans.append((word_spans[run_start][0], word_spans[run_end - 1][1]))
+    return spans
+
+
+def is_recorded(uploader: str, document_key: str) -> bool:
+    with db.get_connection() as conn:
+        return conn.execute("SELECT 1 FROM BoilerplateDocuments WHERE uploader = ? AND document_key = ?",
+                            (uploader, document_key)).fetchone() is not None
+
+
+def record_transcript(text: str, uploader: str, document_key: str,
+                      shingle_words: int = BOILERPLATE_SHINGLE_WORDS) -> bool:
+    """
+    Add an episode's shingles to the uploader's index. An episode (document_key, e.g. its URL) is counted once, so
+    re-processing it does not make its own passages look repeated. Returns whether the episode was new.
+    """
+    hashes = set(shingle_hashes(text, shingle_words))
+    with db.get_connection() as conn:
+        try:
+            inserted = conn.execute("INSERT OR IGNORE INTO BoilerplateDocuments (uploader, document_key) VALUES (?, ?)",
+                                    (uploader, document_key)).rowcount
+            if inserted:
+                conn.executemany(
+                    "INSERT INTO BoilerplateShingles (uploader, shingle_hash) VALUES (?, ?) "
+                    "ON CONFLICT(uploader, shingle_hash) DO UPDATE SET document_count = document_count + 1",
+                    ((uploader, shingle_hash) for shingle_hash in hashes))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    return bool(inserted)
+
+
+def strip_spans(text: str, spans: List[Tuple[int, int]]) -> str:
+    """`text` without the (sorted, non-overlapping) spans."""
+    pieces = []
+    position = 0
+    for start, end in spans:
+        pieces.append(text[position:start])
+        position = end
+    pieces.append(text[position:])
+    return re.sub(r'[ \t]{2,}', ' ', ''.join(pieces)).strip()
+
+
+def remove_boilerplate_segments(segments: List[Dict[str, Any]], uploader: Optional[str],
+                                document_key: Optional[str], strip: Optional[bool] = None) -> List[Dict[str, Any]]:
+    """
+    Flag (log) the passages of a transcript repeated from the uploader's earlier episodes, index the transcript, and
+    with strip (default BOILERPLATE_STRIP) return the segments without them; otherwise the segments unchanged.
+
+    Segments are transcription segments with a 'Text' key. A segment lying entirely inside a flagged passage is
+    dropped; a segment straddling its edge is kept, so no timestamps are lost or shifted.
+    """
+    if not uploader or not document_key or not segments or not _env_flag('BOILERPLATE_DETECTION', 'true'):
+        return segments
+    strip = _env_flag('BOILERPLATE_STRIP', 'false') if strip is None else strip
+
+    # The transcript as extract_text_from_segments joins it, with each segment's offsets
+    offsets = []
+    position = 0
+    for segment in segments:
+        text = (segment.get('Text') or '').strip()
+        offsets.append((position, position + len(text)))
+        position += len(text) + 1
+    text = ' '.join((segment.get('Text') or '').strip() for segment in segments)
+
+    try:
+        # An episode already in the index counts towards its own shingles: require one more episode for it
+        min_episodes = BOILERPLATE_MIN_EPISODES + (1 if is_recorded(uploader, document_key) else 0)
+        spans = find_boilerplate_spans(text, uploader, min_episodes)
+        record_transcript(text, uploader, document_key)
+    except DatabaseError as e:
+        logging.error(f"Boilerplate detection failed for {uploader}: {e}")
+        return segments
+
+    if spans:
+        flagged = sum(end - start for start, end in spans)
+        logging.info(f"Boilerplate: {len(spans)} passage(s), {flagged} characters of {document_key} repeat earlier "
+                     f"episodes of {uploader}{' (stripped)' if strip else ''}")
+    if not strip or not spans:
+        return segments
+
+    kept = []
+    span_index = 0
+    for segment, (start, end) in zip(segments, offsets):
+        # Spans and segments are both in text order
+        while span_index < len(spans) and spans[span_index][1] < start:
+            span_index += 1
+        inside = span_index < len(spans) and spans[span_index][0] <= start and end <= spans[span_index][1]
+        if not inside or start == end:
+            kept.append(segment)
+    return kept
+
+#
+# End of Boilerplate Detection Library
+#######################################################################################################################
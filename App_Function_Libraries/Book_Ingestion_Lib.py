@@ -5,8 +5,8 @@
 ####################
 # Function List
 #
-# 1. ingest_text_file(file_path, title=None, author=None, keywords=None):
-# 2.
+# 1. ingest_text_file(file_path, title=None, author=None, keywords=None, chunk_options=None, chunks=None):
+# 2. ingest_folder(folder_path, keywords=None, chunk_options=None):
 #
 #
 ####################
@@ -20,7 +20,8 @@ import logging
 
 
 # Import Local
-from SQLite_DB import add_media_with_keywords
+from SQLite_DB import add_media_with_keywords, store_media_chunks
+from App_Function_Libraries.Chunk_Lib import CHUNK_OPTION_DEFAULTS, chunk_file, chunk_files_parallel
 
 #######################################################################################################################
 # Function Definitions
@@ -38,14 +39,23 @@ def extract_epub_metadata(content):
     return title, author
 
 
-def ingest_text_file(file_path, title=None, author=None, keywords=None):
-    try:
-        with open(file_path, 'r', encoding='utf-8') as file:
-            content = file.read()
+# Converted epubs carry their Title/Author lines at the top; only this much of the file is searched for them
+METADATA_HEAD_SIZE = 64 * 1024
+
 
+def ingest_text_file(file_path, title=None, author=None, keywords=None, chunk_options=None, chunks=None):
+    """
+    :param chunk_options: Chunking options to chunk the file with (streamed from the file, so a large file is never
+        chunked as one string); the chunks are cached for the new media item, so it is not chunked again when summarized
+    :param chunks: Chunks already computed with chunk_options (with token counts, as Chunk_Lib.chunk_files_parallel
+        returns them)
+    """
+    try:
         # Check if it's a converted epub and extract metadata if so
         if 'epub_converted' in (keywords or ''):
-            extracted_title, extracted_author = extract_epub_metadata(content)
+            with open(file_path, 'r', encoding='utf-8') as file:
+                head = file.read(METADATA_HEAD_SIZE)
+            extracted_title, extracted_author = extract_epub_metadata(head)
             title = title or extracted_title
             author = author or extracted_author
 
@@ -63,6 +73,13 @@ def ingest_text_file(file_path, title=None, author=None, keywords=None):
         else:
             keywords = f'text_file,epub_converted,{keywords}'
 
+        if chunk_options is not None and chunks is None:
+            chunks = chunk_file(file_path, chunk_options)
+
+        # The Media row stores the full text, so it is still read whole here
+        with open(file_path, 'r', encoding='utf-8') as file:
+            content = file.read()
+
         # Add the text file to the database
         add_media_with_keywords(
             url=file_path,
@@ -76,6 +93,9 @@ def ingest_text_file(file_path, title=None, author=None, keywords=None):
             author=author,
             ingestion_date=datetime.now().strftime('%Y-%m-%d')
         )
+        if chunk_options is not None:
+            # Keyed by content: local files do not get a url add_media_with_keywords could look the new item up by
+            store_media_chunks(content, chunk_options, chunks)
 
         return f"Text file '{title}' by {author} ingested successfully."
     except Exception as e:
@@ -83,13 +103,18 @@ def ingest_text_file(file_path, title=None, author=None, keywords=None):
         return f"Error ingesting text file: {str(e)}"
 
 
-def ingest_folder(folder_path, keywords=None):
+def ingest_folder(folder_path, keywords=None, chunk_options=None):
     results = []
-    for filename in os.listdir(folder_path):
-        if filename.lower().endswith('.txt'):
-            file_path = os.path.join(folder_path, filename)
+    file_paths = [os.path.join(folder_path, filename) for filename in sorted(os.listdir(folder_path))
+                  if filename.lower().endswith('.txt')]
+    chunk_options = {**CHUNK_OPTION_DEFAULTS, **(chunk_options or {})}
+    # The files are chunked on a process pool (CHUNK_WORKERS) while they are ingested, in order, one by one
+    chunked = chunk_files_parallel(file_paths, chunk_options, return_exceptions=True)
+    for file_path, (_, chunks) in zip(file_paths, chunked):
+        if isinstance(chunks, Exception):
+            logging.warning(f"Could not chunk {file_path}, ingesting it without chunks: {chunks}")
             result = ingest_text_file(file_path, keywords=keywords)
-            results.append(result)
-
-
-
+        else:
+            result = ingest_text_file(file_path, keywords=keywords, chunk_options=chunk_options, chunks=chunks)
+        results.append(result)
+    return results
@@ -6,23 +6,29 @@
 #
 ####
 # Import necessary libraries
+import hashlib
+import json
 import logging
+import os
 import re
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
 
-from typing import List, Optional, Tuple, Dict, Any
+from typing import List, Optional, Tuple, Dict, Any, Iterable, Iterator
 
 from openai import OpenAI
 from tqdm import tqdm
 #
 # Import 3rd party
-from transformers import GPT2Tokenizer
-import nltk
-from nltk.tokenize import sent_tokenize, word_tokenize
+import numpy as np
 from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
 #
 # Import Local
-from App_Function_Libraries.Tokenization_Methods_Lib import openai_tokenize
+from App_Function_Libraries.Embedding_Models_Lib import get_embedding_model
+from App_Function_Libraries.Sentence_Segmentation_Lib import prepare_sentence_segmenter, split_sentences, \
+    get_segmenter, sentence_spans as segment_sentence_spans
+from App_Function_Libraries.Tokenization_Methods_Lib import count_tokens, count_tokens_batch, get_tokenizer, \
+    resolve_tokenizer_spec, DEFAULT_TOKENIZER_MODEL
 from App_Function_Libraries.Utils import load_comprehensive_config
 
 
@@ -31,52 +37,194 @@ from App_Function_Libraries.Utils import load_comprehensive_config
 # Function Definitions
 #
 
-# FIXME - Make sure it only downloads if it already exists, and does a check first.
-# Ensure NLTK data is downloaded
+# Ensure the sentence segmenter is ready; downloads the NLTK Punkt data only if it is not installed yet
 def ntlk_prep():
-    nltk.download('punkt')
-
-# Load GPT2 tokenizer
-tokenizer = GPT2Tokenizer.from_pretrained("gpt2")
+    prepare_sentence_segmenter(download=True)
 
 # Load Config file for API keys
 config = load_comprehensive_config()
 openai_api_key = config.get('API', 'openai_api_key', fallback=None)
 
+# Characters read per block by the streaming readers/chunkers
+STREAM_BLOCK_SIZE = 1 << 18
+
+
+def iter_text_blocks(file_path: str, block_size: int = STREAM_BLOCK_SIZE, encoding: str = 'utf-8') -> Iterator[str]:
+    """Read a text file block by block."""
+    with open(file_path, 'r', encoding=encoding) as file:
+        while True:
+            block = file.read(block_size)
+            if not block:
+                return
+            yield block
+
+
+def iter_document(file_path: str, block_size: int = STREAM_BLOCK_SIZE) -> Iterator[str]:
+    """load_document() as a stream of blocks: whitespace runs collapsed to one space, ends stripped."""
+    pending_space = False
+    started = False
+    for block in iter_text_blocks(file_path, block_size):
+        normalized = re.sub('\\s+', ' ', block)
+        if not normalized:
+            continue
+        # A whitespace run can span two blocks; hold a trailing space back until text follows it
+        if normalized[0] == ' ':
+            pending_space = True
+            normalized = normalized[1:]
+        trailing_space = normalized.endswith(' ')
+        normalized = normalized.rstrip(' ')
+        if normalized:
+            yield (' ' if pending_space and started else '') + normalized
+            started = True
+            pending_space = False
+        pending_space = pending_space or trailing_space
+
+
 def load_document(file_path):
-    with open(file_path, 'r') as file:
-        text = file.read()
-    return re.sub('\\s+', ' ', text).strip()
+    return ''.join(iter_document(file_path))
 
 
-def improved_chunking_process(text: str, chunk_options: Dict[str, Any]) -> List[Dict[str, Any]]:
+class Chunk:
+    """
+    A chunk as a (start, end) character span over its source text.
+
+    The text is sliced from the source only when it is read, and the offsets are exact, so they can be used for
+    highlighting and citations.
+    """
+    __slots__ = ('source', 'start', 'end', 'chunk_type', 'extra')
+
+    def __init__(self, source: str, start: int, end: int, chunk_type: str = "generic", **extra):
+        self.source = source
+        self.start = start
+        self.end = end
+        self.chunk_type = chunk_type
+        self.extra = extra
+
+    @property
+    def text(self) -> str:
+        return self.source[self.start:self.end]
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __repr__(self):
+        return f"Chunk({self.start}, {self.end}, {self.chunk_type!r})"
+
+    def to_dict(self) -> Dict[str, Any]:
+        """The {'text', 'metadata'} form returned by improved_chunking_process()."""
+        text = self.text
+        return {'text': text, 'metadata': get_chunk_metadata(text, self.source, self.chunk_type,
+                                                             start_index=self.start, **self.extra)}
+
+
+def improved_chunking_spans(text: str, chunk_options: Dict[str, Any]) -> List[Chunk]:
     chunk_method = chunk_options.get('method', 'words')
     max_chunk_size = chunk_options.get('max_size', 300)
     overlap = chunk_options.get('overlap', 0)
     language = chunk_options.get('language', 'english')
     adaptive = chunk_options.get('adaptive', False)
     multi_level = chunk_options.get('multi_level', False)
+    # Tokenizer spec of the model the chunks are for (see Tokenization_Methods_Lib.get_tokenizer)
+    tokenizer = chunk_options.get('tokenizer')
 
     if adaptive:
         max_chunk_size = adaptive_chunk_size(text, max_chunk_size)
 
     if multi_level:
-        chunks = multi_level_chunking(text, chunk_method, max_chunk_size, overlap, language)
+        spans = multi_level_chunk_spans(text, chunk_method, max_chunk_size, overlap, language)
     else:
         if chunk_method == 'words':
-            chunks = chunk_text_by_words(text, max_chunk_size, overlap)
+            spans = chunk_spans_by_words(text, max_chunk_size, overlap)
         elif chunk_method == 'sentences':
-            chunks = chunk_text_by_sentences(text, max_chunk_size, overlap, language)
+            spans = chunk_spans_by_sentences(text, max_chunk_size, overlap, language)
         elif chunk_method == 'paragraphs':
-            chunks = chunk_text_by_paragraphs(text, max_chunk_size, overlap)
+            spans = chunk_spans_by_paragraphs(text, max_chunk_size, overlap)
         elif chunk_method == 'tokens':
-            chunks = chunk_text_by_tokens(text, max_chunk_size, overlap)
+            spans = chunk_spans_by_tokens(text, max_chunk_size, overlap, tokenizer)
+        elif chunk_method == 'semantic':
+            spans = semantic_chunk_spans(text, max_chunk_size, chunk_options.get('unit', 'words'), tokenizer)
         elif chunk_method == 'chapters':
-            return chunk_ebook_by_chapters(text, chunk_options)
+            return chunk_ebook_spans_by_chapters(text, chunk_options)
         else:
-            chunks = [text]  # No chunking applied
+            spans = [trim_span(text, 0, len(text))]  # No chunking applied
 
-    return [{'text': chunk, 'metadata': get_chunk_metadata(chunk, text)} for chunk in chunks]
+    return [Chunk(text, start, end) for start, end in spans if end > start]
+
+
+def improved_chunking_process(text: str, chunk_options: Dict[str, Any]) -> List[Dict[str, Any]]:
+    return [chunk.to_dict() for chunk in improved_chunking_spans(text, chunk_options)]
+
+
+#
+# Chunk caching (stored in the MediaChunks table by SQLite_DB.get_media_chunks)
+#
+
+# Bump whenever a chunker change alters its output, so chunks cached by older versions are not reused
+CHUNKER_VERSION = 1
+
+CHUNK_OPTION_DEFAULTS = {'method': 'words', 'max_size': 300, 'overlap': 0, 'language': 'english',
+                         'adaptive': False, 'multi_level': False}
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def canonical_chunk_options(chunk_options: Dict[str, Any]) -> str:
+    """
+    Chunk options as a canonical string: equal for option dicts that produce the same chunks.
+
+    Defaults are filled in, the tokenizer spec resolved, and what else decides the output recorded (the sentence
+    segmenter, the semantic similarity model and the chunker version).
+    """
+    options = dict(CHUNK_OPTION_DEFAULTS)
+    options.update({key: value for key, value in chunk_options.items() if value is not None})
+    options['max_size'] = int(options['max_size'])
+    options['overlap'] = int(options['overlap'])
+    # Token counts are stored with the chunks, so the tokenizer is part of the key for every method
+    options['tokenizer'] = resolve_tokenizer_spec(options.get('tokenizer'))
+    if options['method'] in ('sentences', 'semantic') or options['multi_level']:
+        options['segmenter'] = get_segmenter(options['language']).name
+    if options['method'] == 'semantic':
+        options.setdefault('unit', 'words')
+        options['semantic_model'] = SEMANTIC_CHUNK_MODEL
+    options['version'] = CHUNKER_VERSION
+    return json.dumps(options, sort_keys=True, separators=(',', ':'), default=str)
+
+
+def serialize_chunks(chunks: List[Chunk], token_counts: List[int]) -> str:
+    """Chunks as JSON [start, end, token count, chunk type, extra] rows, without their text."""
+    return json.dumps([[chunk.start, chunk.end, tokens, chunk.chunk_type, chunk.extra]
+                       for chunk, tokens in zip(chunks, token_counts)], separators=(',', ':'))
+
+
+def deserialize_chunks(text: str, payload: str) -> Tuple[List[Chunk], List[int]]:
+    rows = json.loads(payload)
+    return ([Chunk(text, start, end, chunk_type, **extra) for start, end, _, chunk_type, extra in rows],
+            [row[2] for row in rows])
+
+
+def chunk_dicts_with_token_counts(chunks: List[Chunk], token_counts: List[int]) -> List[Dict[str, Any]]:
+    """improved_chunking_process() output with each chunk's token count added to its metadata."""
+    chunk_dicts = []
+    for chunk, tokens in zip(chunks, token_counts):
+        chunk_dict = chunk.to_dict()
+        chunk_dict['metadata']['token_count'] = tokens
+        chunk_dicts.append(chunk_dict)
+    return chunk_dicts
+
+
+def chunk_dicts_to_spans(text: str, chunk_dicts: List[Dict[str, Any]]) -> Tuple[List[Chunk], List[int]]:
+    """Inverse of chunk_dicts_with_token_counts(), for chunks computed elsewhere (e.g. by the parallel chunkers)."""
+    chunks = []
+    token_counts = []
+    for chunk_dict in chunk_dicts:
+        metadata = chunk_dict['metadata']
+        extra = {key: metadata[key] for key in ('chapter_number', 'chapter_pattern') if key in metadata}
+        chunks.append(Chunk(text, metadata['start_index'], metadata['end_index'],
+                            metadata.get('chunk_type', 'generic'), **extra))
+        token_counts.append(metadata['token_count'])
+    return chunks, token_counts
 
 
 def adaptive_chunk_size(text: str, base_size: int) -> int:
@@ -87,82 +235,143 @@ def adaptive_chunk_size(text: str, base_size: int) -> int:
     return base_size
 
 
-def multi_level_chunking(text: str, method: str, max_size: int, overlap: int, language: str) -> List[str]:
+#
+# Span helpers: every chunker below works on (start, end) character offsets into the original text, so chunk
+#   offsets never have to be searched for afterwards.
+#
+
+WORD_PATTERN = re.compile(r'\S+')
+PARAGRAPH_BREAK_PATTERN = re.compile(r'\n\s*\n')
+
+
+def trim_span(text: str, start: int, end: int) -> Tuple[int, int]:
+    """Shrink a span to exclude leading/trailing whitespace (what post_process_chunks' strip() did)."""
+    segment = text[start:end]
+    stripped = segment.strip()
+    if not stripped:
+        return start, start
+    start += len(segment) - len(segment.lstrip())
+    return start, start + len(stripped)
+
+
+def word_spans(text: str, start: int = 0, end: Optional[int] = None) -> List[Tuple[int, int]]:
+    return [match.span() for match in WORD_PATTERN.finditer(text, start, len(text) if end is None else end)]
+
+
+def sentence_spans(text: str, language: str = 'english', start: int = 0,
+                   end: Optional[int] = None) -> List[Tuple[int, int]]:
+    return segment_sentence_spans(text, language, start, end)
+
+
+def paragraph_spans(text: str, start: int = 0, end: Optional[int] = None) -> List[Tuple[int, int]]:
+    end = len(text) if end is None else end
+    spans = []
+    cursor = start
+    for match in PARAGRAPH_BREAK_PATTERN.finditer(text, start, end):
+        spans.append((cursor, match.start()))
+        cursor = match.end()
+    spans.append((cursor, end))
+    return spans
+
+
+def window_spans(text: str, unit_spans: List[Tuple[int, int]], size: int, overlap: int = 0) -> List[Tuple[int, int]]:
+    """Chunks of `size` consecutive units (words, sentences, ...), consecutive chunks sharing `overlap` units."""
+    spans = []
+    for i in range(0, len(unit_spans), max(1, size - overlap)):
+        window = unit_spans[i:i + size]
+        span = trim_span(text, window[0][0], window[-1][1])
+        if span[1] > span[0]:
+            spans.append(span)
+    return spans
+
+
+def chunk_spans_by_words(text: str, max_words: int = 300, overlap: int = 0, start: int = 0,
+                         end: Optional[int] = None) -> List[Tuple[int, int]]:
+    return window_spans(text, word_spans(text, start, end), max_words, overlap)
+
+
+def chunk_spans_by_sentences(text: str, max_sentences: int = 10, overlap: int = 0, language: str = 'english',
+                             start: int = 0, end: Optional[int] = None) -> List[Tuple[int, int]]:
+    return window_spans(text, sentence_spans(text, language, start, end), max_sentences, overlap)
+
+
+def chunk_spans_by_paragraphs(text: str, max_paragraphs: int = 5, overlap: int = 0) -> List[Tuple[int, int]]:
+    return window_spans(text, paragraph_spans(text), max_paragraphs, overlap)
+
+
+def chunk_spans_by_tokens(text: str, max_tokens: int = 1000, overlap: int = 0,
+                          tokenizer: Optional[str] = None) -> List[Tuple[int, int]]:
+    # Chunks break between words; every word is counted (with its leading space, as it appears mid-text) by the
+    # target model's tokenizer, in one batch
+    words = word_spans(text)
+    word_token_counts = count_tokens_batch([' ' + text[start:end] for start, end in words], tokenizer)
+    spans = []
+    first = 0  # index of the first word of the current chunk
+    current_token_count = 0
+
+    for i, word_token_count in enumerate(word_token_counts):
+        if current_token_count + word_token_count > max_tokens and i > first:
+            spans.append((words[first][0], words[i - 1][1]))
+            first = max(first + 1, i - overlap) if overlap > 0 else i
+            current_token_count = sum(word_token_counts[first:i])
+
+        current_token_count += word_token_count
+
+    if first < len(words):
+        spans.append((words[first][0], words[-1][1]))
+
+    return spans
+
+
+def multi_level_chunk_spans(text: str, method: str, max_size: int, overlap: int,
+                            language: str) -> List[Tuple[int, int]]:
     # First level: chunk by paragraphs
-    paragraphs = chunk_text_by_paragraphs(text, max_size * 2, overlap)
+    paragraphs = chunk_spans_by_paragraphs(text, max_size * 2, overlap)
 
     # Second level: chunk each paragraph further
-    chunks = []
-    for para in paragraphs:
+    spans = []
+    for start, end in paragraphs:
         if method == 'words':
-            chunks.extend(chunk_text_by_words(para, max_size, overlap))
+            spans.extend(chunk_spans_by_words(text, max_size, overlap, start, end))
         elif method == 'sentences':
-            chunks.extend(chunk_text_by_sentences(para, max_size, overlap, language))
+            spans.extend(chunk_spans_by_sentences(text, max_size, overlap, language, start, end))
         else:
-            chunks.append(para)
+            spans.append((start, end))
+
+    return spans
 
-    return chunks
+
+def multi_level_chunking(text: str, method: str, max_size: int, overlap: int, language: str) -> List[str]:
+    return [text[start:end] for start, end in multi_level_chunk_spans(text, method, max_size, overlap, language)]
 
 
 def chunk_text_by_words(text: str, max_words: int = 300, overlap: int = 0) -> List[str]:
-    words = text.split()
-    chunks = []
-    for i in range(0, len(words), max_words - overlap):
-        chunk = ' '.join(words[i:i + max_words])
-        chunks.append(chunk)
-    return post_process_chunks(chunks)
+    return [text[start:end] for start, end in chunk_spans_by_words(text, max_words, overlap)]
 
 
 def chunk_text_by_sentences(text: str, max_sentences: int = 10, overlap: int = 0, language: str = 'english') -> List[
     str]:
-    nltk.download('punkt', quiet=True)
-    sentences = nltk.sent_tokenize(text, language=language)
-    chunks = []
-    for i in range(0, len(sentences), max_sentences - overlap):
-        chunk = ' '.join(sentences[i:i + max_sentences])
-        chunks.append(chunk)
-    return post_process_chunks(chunks)
+    return [text[start:end] for start, end in chunk_spans_by_sentences(text, max_sentences, overlap, language)]
 
 
 def chunk_text_by_paragraphs(text: str, max_paragraphs: int = 5, overlap: int = 0) -> List[str]:
-    paragraphs = re.split(r'\n\s*\n', text)
-    chunks = []
-    for i in range(0, len(paragraphs), max_paragraphs - overlap):
-        chunk = '\n\n'.join(paragraphs[i:i + max_paragraphs])
-        chunks.append(chunk)
-    return post_process_chunks(chunks)
-
-
-def chunk_text_by_tokens(text: str, max_tokens: int = 1000, overlap: int = 0) -> List[str]:
-    # This is a simplified token-based chunking. For more accurate tokenization,
-    # consider using a proper tokenizer like GPT-2 TokenizerFast
-    words = text.split()
-    chunks = []
-    current_chunk = []
-    current_token_count = 0
-
-    for word in words:
-        word_token_count = len(word) // 4 + 1  # Rough estimate of token count
-        if current_token_count + word_token_count > max_tokens and current_chunk:
-            chunks.append(' '.join(current_chunk))
-            current_chunk = current_chunk[-overlap:] if overlap > 0 else []
-            current_token_count = sum(len(w) // 4 + 1 for w in current_chunk)
-
-        current_chunk.append(word)
-        current_token_count += word_token_count
+    return [text[start:end] for start, end in chunk_spans_by_paragraphs(text, max_paragraphs, overlap)]
 
-    if current_chunk:
-        chunks.append(' '.join(current_chunk))
 
-    return post_process_chunks(chunks)
+def chunk_text_by_tokens(text: str, max_tokens: int = 1000, overlap: int = 0,
+                         tokenizer: Optional[str] = None) -> List[str]:
+    return [text[start:end] for start, end in chunk_spans_by_tokens(text, max_tokens, overlap, tokenizer)]
 
 
 def post_process_chunks(chunks: List[str]) -> List[str]:
     return [chunk.strip() for chunk in chunks if chunk.strip()]
 
 
-def get_chunk_metadata(chunk: str, full_text: str, chunk_type: str = "generic", chapter_number: Optional[int] = None, chapter_pattern: Optional[str] = None) -> Dict[str, Any]:
-    start_index = full_text.index(chunk)
+def get_chunk_metadata(chunk: str, full_text: str, chunk_type: str = "generic", chapter_number: Optional[int] = None,
+                       chapter_pattern: Optional[str] = None, start_index: Optional[int] = None) -> Dict[str, Any]:
+    if start_index is None:
+        # Callers without a span; the span-based chunkers always pass the exact offset
+        start_index = full_text.index(chunk)
     metadata = {
         'start_index': start_index,
         'end_index': start_index + len(chunk),
@@ -177,21 +386,20 @@ def get_chunk_metadata(chunk: str, full_text: str, chunk_type: str = "generic",
 
 
 # Hybrid approach, chunk each sentence while ensuring total token size does not exceed a maximum number
-def chunk_text_hybrid(text, max_tokens=1000):
-    sentences = nltk.tokenize.sent_tokenize(text)
+def chunk_text_hybrid(text, max_tokens=1000, tokenizer: Optional[str] = None):
+    sentences = split_sentences(text)
     chunks = []
     current_chunk = []
     current_length = 0
 
-    for sentence in sentences:
-        tokens = tokenizer.encode(sentence)
-        if current_length + len(tokens) <= max_tokens:
+    for sentence, sentence_tokens in zip(sentences, count_tokens_batch(sentences, tokenizer)):
+        if current_length + sentence_tokens <= max_tokens:
             current_chunk.append(sentence)
-            current_length += len(tokens)
+            current_length += sentence_tokens
         else:
             chunks.append(' '.join(current_chunk))
             current_chunk = [sentence]
-            current_length = len(tokens)
+            current_length = sentence_tokens
 
     if current_chunk:
         chunks.append(' '.join(current_chunk))
@@ -201,10 +409,13 @@ def chunk_text_hybrid(text, max_tokens=1000):
 # Thanks openai
 def chunk_on_delimiter(input_string: str,
                        max_tokens: int,
-                       delimiter: str) -> List[str]:
+                       delimiter: str,
+                       model: str = DEFAULT_TOKENIZER_MODEL,
+                       chunk_token_counts: Optional[List[int]] = None) -> List[str]:
     chunks = input_string.split(delimiter)
     combined_chunks, _, dropped_chunk_count = combine_chunks_with_no_minimum(
-        chunks, max_tokens, chunk_delimiter=delimiter, add_ellipsis_for_overflow=True)
+        chunks, max_tokens, chunk_delimiter=delimiter, add_ellipsis_for_overflow=True, model=model,
+        chunk_token_counts=chunk_token_counts)
     if dropped_chunk_count > 0:
         print(f"Warning: {dropped_chunk_count} chunks were dropped due to exceeding the token limit.")
     combined_chunks = [f"{chunk}{delimiter}" for chunk in combined_chunks]
@@ -266,65 +477,511 @@ Natural language processing has its roots in the 1950s. Already in 1950, Alan Tu
 #
 
 # Chunk text into segments based on semantic similarity
-def count_units(text, unit='tokens'):
+def count_units(text, unit='tokens', tokenizer: Optional[str] = None):
     if unit == 'words':
         return len(text.split())
     elif unit == 'tokens':
-        return len(word_tokenize(text))
+        return count_tokens(text, tokenizer)
     elif unit == 'characters':
         return len(text)
     else:
         raise ValueError("Invalid unit. Choose 'words', 'tokens', or 'characters'.")
 
 
-def semantic_chunking(text, max_chunk_size=2000, unit='words'):
-    nltk.download('punkt', quiet=True)
-    sentences = sent_tokenize(text)
-    vectorizer = TfidfVectorizer()
-    sentence_vectors = vectorizer.fit_transform(sentences)
+def count_units_batch(texts: List[str], unit='tokens', tokenizer: Optional[str] = None) -> List[int]:
+    if unit == 'tokens':
+        return count_tokens_batch(texts, tokenizer)
+    return [count_units(text, unit, tokenizer) for text in texts]
+
+
+# Embedding model scoring sentence similarity in semantic chunking; unset uses TF-IDF
+SEMANTIC_CHUNK_MODEL = os.getenv('SEMANTIC_CHUNK_MODEL') or None
+
+
+def adjacent_similarities(sentences: List[str], embedding_model: Optional[str] = None) -> np.ndarray:
+    """
+    Cosine similarity of every sentence with the next one (n - 1 values), in one vectorized pass.
+
+    :param sentences: The sentences, in order
+    :param embedding_model: Embedding model to encode the sentences with (batched); None for TF-IDF vectors
+    """
+    if len(sentences) < 2:
+        return np.zeros(0)
+    if embedding_model:
+        vectors = np.asarray(get_embedding_model(embedding_model).encode(sentences, batch_size=64), dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = vectors / np.where(norms == 0, 1, norms)
+        return np.einsum('ij,ij->i', vectors[:-1], vectors[1:])
+    try:
+        # Rows come out L2-normalized, so the row-wise product with the next row is the cosine similarity
+        vectors = TfidfVectorizer().fit_transform(sentences)
+    except ValueError:
+        # No word in any sentence: nothing to compare
+        return np.zeros(len(sentences) - 1)
+    return np.asarray(vectors[:-1].multiply(vectors[1:]).sum(axis=1)).ravel()
+
+
+def semantic_chunk_spans(text, max_chunk_size=2000, unit='words', tokenizer: Optional[str] = None,
+                         embedding_model: Optional[str] = SEMANTIC_CHUNK_MODEL,
+                         similarity_threshold: float = 0.5) -> List[Tuple[int, int]]:
+    spans = sentence_spans(text)
+    if not spans:
+        return []
+    sentences = [text[start:end] for start, end in spans]
+    similarities = adjacent_similarities(sentences, embedding_model).tolist()
+    # Size of sentences [i, j) is prefix[j] - prefix[i]
+    prefix = [0]
+    for size in count_units_batch(sentences, unit, tokenizer):
+        prefix.append(prefix[-1] + size)
 
     chunks = []
-    current_chunk = []
-    current_size = 0
+    first = 0  # first sentence of the current chunk; the chunk is sentences [first, i]
 
-    for i, sentence in enumerate(sentences):
-        sentence_size = count_units(sentence, unit)
-        if current_size + sentence_size > max_chunk_size and current_chunk:
-            chunks.append(' '.join(current_chunk))
-            overlap_size = count_units(' '.join(current_chunk[-3:]), unit)  # Use last 3 sentences for overlap
-            current_chunk = current_chunk[-3:]  # Keep last 3 sentences for overlap
-            current_size = overlap_size
-
-        current_chunk.append(sentence)
-        current_size += sentence_size
-
-        if i + 1 < len(sentences):
-            current_vector = sentence_vectors[i]
-            next_vector = sentence_vectors[i + 1]
-            similarity = cosine_similarity(current_vector, next_vector)[0][0]
-            if similarity < 0.5 and current_size >= max_chunk_size // 2:
-                chunks.append(' '.join(current_chunk))
-                overlap_size = count_units(' '.join(current_chunk[-3:]), unit)
-                current_chunk = current_chunk[-3:]
-                current_size = overlap_size
+    for i in range(len(sentences)):
+        if prefix[i + 1] - prefix[first] > max_chunk_size and i > first:
+            chunks.append((spans[first][0], spans[i - 1][1]))
+            first = max(first, i - 3)  # Keep last 3 sentences for overlap
 
-    if current_chunk:
-        chunks.append(' '.join(current_chunk))
+        if i + 1 < len(sentences) and similarities[i] < similarity_threshold \
+                and prefix[i + 1] - prefix[first] >= max_chunk_size // 2:
+            chunks.append((spans[first][0], spans[i][1]))
+            first = max(first, i - 2)
+
+    chunks.append((spans[first][0], spans[-1][1]))
 
     return chunks
 
 
+def semantic_chunking(text, max_chunk_size=2000, unit='words', tokenizer: Optional[str] = None):
+    return [text[start:end] for start, end in semantic_chunk_spans(text, max_chunk_size, unit, tokenizer)]
+
+
+def iter_semantic_chunks_from_file(file_path, max_chunk_size=1000, unit='words',
+                                   tokenizer: Optional[str] = None) -> Iterator[str]:
+    """Semantic chunks of a text file of any size, read and chunked block by block (see stream_chunks)."""
+    options = {'method': 'semantic', 'max_size': max_chunk_size, 'unit': unit, 'tokenizer': tokenizer}
+    for chunk in stream_chunks(iter_text_blocks(file_path), options):
+        yield chunk['text']
+
+
 def semantic_chunk_long_file(file_path, max_chunk_size=1000, overlap=100):
+    # Overlap between semantic chunks is fixed at three sentences; `overlap` is kept for existing callers
     try:
-        with open(file_path, 'r', encoding='utf-8') as file:
-            content = file.read()
-
-        chunks = semantic_chunking(content, max_chunk_size, overlap)
-        return chunks
+        return list(iter_semantic_chunks_from_file(file_path, max_chunk_size))
     except Exception as e:
         logging.error(f"Error chunking text file: {str(e)}")
         return None
 #######################################################################################################################
+#
+# Extractive pre-compression
+#
+# Before chunks go to an LLM, the least central sentences can be dropped on the CPU: sentences are ranked with
+# TextRank (PageRank over the TF-IDF cosine-similarity graph of the chunk's sentences, by power iteration in NumPy)
+# and the best are kept, in their original order, up to a fraction of the chunk's tokens. Long texts are ranked in
+# windows of COMPRESSION_WINDOW_SENTENCES sentences, each keeping its share, so cost stays linear in the text length
+# and every part of the text stays represented.
+
+# Fraction of each chunk's tokens kept by extractive pre-compression; 1.0 (the default) turns it off
+EXTRACTIVE_COMPRESSION_RATIO = float(os.getenv('EXTRACTIVE_COMPRESSION_RATIO', '1.0'))
+COMPRESSION_WINDOW_SENTENCES = 64
+
+
+def textrank_scores(sentences: List[str], damping: float = 0.85, max_iterations: int = 100,
+                    tolerance: float = 1e-6) -> np.ndarray:
+    """TextRank centrality of each sentence (the scores sum to 1)."""
+    count = len(sentences)
+    if count < 3:
+        return np.full(count, 1.0 / max(count, 1))
+    try:
+        vectors = TfidfVectorizer(stop_words='english').fit_transform(sentences)
+    except ValueError:
+        # No word in any sentence
+        return np.full(count, 1.0 / count)
+    # TF-IDF rows are L2-normalized, so the similarity matrix is V @ V.T (minus its diagonal of self-similarities).
+    # It is never formed: similarity @ x is computed as V @ (V.T @ x), two sparse products.
+    self_similarity = np.asarray(vectors.multiply(vectors).sum(axis=1), dtype=float).ravel()
+
+    def propagate(x: np.ndarray) -> np.ndarray:
+        return np.asarray(vectors @ (vectors.T @ x), dtype=float).ravel() - self_similarity * x
+
+    out_weight = propagate(np.ones(count))
+    linked = out_weight > 1e-12
+    scores = np.full(count, 1.0 / count)
+    for _ in range(max_iterations):
+        # Sentences sharing no word with any other link to every sentence equally
+        shared = np.divide(scores, out_weight, out=np.zeros(count), where=linked)
+        updated = (1 - damping) / count + damping * (propagate(shared) + scores[~linked].sum() / count)
+        if np.abs(updated - scores).sum() < tolerance:
+            return updated
+        scores = updated
+    return scores
+
+
+def extractive_compress(text: str, ratio: float = EXTRACTIVE_COMPRESSION_RATIO, tokenizer: Optional[str] = None,
+                        language: str = 'english', window_sentences: int = COMPRESSION_WINDOW_SENTENCES) -> str:
+    """
+    Keep the most central sentences of `text`, in order, within `ratio` of its tokens.
+
+    :param text: The text (usually one chunk) to compress
+    :param ratio: Fraction of the tokens to keep, in (0, 1]; lower is more aggressive, 1.0 returns the text unchanged
+    :param tokenizer: Tokenizer spec the budget is counted in (that of the summarizing model)
+    :param language: Language for sentence segmentation
+    :param window_sentences: Sentences ranked together; each window keeps `ratio` of its own tokens
+    """
+    if ratio >= 1.0:
+        return text
+    spans = sentence_spans(text, language)
+    if len(spans) < 3:
+        return text
+    sentences = [text[start:end] for start, end in spans]
+    token_counts = count_tokens_batch(sentences, tokenizer)
+
+    kept = []
+    for window_start in range(0, len(sentences), window_sentences):
+        window_end = min(window_start + window_sentences, len(sentences))
+        budget = max(0.0, ratio) * sum(token_counts[window_start:window_end])
+        window_kept = []
+        used = 0
+        for offset in np.argsort(-textrank_scores(sentences[window_start:window_end]), kind='stable').tolist():
+            index = window_start + offset
+            if used + token_counts[index] <= budget or not window_kept:
+                window_kept.append(index)
+                used += token_counts[index]
+        kept.extend(sorted(window_kept))
+
+    # Kept sentences are joined by the original text between them, the one with the most line breaks where
+    # sentences were dropped, so paragraph and transcript line breaks survive
+    pieces = [sentences[kept[0]]]
+    for previous, index in zip(kept, kept[1:]):
+        gaps = [text[spans[k][1]:spans[k + 1][0]] for k in range(previous, index)]
+        pieces.append(max(gaps, key=lambda gap: gap.count('\n')) or ' ')
+        pieces.append(sentences[index])
+    return ''.join(pieces)
+
+
+def compress_chunks(chunks: List[Dict[str, Any]], ratio: float = EXTRACTIVE_COMPRESSION_RATIO,
+                    tokenizer: Optional[str] = None, language: str = 'english') -> List[Dict[str, Any]]:
+    """Chunk dicts with their text extractively compressed; the metadata still describes the original chunk."""
+    if ratio >= 1.0:
+        return chunks
+    compressed = [dict(chunk, text=extractive_compress(chunk['text'], ratio, tokenizer, language)) for chunk in chunks]
+    before = sum(len(chunk['text']) for chunk in chunks)
+    after = sum(len(chunk['text']) for chunk in compressed)
+    logging.info(f"Extractive pre-compression kept {after}/{before} characters (target ratio {ratio})")
+    return compressed
+#######################################################################################################################
+#
+# Streaming chunking
+#
+# Chunks text that arrives in blocks (a file read piece by piece, a transcript as it is produced) with bounded memory.
+# Only the unfinished tail is kept: after each block the buffer is chunked, every chunk that more text can no longer
+# change is yielded, and the buffer is cut at the start of the first chunk not yet yielded. Chunking from a chunk's
+# start reproduces the same chunks (windows restart on a unit boundary with the same stride), so the yielded chunks
+# match chunking the whole text at once; only semantic chunking differs, as its TF-IDF is fitted per buffer.
+
+def stable_boundary(buffer: str, chunk_options: Dict[str, Any]) -> int:
+    """Offset up to which `buffer` is final: its last unit (word, sentence, paragraph) may still be incomplete."""
+    method = chunk_options.get('method', 'words')
+    if chunk_options.get('multi_level') or method == 'paragraphs':
+        last = None
+        for last in PARAGRAPH_BREAK_PATTERN.finditer(buffer):
+            pass
+        return last.start() if last else 0
+    if method in ('sentences', 'semantic'):
+        # Same segmenter as the chunkers: everything before the last sentence is final
+        spans = sentence_spans(buffer, chunk_options.get('language', 'english'))
+        return spans[-1][0] if len(spans) > 1 else 0
+    position = len(buffer)
+    while position > 0 and not buffer[position - 1].isspace():
+        position -= 1
+    return position
+
+
+def chunk_span_groups(text: str, chunk_options: Dict[str, Any]) -> List[Tuple[int, List[Chunk]]]:
+    """Chunks grouped by the offset chunking can restart from: (restart offset, chunks) per group."""
+    if chunk_options.get('multi_level'):
+        # Second-level chunks restart at their first-level paragraph group
+        options = dict(chunk_options, multi_level=False)
+        groups = []
+        for start, end in chunk_spans_by_paragraphs(text, chunk_options.get('max_size', 300) * 2,
+                                                    chunk_options.get('overlap', 0)):
+            chunks = [Chunk(text, start + chunk.start, start + chunk.end)
+                      for chunk in improved_chunking_spans(text[start:end], options)]
+            groups.append((start, chunks))
+        return groups
+    return [(chunk.start, [chunk]) for chunk in improved_chunking_spans(text, chunk_options)]
+
+
+def _shifted(chunk: Chunk, offset: int) -> Dict[str, Any]:
+    chunk_dict = chunk.to_dict()
+    chunk_dict['metadata']['start_index'] += offset
+    chunk_dict['metadata']['end_index'] += offset
+    return chunk_dict
+
+
+def stream_chunks(blocks: Iterable[str], chunk_options: Dict[str, Any],
+                  min_buffer_size: int = STREAM_BLOCK_SIZE) -> Iterator[Dict[str, Any]]:
+    """
+    Chunk a stream of text blocks, yielding chunks (as improved_chunking_process() does) as soon as they are final.
+
+    Offsets in the metadata are relative to the start of the stream. Memory is bounded by min_buffer_size plus the
+    unfinished chunk and its overlap. Chapter chunking needs the whole text and is not streamed.
+    """
+    options = dict(chunk_options)
+    if options.get('method') == 'chapters':
+        yield from (chunk.to_dict() for chunk in chunk_ebook_spans_by_chapters(''.join(blocks), options))
+        return
+
+    buffer = ''
+    buffer_offset = 0  # offset of buffer[0] in the stream
+    blocks = iter(blocks)
+    exhausted = False
+    while not exhausted:
+        block = next(blocks, None)
+        if block is None:
+            exhausted = True
+        else:
+            buffer += block
+            if len(buffer) < min_buffer_size:
+                continue
+        if options.get('adaptive') and buffer.split():
+            # Decided once, from the first buffer, so the chunk size does not change mid-stream
+            options['max_size'] = adaptive_chunk_size(buffer, options.get('max_size', 300))
+            options['adaptive'] = False
+
+        boundary = len(buffer) if exhausted else stable_boundary(buffer, options)
+        groups = chunk_span_groups(buffer, options)
+        emitted = 0
+        # A group is final once it ends before the unstable tail and a later group starts after it: a group cut
+        # short by the end of the buffer overlaps every group that follows it
+        while emitted < len(groups) and (exhausted or (
+                max((chunk.end for chunk in groups[emitted][1]), default=0) <= min(boundary, groups[-1][0]))):
+            for chunk in groups[emitted][1]:
+                yield _shifted(chunk, buffer_offset)
+            emitted += 1
+        if not exhausted:
+            restart = groups[emitted][0] if emitted < len(groups) else len(buffer)
+            buffer = buffer[restart:]
+            buffer_offset += restart
+
+
+def chunk_file_stream(file_path: str, chunk_options: Dict[str, Any],
+                      block_size: int = STREAM_BLOCK_SIZE) -> Iterator[Dict[str, Any]]:
+    """Stream the chunks of a text file of any size, see stream_chunks()."""
+    return stream_chunks(iter_text_blocks(file_path, block_size), chunk_options, block_size)
+
+
+def add_token_counts(chunks: List[Dict[str, Any]], tokenizer: Optional[str] = None) -> List[Dict[str, Any]]:
+    """Add each chunk's token count to its metadata, as get_media_chunks() returns chunks."""
+    for chunk, tokens in zip(chunks, count_tokens_batch([chunk['text'] for chunk in chunks], tokenizer)):
+        chunk['metadata']['token_count'] = tokens
+    return chunks
+
+
+def chunk_file(file_path: str, chunk_options: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """All chunks of a text file, with token counts; the file is streamed, not read into one string."""
+    return add_token_counts(list(chunk_file_stream(file_path, chunk_options)), chunk_options.get('tokenizer'))
+#######################################################################################################################
+#
+# Transcript chunking
+#
+# Chunks Whisper / diarized segment lists ({'Time_Start', 'Time_End', 'Text', 'Speaker'}, or the lower-case
+# 'start'/'end'/'text'/'speaker' keys) into time-aligned chunks carrying their start and end times, so a summary of a
+# chunk can be mapped back to its place in the recording. One pass over the segments: a chunk is closed before a
+# segment that would take it over the duration or token budget, or earlier, once it is TRANSCRIPT_SOFT_FILL full,
+# at a natural break (a speaker change or a sentence end).
+
+# Default duration budget of a transcript chunk, in seconds
+TRANSCRIPT_CHUNK_SECONDS = float(os.getenv('TRANSCRIPT_CHUNK_SECONDS', '300'))
+# Fraction of a budget after which a chunk is closed at the next speaker change or sentence end
+TRANSCRIPT_SOFT_FILL = 0.75
+SENTENCE_FINAL_CHARACTERS = ('.', '!', '?', '…', '"', "'", ')')
+
+
+def _segment_fields(segment: Dict[str, Any]) -> Tuple[float, float, str, Optional[str]]:
+    start = segment.get('Time_Start', segment.get('start', 0.0))
+    end = segment.get('Time_End', segment.get('end', start))
+    return (float(start or 0.0), float(end or 0.0), (segment.get('Text', segment.get('text')) or '').strip(),
+            segment.get('Speaker', segment.get('speaker')))
+
+
+def format_timestamp(seconds: float) -> str:
+    seconds = int(seconds)
+    return f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+
+def _transcript_chunk(fields: List[Tuple[float, float, str, Optional[str]]], first: int, last: int,
+                      token_count: int) -> Dict[str, Any]:
+    """Segments [first, last) as one chunk; diarized turns become 'Speaker: text' lines."""
+    lines = []
+    speakers = []
+    previous_speaker = object()
+    for start, end, text, speaker in fields[first:last]:
+        if not text:
+            continue
+        if speaker is not None and speaker not in speakers:
+            speakers.append(speaker)
+        if speaker != previous_speaker or not lines:
+            lines.append(f"{speaker}: {text}" if speaker is not None else text)
+        else:
+            lines[-1] += ' ' + text
+        previous_speaker = speaker
+    text = ('\n' if speakers else ' ').join(lines)
+    return {'text': text, 'metadata': {
+        'start': fields[first][0],
+        'end': fields[last - 1][1],
+        'speakers': speakers,
+        'first_segment': first,
+        'last_segment': last - 1,
+        'token_count': token_count,
+        'word_count': len(text.split()),
+        'char_count': len(text),
+        'chunk_type': 'transcript',
+    }}
+
+
+def chunk_transcript_segments(segments: List[Dict[str, Any]], max_duration: Optional[float] = TRANSCRIPT_CHUNK_SECONDS,
+                              max_tokens: Optional[int] = None, tokenizer: Optional[str] = None,
+                              respect_speakers: bool = True) -> List[Dict[str, Any]]:
+    """
+    Time-aligned chunks of a transcript, each with 'start'/'end' (seconds) and 'speakers' in its metadata.
+
+    A chunk is never split inside a segment, so a single segment longer than a budget becomes a chunk of its own.
+    """
+    fields = [_segment_fields(segment) for segment in segments]
+    if not any(field[2] for field in fields):
+        return []
+    # Counted even without a token budget: every chunk reports its token_count
+    token_counts = count_tokens_batch([field[2] for field in fields], tokenizer)
+
+    chunks = []
+    first = 0
+    tokens = 0
+    for i, (start, end, text, speaker) in enumerate(fields):
+        if i > first:
+            previous = fields[i - 1]
+            # Over budget with segment i added; filled (worth ending at a natural break) without it, in both units
+            over_budget = (max_duration and end - fields[first][0] > max_duration) or \
+                          (max_tokens and tokens + token_counts[i] > max_tokens)
+            filled = (max_duration and previous[1] - fields[first][0] >= TRANSCRIPT_SOFT_FILL * max_duration) or \
+                     (max_tokens and tokens >= TRANSCRIPT_SOFT_FILL * max_tokens)
+            natural_break = (respect_speakers and speaker != previous[3]) or \
+                            previous[2].endswith(SENTENCE_FINAL_CHARACTERS)
+            if over_budget or (filled and natural_break):
+                chunks.append(_transcript_chunk(fields, first, i, tokens))
+                first = i
+                tokens = 0
+        tokens += token_counts[i]
+    chunks.append(_transcript_chunk(fields, first, len(fields), tokens))
+    return chunks
+
+
+def chunk_transcript(segments: List[Dict[str, Any]], chunk_options: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    chunk_transcript_segments() driven by chunk options: 'max_duration' and 'max_tokens'. 'max_size' is the
+    duration for method 'transcript' and the token budget for method 'tokens'.
+    """
+    method = chunk_options.get('method')
+    max_duration = chunk_options.get('max_duration')
+    if max_duration is None:
+        max_duration = chunk_options.get('max_size') if method == 'transcript' else TRANSCRIPT_CHUNK_SECONDS
+    max_tokens = chunk_options.get('max_tokens')
+    if max_tokens is None and method == 'tokens':
+        max_tokens = chunk_options.get('max_size')
+    return chunk_transcript_segments(segments, float(max_duration) if max_duration else None,
+                                     int(max_tokens) if max_tokens else None, chunk_options.get('tokenizer'),
+                                     chunk_options.get('respect_speakers', True))
+
+
+#######################################################################################################################
+#
+# Parallel chunking
+#
+# Bulk ingests chunk many documents; sentence splitting, token counting and TF-IDF are CPU bound, so documents are
+# spread over a process pool. Each worker loads its tokenizer once (get_tokenizer caches per process, and the pool
+# initializer warms it, along with the sentence segmenter) and then chunks documents until the pool is shut down.
+# Token counts are computed on the pool too and returned in each chunk's metadata, as get_media_chunks() does.
+
+# Worker processes used by default for bulk chunking
+CHUNK_WORKERS = int(os.getenv('CHUNK_WORKERS', '0')) or os.cpu_count() or 1
+
+
+def _init_chunk_worker(tokenizer: Optional[str], language: str):
+    get_tokenizer(tokenizer)
+    prepare_sentence_segmenter(language)
+
+
+def _chunk_document(task: Tuple[int, str, bool, Dict[str, Any], bool]) -> Tuple[int, Any]:
+    index, document, is_path, chunk_options, return_exceptions = task
+    try:
+        if is_path:
+            # Read (and chunk) in the worker: only the path crosses the process boundary
+            return index, chunk_file(document, chunk_options)
+        return index, add_token_counts(improved_chunking_process(document, chunk_options),
+                                       chunk_options.get('tokenizer'))
+    except Exception as e:
+        if not return_exceptions:
+            raise
+        return index, e
+
+
+def _chunk_in_parallel(documents: Iterable[str], is_path: bool, chunk_options: Dict[str, Any],
+                       max_workers: Optional[int], ordered: bool, executor: Optional[ProcessPoolExecutor],
+                       return_exceptions: bool) -> Iterator[Tuple[int, Any]]:
+    tasks = ((index, document, is_path, chunk_options, return_exceptions)
+             for index, document in enumerate(documents))
+    max_workers = max_workers or CHUNK_WORKERS
+    if executor is None and max_workers <= 1:
+        yield from map(_chunk_document, tasks)
+        return
+
+    own_executor = executor is None
+    if own_executor:
+        executor = ProcessPoolExecutor(max_workers=max_workers, initializer=_init_chunk_worker,
+                                       initargs=(chunk_options.get('tokenizer'), chunk_options.get('language', 'english')))
+    # At most two documents per worker are in flight, so a long (or lazy) input is never loaded all at once
+    max_pending = 2 * max_workers
+    pending = deque()
+
+    def next_results():
+        if ordered:
+            return [pending.popleft().result()]
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            pending.remove(future)
+        return [future.result() for future in done]
+
+    try:
+        for task in tasks:
+            pending.append(executor.submit(_chunk_document, task))
+            while len(pending) >= max_pending:
+                yield from next_results()
+        while pending:
+            yield from next_results()
+    finally:
+        if own_executor:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+
+def chunk_documents_parallel(texts: Iterable[str], chunk_options: Dict[str, Any], max_workers: Optional[int] = None,
+                             ordered: bool = True, executor: Optional[ProcessPoolExecutor] = None,
+                             return_exceptions: bool = False) -> Iterator[Tuple[int, Any]]:
+    """
+    Chunk many texts on a process pool, yielding (index of the text, its chunks) as results arrive.
+
+    With ordered=False results are yielded as soon as each text is done, otherwise in input order. Pass an executor
+    to reuse one pool across calls; by default a pool of CHUNK_WORKERS (env, default: all cores) is started. With
+    return_exceptions=True a text that fails to chunk yields (index, the exception) instead of ending the iteration.
+    """
+    return _chunk_in_parallel(texts, False, chunk_options, max_workers, ordered, executor, return_exceptions)
+
+
+def chunk_files_parallel(file_paths: Iterable[str], chunk_options: Dict[str, Any], max_workers: Optional[int] = None,
+                         ordered: bool = True, executor: Optional[ProcessPoolExecutor] = None,
+                         return_exceptions: bool = False) -> Iterator[Tuple[int, Any]]:
+    """chunk_documents_parallel() for text files, which the workers read (streamed) themselves."""
+    return _chunk_in_parallel(file_paths, True, chunk_options, max_workers, ordered, executor, return_exceptions)
+#######################################################################################################################
 
 
 
@@ -348,12 +1005,18 @@ def get_chat_completion(messages, model='gpt-4-turbo'):
 
 # This function combines text chunks into larger blocks without exceeding a specified token count.
 #   It returns the combined chunks, their original indices, and the number of dropped chunks due to overflow.
+#   Every chunk is tokenized once and the candidate's size is kept as a running total (chunk tokens plus one
+#   delimiter per join), so the whole pass is linear in the input size. The joined text is not re-tokenized: BPE can
+#   tokenize across a join differently than the parts on their own, so a combined chunk can exceed max_tokens by a
+#   few tokens.
 def combine_chunks_with_no_minimum(
         chunks: List[str],
         max_tokens: int,
         chunk_delimiter="\n\n",
         header: Optional[str] = None,
         add_ellipsis_for_overflow=False,
+        model: str = DEFAULT_TOKENIZER_MODEL,
+        chunk_token_counts: Optional[List[int]] = None,
 ) -> Tuple[List[str], List[int]]:
     dropped_chunk_count = 0
     output = []  # list to hold the final combined chunks
@@ -362,31 +1025,42 @@ def combine_chunks_with_no_minimum(
         [] if header is None else [header]
     )  # list to hold the current combined chunk candidate
     candidate_indices = []
-    for chunk_i, chunk in enumerate(chunks):
+
+    if chunk_token_counts is None:
+        chunk_token_counts = count_tokens_batch(chunks, model)
+    delimiter_tokens = count_tokens(chunk_delimiter, model)
+    header_tokens = 0 if header is None else count_tokens(header, model)
+    ellipsis_tokens = count_tokens("...", model)
+
+    def joined_tokens(parts_tokens: int, num_parts: int) -> int:
+        return parts_tokens + max(0, num_parts - 1) * delimiter_tokens
+
+    candidate_tokens = header_tokens  # tokens of the parts in candidate, without delimiters
+    for chunk_i, (chunk, chunk_tokens) in enumerate(zip(chunks, chunk_token_counts)):
         chunk_with_header = [chunk] if header is None else [header, chunk]
-        # FIXME MAKE NOT OPENAI SPECIFIC
-        if len(openai_tokenize(chunk_delimiter.join(chunk_with_header))) > max_tokens:
+        if joined_tokens(header_tokens + chunk_tokens, len(chunk_with_header)) > max_tokens:
             print(f"warning: chunk overflow")
             if (
                     add_ellipsis_for_overflow
-                    # FIXME MAKE NOT OPENAI SPECIFIC
-                    and len(openai_tokenize(chunk_delimiter.join(candidate + ["..."]))) <= max_tokens
+                    and joined_tokens(candidate_tokens + ellipsis_tokens, len(candidate) + 1) <= max_tokens
             ):
                 candidate.append("...")
+                candidate_tokens += ellipsis_tokens
                 dropped_chunk_count += 1
             continue  # this case would break downstream assumptions
-        # estimate token count with the current chunk added
-        # FIXME MAKE NOT OPENAI SPECIFIC
-        extended_candidate_token_count = len(openai_tokenize(chunk_delimiter.join(candidate + [chunk])))
+        # token count with the current chunk added
+        extended_candidate_token_count = joined_tokens(candidate_tokens + chunk_tokens, len(candidate) + 1)
         # If the token count exceeds max_tokens, add the current candidate to output and start a new candidate
         if extended_candidate_token_count > max_tokens:
             output.append(chunk_delimiter.join(candidate))
             output_indices.append(candidate_indices)
             candidate = chunk_with_header  # re-initialize candidate
+            candidate_tokens = header_tokens + chunk_tokens
             candidate_indices = [chunk_i]
         # otherwise keep extending the candidate
         else:
             candidate.append(chunk)
+            candidate_tokens += chunk_tokens
             candidate_indices.append(chunk_i)
     # add the remaining candidate to output if it's not empty
     if (header is not None and len(candidate) > 1) or (header is None and len(candidate) > 0):
@@ -430,20 +1104,22 @@ def rolling_summarize(text: str,
     # check detail is set correctly
     assert 0 <= detail <= 1
 
+    # tokenize every piece once; both chunking passes and the document length reuse these counts
+    pieces = text.split(chunk_delimiter)
+    piece_token_counts = count_tokens_batch(pieces, model)
+
     # interpolate the number of chunks based to get specified level of detail
-    max_chunks = len(chunk_on_delimiter(text, minimum_chunk_size, chunk_delimiter))
+    max_chunks = len(chunk_on_delimiter(text, minimum_chunk_size, chunk_delimiter, model, piece_token_counts))
     min_chunks = 1
     num_chunks = int(min_chunks + detail * (max_chunks - min_chunks))
 
     # adjust chunk_size based on interpolated number of chunks
-    # FIXME MAKE NOT OPENAI SPECIFIC
-    document_length = len(openai_tokenize(text))
+    document_length = sum(piece_token_counts) + (len(pieces) - 1) * count_tokens(chunk_delimiter, model)
     chunk_size = max(minimum_chunk_size, document_length // num_chunks)
-    text_chunks = chunk_on_delimiter(text, chunk_size, chunk_delimiter)
+    text_chunks = chunk_on_delimiter(text, chunk_size, chunk_delimiter, model, piece_token_counts)
     if verbose:
         print(f"Splitting the text into {len(text_chunks)} chunks to be summarized.")
-        # FIXME MAKE NOT OPENAI SPECIFIC
-        print(f"Chunk lengths are {[len(openai_tokenize(x)) for x in text_chunks]}")
+        print(f"Chunk lengths are {count_tokens_batch(text_chunks, model)}")
 
     # set system message - FIXME
     system_message_content = "Rewrite this text in summarized form."
@@ -477,7 +1153,7 @@ def rolling_summarize(text: str,
 # Ebook Chapter Chunking
 
 
-def chunk_ebook_by_chapters(text: str, chunk_options: Dict[str, Any]) -> List[Dict[str, Any]]:
+def chunk_ebook_spans_by_chapters(text: str, chunk_options: Dict[str, Any]) -> List[Chunk]:
     max_chunk_size = chunk_options.get('max_size', 300)
     overlap = chunk_options.get('overlap', 0)
     custom_pattern = chunk_options.get('custom_chapter_pattern', None)
@@ -505,29 +1181,28 @@ def chunk_ebook_by_chapters(text: str, chunk_options: Dict[str, Any]) -> List[Di
 
     # If no chapters found, return the entire content as one chunk
     if not chapter_positions:
-        return [{'text': text, 'metadata': get_chunk_metadata(text, text, chunk_type="whole_document")}]
+        return [Chunk(text, 0, len(text), chunk_type="whole_document")]
 
-    # Split content into chapters
-    chunks = []
+    # Split content into chapter spans
+    spans = []
     for i in range(len(chapter_positions)):
         start = chapter_positions[i]
-        end = chapter_positions[i + 1] if i + 1 < len(chapter_positions) else None
-        chapter = text[start:end]
+        end = chapter_positions[i + 1] if i + 1 < len(chapter_positions) else len(text)
 
         # Apply overlap if specified
         if overlap > 0 and i > 0:
-            overlap_start = max(0, start - overlap)
-            chapter = text[overlap_start:end]
+            start = max(0, start - overlap)
 
-        chunks.append(chapter)
+        span = trim_span(text, start, end)
+        if span[1] > span[0]:
+            spans.append(span)
 
-    # Post-process chunks
-    processed_chunks = post_process_chunks(chunks)
+    return [Chunk(text, start, end, chunk_type="chapter", chapter_number=i + 1, chapter_pattern=used_pattern)
+            for i, (start, end) in enumerate(spans)]
 
-    # Add metadata to chunks
-    return [{'text': chunk, 'metadata': get_chunk_metadata(chunk, text, chunk_type="chapter", chapter_number=i + 1,
-                                                           chapter_pattern=used_pattern)}
-            for i, chunk in enumerate(processed_chunks)]
+
+def chunk_ebook_by_chapters(text: str, chunk_options: Dict[str, Any]) -> List[Dict[str, Any]]:
+    return [chunk.to_dict() for chunk in chunk_ebook_spans_by_chapters(text, chunk_options)]
 
 
 # # Example usage
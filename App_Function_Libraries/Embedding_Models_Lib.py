@@ -0,0 +1,379 @@
+# Embedding_Models_Lib.py
+#########################################
+# Embedding Models Library
+# This library holds the process-wide registry of embedding models, so every RAG system, Gradio handler and
+#   chunker shares one loaded copy of each model instead of paying load time and memory per instance.
+#
+####
+####################
+# Function List
+#
+# 1. configure_cpu_threads(num_threads)
+# 2. load_embedding_model(model_name, backend=None, onnx_file=None, num_threads=None)
+# 3. get_embedding_model(model_name=None, backend=None, onnx_file=None)
+# 4. register_embedding_model(model_name, model, backend=None, onnx_file=None)
+# 5. warm_up_embedding_models(model_names=None)
+# 6. start_embedding_warm_up()
+# 7. get_embedding_batcher(model_name=None)
+# 8. get_embedding_encoder(model_name=None)
+#
+####################
+#
+# Settings (environment / .env, like DEFAULT_MODEL_NAME):
+#   DEFAULT_MODEL_NAME         - SentenceTransformer model used when none is given (all-MiniLM-L6-v2)
+#   EMBEDDING_BACKEND          - 'torch' (default) or 'onnx' for ONNX Runtime CPU inference
+#   EMBEDDING_ONNX_FILE        - ONNX file inside the model repo, e.g. 'onnx/model_qint8_avx512.onnx' for a
+#                                quantized model; defaults to the repo's 'onnx/model.onnx'
+#   EMBEDDING_NUM_THREADS      - intra-op threads for torch / ONNX Runtime (default: library default)
+#   EMBEDDING_WARMUP_MODELS    - comma separated models to load and warm up when the server starts
+#   EMBEDDING_BATCHING         - 'true' (default) to route RAG encoding through the shared dynamic batcher
+#   EMBEDDING_BATCH_SIZE       - most texts the batcher encodes in one call (default 64)
+#   EMBEDDING_BATCH_WAIT_MS    - how long the batcher waits for more requests to fill a batch (default 2)
+#
+# Import necessary libraries
+import itertools
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+#
+#######################################################################################################################
+# Function Definitions
+#
+
+DEFAULT_EMBEDDING_MODEL = 'all-MiniLM-L6-v2'
+
+
+def default_model_name() -> str:
+    return os.getenv('DEFAULT_MODEL_NAME', DEFAULT_EMBEDDING_MODEL)
+
+
+def configured_num_threads() -> Optional[int]:
+    num_threads = os.getenv('EMBEDDING_NUM_THREADS')
+    return int(num_threads) if num_threads else None
+
+
+def configure_cpu_threads(num_threads: Optional[int]):
+    """Set the torch intra-op thread count; ONNX sessions get theirs via session options at load time."""
+    if not num_threads:
+        return
+    try:
+        import torch
+        torch.set_num_threads(num_threads)
+        logging.info(f"Set torch intra-op threads to {num_threads}")
+    except ImportError:
+        pass
+
+
+def _onnx_model_kwargs(onnx_file: Optional[str], num_threads: Optional[int]) -> Dict:
+    model_kwargs = {'provider': 'CPUExecutionProvider'}
+    if onnx_file:
+        model_kwargs['file_name'] = onnx_file
+    if num_threads:
+        import onnxruntime
+        session_options = onnxruntime.SessionOptions()
+        session_options.intra_op_num_threads = num_threads
+        model_kwargs['session_options'] = session_options
+    return model_kwargs
+
+
+def load_embedding_model(model_name: str, backend: Optional[str] = None, onnx_file: Optional[str] = None,
+                         num_threads: Optional[int] = None):
+    """
+    Load a SentenceTransformer model, optionally on the ONNX Runtime CPU backend.
+
+    The ONNX backend needs sentence-transformers >= 3.2 with optimum/onnxruntime installed; if it is not
+    available the torch backend is used instead and a warning is logged.
+    """
+    from sentence_transformers import SentenceTransformer
+
+    backend = (backend or os.getenv('EMBEDDING_BACKEND', 'torch')).lower()
+    num_threads = num_threads or configured_num_threads()
+    configure_cpu_threads(num_threads)
+
+    if backend == 'onnx':
+        try:
+            model = SentenceTransformer(model_name, backend='onnx',
+                                        model_kwargs=_onnx_model_kwargs(onnx_file, num_threads))
+            logging.info(f"Loaded embedding model {model_name} on the ONNX backend ({onnx_file or 'default file'})")
+            return model
+        except (ImportError, TypeError, ValueError, OSError) as e:
+            logging.warning(f"ONNX backend unavailable for {model_name} ({e}), falling back to torch")
+
+    model = SentenceTransformer(model_name)
+    logging.info(f"Loaded embedding model {model_name} on the torch backend")
+    return model
+
+
+class EmbeddingModelRegistry:
+    """
+    Thread-safe, lazily-populated cache of loaded embedding models.
+
+    Models are keyed by (model name, backend, onnx file). Concurrent first requests for the same model wait on a
+    per-model lock, so each model is loaded exactly once, while requests for other models are not blocked.
+    """
+
+    def __init__(self):
+        self.models: Dict[Tuple, object] = {}
+        self.lock = threading.Lock()
+        self.loading_locks: Dict[Tuple, threading.Lock] = {}
+
+    @staticmethod
+    def make_key(model_name: str, backend: Optional[str], onnx_file: Optional[str]) -> Tuple:
+        backend = (backend or os.getenv('EMBEDDING_BACKEND', 'torch')).lower()
+        onnx_file = (onnx_file or os.getenv('EMBEDDING_ONNX_FILE')) if backend == 'onnx' else None
+        return model_name, backend, onnx_file
+
+    def get(self, model_name: str, backend: Optional[str] = None, onnx_file: Optional[str] = None):
+        key = self.make_key(model_name, backend, onnx_file)
+        model = self.models.get(key)
+        if model is not None:
+            return model
+        with self.lock:
+            loading_lock = self.loading_locks.setdefault(key, threading.Lock())
+        with loading_lock:
+            model = self.models.get(key)
+            if model is None:
+                model = load_embedding_model(*key)
+                self.models[key] = model
+        return model
+
+    def register(self, model_name: str, model, backend: Optional[str] = None, onnx_file: Optional[str] = None):
+        with self.lock:
+            self.models[self.make_key(model_name, backend, onnx_file)] = model
+
+    def loaded_models(self) -> List[Tuple]:
+        return list(self.models.keys())
+
+    def clear(self):
+        with self.lock:
+            self.models.clear()
+            self.loading_locks.clear()
+
+
+registry = EmbeddingModelRegistry()
+
+
+def get_embedding_model(model_name: Optional[str] = None, backend: Optional[str] = None,
+                        onnx_file: Optional[str] = None):
+    """Shared embedding model for `model_name` (default: DEFAULT_MODEL_NAME), loaded on first use."""
+    return registry.get(model_name or default_model_name(), backend, onnx_file)
+
+
+def register_embedding_model(model_name: str, model, backend: Optional[str] = None, onnx_file: Optional[str] = None):
+    """Serve an already constructed encoder (anything with .encode(texts)) under `model_name`, e.g. for benchmarks."""
+    registry.register(model_name, model, backend, onnx_file)
+
+
+def warm_up_embedding_models(model_names: Optional[List[str]] = None):
+    """Load each model and run one encode, so the first real request doesn't pay for lazy initialization."""
+    if model_names is None:
+        model_names = [name.strip() for name in os.getenv('EMBEDDING_WARMUP_MODELS', '').split(',') if name.strip()]
+    for model_name in model_names:
+        try:
+            get_embedding_model(model_name).encode(['warm-up'])
+            logging.info(f"Warmed up embedding model {model_name}")
+        except Exception as e:
+            logging.error(f"Failed to warm up embedding model {model_name}: {e}")
+
+
+def start_embedding_warm_up() -> Optional[threading.Thread]:
+    """Warm up the models listed in EMBEDDING_WARMUP_MODELS in the background, at server start."""
+    if not os.getenv('EMBEDDING_WARMUP_MODELS'):
+        return None
+    thread = threading.Thread(target=warm_up_embedding_models, name='embedding-warm-up', daemon=True)
+    thread.start()
+    return thread
+
+
+class EmbeddingBatcher:
+    """
+    Dynamic-batching front end for one shared embedding model.
+
+    Callers (ingestion and interactive queries alike) submit texts and get a Future; a single worker thread
+    coalesces whatever is pending into one encode call of up to max_batch_size texts, waiting at most max_wait_ms
+    for a batch to fill, and fans the rows back out to the futures. Small requests (interactive queries) are
+    served before bulk ones, and bulk requests are split into max_batch_size slices, so a burst of ingestion never
+    holds a query back for more than one batch.
+
+    encode(texts) has the same shape as SentenceTransformer.encode(texts), so a batcher can stand in for the model.
+    """
+
+    def __init__(self, model, max_batch_size: int = 64, max_wait_ms: float = 2.0, interactive_size: int = 8):
+        """
+        :param model: Encoder with .encode(texts) -> (len(texts), dim) array
+        :param max_batch_size: Most texts encoded in one call
+        :param max_wait_ms: Longest wait for more requests once one is pending
+        :param interactive_size: Requests of at most this many texts are served first
+        """
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.interactive_size = interactive_size
+        self.requests = queue.PriorityQueue()
+        self.sequence = itertools.count()
+        self.stats_lock = threading.Lock()
+        self.batches = 0
+        self.texts_encoded = 0
+        self.closed = False
+        self.worker = threading.Thread(target=self.run, name='embedding-batcher', daemon=True)
+        self.worker.start()
+
+    def __getattr__(self, name):
+        # Everything else (get_sentence_embedding_dimension, ...) is the wrapped model's
+        if name == 'model':
+            raise AttributeError(name)
+        return getattr(self.model, name)
+
+    def submit(self, texts: List[str]) -> Future:
+        """Queue texts for encoding; the Future resolves to their (len(texts), dim) embeddings."""
+        if self.closed:
+            raise RuntimeError("Embedding batcher is closed")
+        texts = list(texts)
+        if not texts:
+            # Nothing to queue: no slice would ever resolve a combined future
+            future = Future()
+            future.set_result(np.zeros((0, self.dimension()), dtype=np.float32))
+            return future
+        priority = 0 if len(texts) <= self.interactive_size else 1
+        slices = [texts[start:start + self.max_batch_size] for start in range(0, len(texts), self.max_batch_size)]
+        futures = []
+        for texts_slice in slices:
+            future = Future()
+            self.requests.put((priority, next(self.sequence), texts_slice, future))
+            futures.append(future)
+        if len(futures) == 1:
+            return futures[0]
+        return self._combine(futures)
+
+    def dimension(self) -> int:
+        get_dimension = getattr(self.model, 'get_sentence_embedding_dimension', None)
+        return int(get_dimension() or 0) if get_dimension else 0
+
+    @staticmethod
+    def _combine(futures: List[Future]) -> Future:
+        combined = Future()
+        remaining = [len(futures)]
+        lock = threading.Lock()
+
+        def on_done(done: Future):
+            # Slices finish on the worker thread in any order; only the first failure or the last success resolves
+            with lock:
+                if combined.done():
+                    return
+                if done.exception() is not None:
+                    combined.set_exception(done.exception())
+                    return
+                remaining[0] -= 1
+                if remaining[0] == 0:
+                    combined.set_result(np.vstack([future.result() for future in futures]))
+
+        for future in futures:
+            future.add_done_callback(on_done)
+        return combined
+
+    def encode(self, texts, **kwargs) -> np.ndarray:
+        if kwargs:
+            # Non-default encode options can't be shared with other callers' texts
+            return self.model.encode(texts, **kwargs)
+        if isinstance(texts, str):
+            return self.submit([texts]).result()[0]
+        return self.submit(texts).result()
+
+    def _next_batch(self) -> List[Tuple]:
+        batch = [self.requests.get()]
+        if batch[0][2] is None:
+            return batch
+        count = len(batch[0][2])
+        deadline = time.monotonic() + self.max_wait
+        while count < self.max_batch_size:
+            try:
+                timeout = deadline - time.monotonic()
+                request = self.requests.get_nowait() if timeout <= 0 else self.requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if request[2] is None or count + len(request[2]) > self.max_batch_size:
+                # Keeps its place in line for the next batch
+                self.requests.put(request)
+                break
+            batch.append(request)
+            count += len(request[2])
+        return batch
+
+    def run(self):
+        while True:
+            batch = self._next_batch()
+            if batch[0][2] is None:
+                return
+            texts = [text for _, _, request_texts, _ in batch for text in request_texts]
+            try:
+                embeddings = np.asarray(self.model.encode(texts, batch_size=self.max_batch_size), dtype=np.float32)
+            except Exception as e:
+                logging.error(f"Embedding batch of {len(texts)} texts failed: {e}")
+                for _, _, _, future in batch:
+                    future.set_exception(e)
+                continue
+            offset = 0
+            for _, _, request_texts, future in batch:
+                future.set_result(embeddings[offset:offset + len(request_texts)])
+                offset += len(request_texts)
+            with self.stats_lock:
+                self.batches += 1
+                self.texts_encoded += len(texts)
+
+    def stats(self) -> Dict[str, float]:
+        with self.stats_lock:
+            return {
+                'batches': self.batches,
+                'texts': self.texts_encoded,
+                'mean_batch_size': self.texts_encoded / self.batches if self.batches else 0.0,
+                'pending_requests': self.requests.qsize(),
+            }
+
+    def close(self):
+        """Stop the worker once every request queued so far has been served."""
+        if not self.closed:
+            self.closed = True
+            self.requests.put((2, next(self.sequence), None, None))
+            self.worker.join()
+
+
+batchers: Dict[str, EmbeddingBatcher] = {}
+batchers_lock = threading.Lock()
+
+
+def get_embedding_batcher(model_name: Optional[str] = None) -> EmbeddingBatcher:
+    """The process-wide dynamic batcher in front of the shared model for `model_name`, started on first use."""
+    model_name = model_name or default_model_name()
+    batcher = batchers.get(model_name)
+    if batcher is not None:
+        return batcher
+    # Loaded outside batchers_lock (the model registry has its own locking), so a slow model load does not block
+    # callers asking for the batchers of other models
+    model = get_embedding_model(model_name)
+    with batchers_lock:
+        batcher = batchers.get(model_name)
+        if batcher is None:
+            batcher = batchers[model_name] = EmbeddingBatcher(
+                model,
+                max_batch_size=int(os.getenv('EMBEDDING_BATCH_SIZE', '64')),
+                max_wait_ms=float(os.getenv('EMBEDDING_BATCH_WAIT_MS', '2')),
+            )
+            logging.info(f"Started embedding batcher for {model_name}")
+        return batcher
+
+
+def get_embedding_encoder(model_name: Optional[str] = None):
+    """Encoder for `model_name`: the shared batcher, or the bare shared model if EMBEDDING_BATCHING is off."""
+    if os.getenv('EMBEDDING_BATCHING', 'true').lower() in ('false', '0', 'no'):
+        return get_embedding_model(model_name)
+    return get_embedding_batcher(model_name)
+
+#
+# End of Embedding Models Library
+#######################################################################################################################
@@ -27,6 +27,7 @@ import logging
 import os.path
 from pathlib import Path
 import sqlite3
+import threading
 from typing import Dict, List, Tuple, Optional
 import traceback
 from functools import wraps
@@ -40,7 +41,10 @@ import gradio as gr
 # Local Imports
 from App_Function_Libraries.Article_Summarization_Lib import scrape_and_summarize_multiple
 from App_Function_Libraries.Audio_Files import process_audio_files, process_podcast
-from App_Function_Libraries.Chunk_Lib import improved_chunking_process
+from App_Function_Libraries.Boilerplate_Lib import remove_boilerplate_segments
+from App_Function_Libraries.Chunk_Lib import compress_chunks
+from App_Function_Libraries.Tokenization_Methods_Lib import tokenizer_for_api
+from App_Function_Libraries.Embedding_Models_Lib import start_embedding_warm_up
 from App_Function_Libraries.PDF_Ingestion_Lib import process_and_cleanup_pdf
 from App_Function_Libraries.Local_LLM_Inference_Engine_Lib import local_llm_gui_function
 from App_Function_Libraries.Local_Summarization_Lib import summarize_with_llama, summarize_with_kobold, \
@@ -53,7 +57,8 @@ from App_Function_Libraries.SQLite_DB import update_media_content, list_prompts,
     fetch_prompt_details, keywords_browser_interface, add_keyword, delete_keyword, \
     export_keywords_to_csv, add_media_to_database, insert_prompt_to_db, import_obsidian_note_to_db, add_prompt, \
     delete_chat_message, update_chat_message, add_chat_message, get_chat_messages, search_chat_conversations, \
-    create_chat_conversation, save_chat_history_to_database, view_database
+    create_chat_conversation, save_chat_history_to_database, view_database, register_media_update_listener, \
+    get_media_chunks
 from App_Function_Libraries.Utils import sanitize_filename, extract_text_from_segments, create_download_directory, \
     convert_to_seconds, load_comprehensive_config
 from App_Function_Libraries.Video_DL_Ingestion_Lib import parse_and_expand_urls, \
@@ -368,6 +373,7 @@ def load_media_content(media_id: int) -> dict:
             content, prompt, summary = "", "", ""
 
         return {
+            "id": media_id,
             "content": content or "No content available",
             "prompt": prompt or "No prompt available",
             "summary": summary or "No summary available"
@@ -645,8 +651,8 @@ def create_video_transcription_tab():
                 with gr.Row(visible=False) as chunking_options_box:
                     gr.Markdown("### Chunking Options")
                     with gr.Column():
-                        chunk_method = gr.Dropdown(choices=['words', 'sentences', 'paragraphs', 'tokens'],
-                                                   label="Chunking Method")
+                        chunk_method = gr.Dropdown(choices=['words', 'sentences', 'paragraphs', 'tokens', 'transcript'],
+                                                   label="Chunking Method (transcript: by time, max size in seconds)")
                         max_chunk_size = gr.Slider(minimum=100, maximum=1000, value=300, step=50, label="Max Chunk Size")
                         chunk_overlap = gr.Slider(minimum=0, maximum=100, value=0, step=10, label="Chunk Overlap")
                         use_adaptive_chunking = gr.Checkbox(label="Use Adaptive Chunking (Adjust chunking based on text complexity)")
@@ -754,7 +760,8 @@ def create_video_transcription_tab():
                                     'overlap': chunk_overlap,
                                     'adaptive': use_adaptive_chunking,
                                     'multi_level': use_multi_level_chunking,
-                                    'language': chunk_language
+                                    'language': chunk_language,
+                                    'tokenizer': tokenizer_for_api(api_name)
                                 } if chunking_options_checkbox else None
 
                                 logging.debug("Gradio_Related.py: process_url_with_metadata being called")
@@ -1067,13 +1074,29 @@ def create_video_transcription_tab():
 
                     logging.debug(f"Full text with metadata extracted: {full_text_with_metadata[:100]}...")
 
+                    # Passages repeated from the uploader's earlier episodes (sponsor reads, intros, outros) are
+                    # flagged, and with BOILERPLATE_STRIP left out of the summary; the stored transcript keeps them
+                    summary_segments = remove_boilerplate_segments(segments, info_dict.get('uploader'),
+                                                                   info_dict.get('webpage_url'))
+
                     # Perform summarization if API is provided
                     summary_text = None
                     if api_name:
                         # API key resolution handled at base of function if none provided
                         api_key = api_key if api_key else None
                         logging.info(f"Starting summarization with {api_name}...")
-                        summary_text = perform_summarization(api_name, full_text_with_metadata, custom_prompt, api_key)
+                        if use_chunking and chunk_options and chunk_options.get('method') == 'transcript' \
+                                and include_timestamps:
+                            # Time-aligned chunk summaries, so each can be traced back to its place in the video
+                            summary_input = {'title': info_dict.get('title'), 'author': info_dict.get('uploader'),
+                                             'segments': summary_segments}
+                        elif summary_segments is not segments:
+                            summary_input = f"{json.dumps(info_dict, indent=2)}\n\n" \
+                                            f"{extract_text_from_segments(summary_segments)}"
+                        else:
+                            summary_input = full_text_with_metadata
+                        summary_text = perform_summarization(api_name, summary_input, custom_prompt, api_key,
+                                                             chunk_options=chunk_options if use_chunking else None)
                         if summary_text is None:
                             logging.error("Summarization failed.")
                             return None, None, None, None, None, None
@@ -1562,6 +1585,7 @@ def resummarize_content_wrapper(selected_item, item_mapping, api_name, api_key,
         'language': 'english',
         'adaptive': True,
         'multi_level': False,
+        'tokenizer': tokenizer_for_api(api_name),
     } if chunking_options_checkbox else None
 
     # Prepare summarization prompt
@@ -1597,13 +1621,16 @@ def resummarize_content(selected_item, item_mapping, api_name, api_key, chunking
         'language': 'english',
         'adaptive': True,
         'multi_level': False,
+        'tokenizer': tokenizer_for_api(api_name),
     }
 
-    # Chunking logic
+    # Chunking logic (cached per content and options, so re-summarizing the same item does not re-chunk it)
     if chunking_options_checkbox:
-        chunks = improved_chunking_process(content, chunk_options)
+        chunks = get_media_chunks(content, chunk_options, media_id)
     else:
         chunks = [{'text': content, 'metadata': {}}]
+    # Optional extractive pre-compression (EXTRACTIVE_COMPRESSION_RATIO), after the cache: it depends on the ratio
+    chunks = compress_chunks(chunks, tokenizer=chunk_options['tokenizer'])
 
     # Prepare summarization prompt
     if custom_prompt_checkbox and custom_prompt:
@@ -1939,6 +1966,40 @@ def create_llamafile_advanced_inputs():
 
 
 # FIXME - not adding content from selected item to query
+# Answers to (near-)identical questions about the same media, context and model are served without an LLM call;
+# answers about a media item are dropped when it is re-ingested or edited. Created on first use, as importing
+# RAG_Library configures logging and loads .env, which importing this module must not do
+chat_answer_cache = None
+chat_answer_cache_lock = threading.Lock()
+
+
+def get_chat_answer_cache():
+    global chat_answer_cache
+    with chat_answer_cache_lock:
+        if chat_answer_cache is None:
+            from App_Function_Libraries.RAG_Library import SemanticAnswerCache
+            chat_answer_cache = SemanticAnswerCache()
+            register_media_update_listener(chat_answer_cache.invalidate_media)
+        return chat_answer_cache
+
+
+# The summarize_with_* functions report failures as "<provider>: <error text>" responses, those are never cached
+API_ERROR_RESPONSE_PATTERN = re.compile(
+    r'^([\w.\-]+: )?((An |Network |Unexpected )?error\b|Failed to|File not found|Invalid JSON|API request failed|'
+    r'Expected data not found|Summary not available)', re.IGNORECASE)
+
+
+def get_cached_chat_answer(scope_key, message):
+    """(cached answer or None, question embedding or None); the cache is skipped if the embedding model is unavailable"""
+    try:
+        answer_cache = get_chat_answer_cache()
+        question_embedding = answer_cache.encode(message)
+    except Exception as e:
+        logging.warning(f"Semantic answer cache unavailable: {e}")
+        return None, None
+    return answer_cache.get(scope_key, question_embedding), question_embedding
+
+
 def chat(message, history, media_content, selected_parts, api_endpoint, api_key, prompt):
     try:
         logging.info(f"Debug - Chat Function - Message: {message}")
@@ -1965,6 +2026,15 @@ def chat(message, history, media_content, selected_parts, api_endpoint, api_key,
         # Print first 500 chars
         logging.info(f"Debug - Chat Function - Input Data: {input_data[:500]}...")
 
+        # Same media (or context), parts, endpoint, prompt and conversation so far -> same answer scope
+        from App_Function_Libraries.RAG_Library import make_cache_key
+        scope_key = make_cache_key('chat', media_content.get('id') or combined_content, selected_parts,
+                                   api_endpoint, prompt, history)
+        cached_response, question_embedding = get_cached_chat_answer(scope_key, message)
+        if cached_response is not None:
+            logging.info(f"Chat answer served from the semantic answer cache: {get_chat_answer_cache().stats()}")
+            return cached_response
+
         # Use the existing API request code based on the selected endpoint
         logging.info(f"Debug - Chat Function - API Endpoint: {api_endpoint}")
         if api_endpoint.lower() == 'openai':
@@ -1996,6 +2066,8 @@ def chat(message, history, media_content, selected_parts, api_endpoint, api_key,
         else:
             raise ValueError(f"Unsupported API endpoint: {api_endpoint}")
 
+        if question_embedding is not None and response and not API_ERROR_RESPONSE_PATTERN.match(response[:200]):
+            get_chat_answer_cache().put(scope_key, question_embedding, response, [media_content.get('id')])
         return response
 
     except Exception as e:
@@ -3782,6 +3854,9 @@ def launch_ui(share_public=None, server_mode=False):
                 create_utilities_tab()
 
 
+    # Load/warm up any embedding models listed in EMBEDDING_WARMUP_MODELS while the UI starts
+    start_embedding_warm_up()
+
     # Launch the interface
     server_port_variable = 7860
     if share==True:
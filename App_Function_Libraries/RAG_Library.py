@@ -6,16 +6,35 @@
 #
 ####
 
+import asyncio
+import functools
+import hashlib
+import inspect
 import os
-from typing import List, Tuple, Callable, Optional
-from contextlib import contextmanager
+import re
+import threading
+import time
+import unicodedata
+import zlib
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple, Callable, Optional, Dict
+from contextlib import contextmanager, closing
 import sqlite3
 import numpy as np
-from sentence_transformers import SentenceTransformer
-from sklearn.metrics.pairwise import cosine_similarity
 import logging
 from dotenv import load_dotenv
 
+from App_Function_Libraries.Embedding_Models_Lib import get_embedding_encoder, default_model_name
+from App_Function_Libraries.Tokenization_Methods_Lib import count_tokens, DEFAULT_TOKENIZER_MODEL
+
+try:
+    # Optional: native async SQLite reads for AsyncRAGSystem; without it reads run on the executor
+    import aiosqlite
+except ImportError:
+    aiosqlite = None
+
 load_dotenv()
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -27,24 +46,815 @@ class RAGException(Exception):
     pass
 
 
-class BaseRAGSystem:
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """L2-normalize a vector or each row of a matrix, leaving all-zero rows untouched."""
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def top_k_indices(scores: np.ndarray, top_k: int) -> np.ndarray:
+    """Indices of the top_k highest scores, best first, without sorting the whole array."""
+    if top_k <= 0 or len(scores) == 0:
+        return np.empty(0, dtype=np.int64)
+    if top_k >= len(scores):
+        return np.argsort(-scores)
+    candidates = np.argpartition(-scores, top_k - 1)[:top_k]
+    return candidates[np.argsort(-scores[candidates])]
+
+
+def build_fts_query(query: str) -> str:
+    """
+    Turn free text into a safe FTS5 MATCH expression.
+
+    Every word/number is quoted (so punctuation or FTS operators in the user's question can't break the query)
+    and the terms are OR'ed, leaving the ranking to bm25().
+    """
+    terms = re.findall(r'\w+', query)
+    return ' OR '.join('"' + term.replace('"', '""') + '"' for term in terms)
+
+
+def reciprocal_rank_fusion(ranked_lists: List[List[Tuple[int, float]]], k: int = 60,
+                           weights: Optional[List[float]] = None) -> List[Tuple[int, float]]:
+    """
+    Fuse several ranked result lists with reciprocal rank fusion.
+
+    :param ranked_lists: Lists of (document id, score), each sorted best first. Only the rank is used.
+    :param k: RRF damping constant, 60 is the value from the original paper
+    :param weights: Optional per-list weights, defaults to 1.0 each
+    :return: List of (document id, fused score), best first
+    """
+    weights = weights or [1.0] * len(ranked_lists)
+    fused = {}
+    for ranked, weight in zip(ranked_lists, weights):
+        for rank, (doc_id, _) in enumerate(ranked, start=1):
+            fused[doc_id] = fused.get(doc_id, 0.0) + weight / (k + rank)
+    return sorted(fused.items(), key=lambda x: x[1], reverse=True)
+
+
+def weighted_score_fusion(ranked_lists: List[List[Tuple[int, float]]],
+                          weights: List[float]) -> List[Tuple[int, float]]:
+    """
+    Fuse ranked result lists by a weighted sum of min-max normalized scores.
+
+    :param ranked_lists: Lists of (document id, score), higher is better
+    :param weights: Per-list weights
+    :return: List of (document id, fused score), best first
+    """
+    fused = {}
+    for ranked, weight in zip(ranked_lists, weights):
+        if not ranked:
+            continue
+        scores = [score for _, score in ranked]
+        low, high = min(scores), max(scores)
+        spread = (high - low) or 1.0
+        for doc_id, score in ranked:
+            fused[doc_id] = fused.get(doc_id, 0.0) + weight * (score - low) / spread
+    return sorted(fused.items(), key=lambda x: x[1], reverse=True)
+
+
+def embedding_rows_to_matrix(rows: List[Tuple[int, bytes]]) -> Tuple[np.ndarray, np.ndarray]:
+    """Turn (id, float32 embedding blob) rows into (ids, L2-normalized matrix)."""
+    if not rows:
+        return np.empty(0, dtype=np.int64), np.empty((0, 0), dtype=np.float32)
+    ids = np.array([id for id, _ in rows], dtype=np.int64)
+    matrix = np.vstack([np.frombuffer(embedding, dtype=np.float32) for _, embedding in rows])
+    return ids, normalize_rows(matrix)
+
+
+def embedding_dimension(encoder) -> int:
+    """Output dimension of an embedding model (or batcher), probing with one encode if it cannot tell."""
+    get_dimension = getattr(encoder, 'get_sentence_embedding_dimension', None)
+    dimension = get_dimension() if callable(get_dimension) else None
+    return int(dimension or len(encoder.encode(['dimension probe'])[0]))
+
+
+def format_context_document(title: str, content: str) -> str:
+    return f"Title: {title}\nContent: {content}"
+
+
+def build_rag_prompt(query: str, relevant_docs: List[Tuple[int, str, str, float]]) -> str:
+    """Build the LLM prompt for a query from its retrieved (id, title, content, score) documents."""
+    context = "\n\n".join([format_context_document(title, content) for _, title, content, _ in relevant_docs])
+    return f"Based on the following context, please answer the query:\n\nContext:\n{context}\n\nQuery: {query}"
+
+
+#######################################################################################################################
+#
+# Query caches
+#
+
+def normalize_query(query: str) -> str:
+    """Normalize a query for cache lookups: unicode/case/whitespace folded, trailing punctuation dropped."""
+    query = unicodedata.normalize('NFKC', query).lower()
+    query = re.sub(r'\s+', ' ', query).strip()
+    return query.rstrip('?!.,;: ')
+
+
+def make_cache_key(*parts) -> str:
+    """Stable hash of the parts that identify a cached value."""
+    return hashlib.sha256('\x1f'.join(str(part) for part in parts).encode('utf-8')).hexdigest()
+
+
+def llm_function_id(llm_function: Callable) -> str:
+    """
+    Best-effort identity of an LLM callable for cache keys.
+
+    An explicit `model_id` attribute wins; functools.partial objects are identified by the wrapped
+    function plus their bound arguments (so e.g. different api_name values don't share entries). Lambdas and
+    nested functions share a qualified name with every other lambda / closure made at the same place, so functions
+    are also identified by their code and the values they capture (closure cells and defaults). Bound methods and
+    other callable objects are identified by the instance (id()), so their entries only match within this process;
+    give them a `model_id` for entries that survive restarts.
+    """
+    model_id = getattr(llm_function, 'model_id', None)
+    if model_id:
+        return str(model_id)
+    if isinstance(llm_function, functools.partial):
+        return f"{llm_function_id(llm_function.func)}({llm_function.args!r}, {llm_function.keywords!r})"
+    module = getattr(llm_function, '__module__', '') or ''
+    name = getattr(llm_function, '__qualname__', None) or type(llm_function).__qualname__
+    if inspect.isfunction(llm_function):
+        if not llm_function.__closure__ and '<' not in name and not llm_function.__defaults__:
+            return f"{module}.{name}"
+        code = llm_function.__code__
+        captured = [cell.cell_contents for cell in llm_function.__closure__ or ()
+                    if cell.cell_contents is not llm_function]
+        return f"{module}.{name}#" + make_cache_key(code.co_filename, code.co_firstlineno, code.co_code,
+                                                    code.co_consts, captured, llm_function.__defaults__,
+                                                    llm_function.__kwdefaults__)[:16]
+    # A bound method is a new object on every attribute access; the instance it is bound to is what identifies it
+    owner = getattr(llm_function, '__self__', llm_function)
+    return f"{module}.{name}@{id(owner):x}"
+
+
+class QueryCache:
+    """
+    Thread-safe LRU + TTL cache, optionally persisted to a SQLite file.
+
+    Persisted entries survive restarts; `serialize`/`deserialize` convert values to and from bytes for storage.
+    """
+
+    def __init__(self, max_size: int = 1024, ttl_seconds: Optional[float] = 3600, persist_path: Optional[str] = None,
+                 namespace: str = 'default', serialize: Optional[Callable] = None,
+                 deserialize: Optional[Callable] = None):
+        """
+        :param max_size: Maximum number of entries kept in memory
+        :param ttl_seconds: Entry lifetime, None for no expiry
+        :param persist_path: Optional SQLite file to persist entries in
+        :param namespace: Separates different caches sharing one persistence file
+        :param serialize: Value -> bytes, required with persist_path
+        :param deserialize: bytes -> value, required with persist_path
+        """
+        if persist_path and (serialize is None or deserialize is None):
+            raise RAGException("Persisted caches need serialize and deserialize functions")
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.persist_path = persist_path
+        self.namespace = namespace
+        self.serialize = serialize
+        self.deserialize = deserialize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if self.persist_path:
+            with closing(sqlite3.connect(self.persist_path)) as conn, conn:
+                conn.execute('''
+                CREATE TABLE IF NOT EXISTS query_cache (
+                    namespace TEXT NOT NULL,
+                    cache_key TEXT NOT NULL,
+                    value BLOB,
+                    created_at REAL NOT NULL,
+                    PRIMARY KEY (namespace, cache_key)
+                )
+                ''')
+
+    def _expired(self, created_at: float) -> bool:
+        return self.ttl_seconds is not None and time.time() - created_at > self.ttl_seconds
+
+    def _load_persisted(self, key: str):
+        with closing(sqlite3.connect(self.persist_path)) as conn, conn:
+            row = conn.execute('SELECT value, created_at FROM query_cache WHERE namespace = ? AND cache_key = ?',
+                               (self.namespace, key)).fetchone()
+        if row is None or self._expired(row[1]):
+            return None
+        return self.deserialize(row[0]), row[1]
+
+    def get(self, key: str):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and self._expired(entry[1]):
+                del self.entries[key]
+                entry = None
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+        if self.persist_path:
+            persisted = self._load_persisted(key)
+            if persisted is not None:
+                with self.lock:
+                    self._store(key, persisted)
+                    self.hits += 1
+                return persisted[0]
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def _store(self, key: str, entry: Tuple):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def put(self, key: str, value):
+        created_at = time.time()
+        with self.lock:
+            self._store(key, (value, created_at))
+        if self.persist_path:
+            with closing(sqlite3.connect(self.persist_path)) as conn, conn:
+                conn.execute('INSERT OR REPLACE INTO query_cache (namespace, cache_key, value, created_at) '
+                             'VALUES (?, ?, ?, ?)', (self.namespace, key, self.serialize(value), created_at))
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+        if self.persist_path:
+            with closing(sqlite3.connect(self.persist_path)) as conn, conn:
+                conn.execute('DELETE FROM query_cache WHERE namespace = ?', (self.namespace,))
+
+    def stats(self) -> Dict[str, float]:
+        with self.lock:
+            total = self.hits + self.misses
+            return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': self.hits / total if total else 0.0}
+
+
+def _cache_settings() -> Tuple[int, Optional[float], Optional[str]]:
+    """Query cache size, TTL and persistence file from the environment."""
+    ttl = os.getenv('RAG_QUERY_CACHE_TTL', '3600')
+    return (int(os.getenv('RAG_QUERY_CACHE_SIZE', '1024')),
+            float(ttl) if ttl.lower() != 'none' else None,
+            os.getenv('RAG_QUERY_CACHE_PATH') or None)
+
+
+def create_embedding_cache(namespace: str = 'query_embeddings') -> QueryCache:
+    max_size, ttl, persist_path = _cache_settings()
+    return QueryCache(max_size, ttl, persist_path, namespace,
+                      serialize=lambda value: np.asarray(value, dtype=np.float32).tobytes(),
+                      deserialize=lambda blob: np.frombuffer(blob, dtype=np.float32))
+
+
+def create_text_cache(namespace: str) -> QueryCache:
+    max_size, ttl, persist_path = _cache_settings()
+    return QueryCache(max_size, ttl, persist_path, namespace,
+                      serialize=lambda value: value.encode('utf-8'),
+                      deserialize=lambda blob: blob.decode('utf-8'))
+
+#
+# End of Query caches
+#######################################################################################################################
+#
+# Embedding quantization
+#
+
+# Number of set bits for every byte value, used for Hamming distances over packed sign bits
+POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def quantize_int8(matrix: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Symmetric per-vector int8 scalar quantization.
+
+    :param matrix: (n, dim) or (dim,) float embeddings
+    :return: (codes, scales) with codes int8 in [-127, 127] and codes * scale ~= the L2-normalized vector
+    """
+    matrix = normalize_rows(np.atleast_2d(np.asarray(matrix, dtype=np.float32)))
+    scales = np.abs(matrix).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    codes = np.clip(np.rint(matrix / scales[:, np.newaxis]), -127, 127).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+def quantize_binary(matrix: np.ndarray) -> np.ndarray:
+    """Sign-bit quantization, 1 bit per dimension packed into uint8 (32x smaller than float32)."""
+    return np.packbits(np.atleast_2d(np.asarray(matrix)) > 0, axis=1)
+
+
+def hamming_distances(codes: np.ndarray, query_code: np.ndarray) -> np.ndarray:
+    """Hamming distance between every row of packed binary `codes` and one packed `query_code`."""
+    return POPCOUNT_TABLE[np.bitwise_xor(codes, query_code)].sum(axis=1, dtype=np.int32)
+
+
+# Columns derived from documents.embedding by QuantizedRAGSystem; stale once the embedding is replaced
+QUANTIZED_COLUMNS = ('embedding_int8', 'embedding_scale', 'embedding_binary')
+
+#
+# End of Embedding quantization
+#######################################################################################################################
+#
+# Metadata filters
+#
+
+# Keys accepted in a metadata filter, e.g. {'keywords': ['physics'], 'media_type': 'podcast', 'last_days': 30}
+METADATA_FILTER_KEYS = ('media_id', 'media_type', 'collection', 'keywords', 'since', 'until', 'last_days')
+
+
+def normalize_keywords(keywords) -> List[str]:
+    """Keywords as a list of stripped, lower-cased strings; accepts a comma separated string like SQLite_DB."""
+    if not keywords:
+        return []
+    if isinstance(keywords, str):
+        keywords = keywords.split(',')
+    return [keyword.strip().lower() for keyword in keywords if keyword and keyword.strip()]
+
+
+def _as_list(value) -> list:
+    return list(value) if isinstance(value, (list, tuple, set)) else [value]
+
+
+def build_metadata_filter(filters: Optional[Dict], alias: str = 'documents') -> Tuple[str, list]:
+    """
+    Translate a metadata filter into a SQL condition over the documents table.
+
+    All given keys must match; list values match any of their items. Dates compare as '%Y-%m-%d' strings,
+    the format SQLite_DB uses for ingestion_date.
+
+    :param filters: Dict with any of METADATA_FILTER_KEYS:
+        media_id (id or list of ids), media_type (str or list), collection (str or list),
+        keywords (str or list, any match),
+        since / until (inclusive dates), last_days (ingested within the last N days)
+    :param alias: Name or alias of the documents table in the surrounding query
+    :return: (condition, params); the condition is '1' when there is nothing to filter
+    """
+    if not filters:
+        return '1', []
+    unknown = set(filters) - set(METADATA_FILTER_KEYS)
+    if unknown:
+        raise RAGException(f"Unknown metadata filter keys: {sorted(unknown)}")
+
+    conditions, params = [], []
+    if filters.get('media_id') is not None:
+        media_ids = [int(media_id) for media_id in _as_list(filters['media_id'])]
+        conditions.append(f"{alias}.media_id IN ({','.join('?' * len(media_ids))})")
+        params.extend(media_ids)
+    if filters.get('media_type'):
+        media_types = _as_list(filters['media_type'])
+        conditions.append(f"{alias}.media_type IN ({','.join('?' * len(media_types))})")
+        params.extend(media_types)
+    if filters.get('collection') is not None:
+        collections = [str(collection) for collection in _as_list(filters['collection'])]
+        conditions.append(f"{alias}.collection IN ({','.join('?' * len(collections))})")
+        params.extend(collections)
+    keywords = normalize_keywords(filters.get('keywords'))
+    if keywords:
+        conditions.append(f"{alias}.id IN (SELECT document_id FROM document_keywords "
+                          f"WHERE keyword IN ({','.join('?' * len(keywords))}))")
+        params.extend(keywords)
+    since = filters.get('since')
+    if filters.get('last_days') is not None:
+        cutoff = (datetime.now() - timedelta(days=int(filters['last_days']))).strftime('%Y-%m-%d')
+        since = max(since, cutoff) if since else cutoff
+    if since:
+        conditions.append(f"{alias}.ingestion_date >= ?")
+        params.append(str(since))
+    if filters.get('until'):
+        # Inclusive of the whole 'until' day, also for values stored with a time part
+        conditions.append(f"substr({alias}.ingestion_date, 1, 10) <= ?")
+        params.append(str(filters['until']))
+    return (' AND '.join(conditions) or '1'), params
+
+#
+# End of Metadata filters
+#######################################################################################################################
+#
+# Context packing
+#
+
+def word_shingles(text: str, size: int = 3) -> set:
+    words = re.findall(r'\w+', text.lower())
+    if len(words) <= size:
+        return {tuple(words)} if words else set()
+    return {tuple(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+def shingle_containment(shingles: set, kept: set) -> float:
+    """Fraction of `shingles` already present in `kept`; catches both re-ingested copies and sub-passages."""
+    if not shingles or not kept:
+        return 0.0
+    return len(shingles & kept) / len(shingles)
+
+
+def merge_overlapping_text(first: str, second: str, min_overlap: int = 20) -> Optional[str]:
+    """
+    Join two chunks when the end of `first` repeats at the start of `second`, as with overlapping chunking.
+
+    :return: The merged text, or None if the chunks don't overlap by at least min_overlap characters
+    """
+    if second in first:
+        return first
+    if first in second:
+        return second
+    probe = second[:min_overlap]
+    if len(probe) < min_overlap:
+        return None
+    # Every occurrence of the probe in `first` is a candidate overlap start; the earliest gives the longest overlap
+    position = first.find(probe)
+    while position != -1:
+        if second.startswith(first[position:]):
+            return first + second[len(first) - position:]
+        position = first.find(probe, position + 1)
+    return None
+
+
+def truncate_to_budget(text: str, max_tokens: int, token_counter: Callable[[str], int]) -> str:
+    """Longest word prefix of `text` that fits in max_tokens, found by binary search over the word count."""
+    words = text.split(' ')
+    low, high = 0, len(words)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if token_counter(' '.join(words[:middle])) <= max_tokens:
+            low = middle
+        else:
+            high = middle - 1
+    return ' '.join(words[:low])
+
+
+def merge_same_media_documents(relevant_docs: List[Tuple[int, str, str, float]],
+                               metadata: Dict[int, Dict]) -> List[Dict]:
+    """
+    Merge chunks of the same media that overlap or are adjacent (consecutive chunk_index) into one passage.
+
+    Input and output are best-first; a merged passage keeps the position and score of its best chunk.
+    """
+    passages = []
+    for doc_id, title, content, score in relevant_docs:
+        info = metadata.get(doc_id, {})
+        media_id, chunk_index = info.get('media_id'), info.get('chunk_index')
+        merged = False
+        for passage in passages:
+            if media_id is None or passage['media_id'] != media_id:
+                continue
+            if chunk_index is not None and passage['last_index'] is not None \
+                    and chunk_index == passage['last_index'] + 1:
+                passage['content'] = (merge_overlapping_text(passage['content'], content)
+                                      or f"{passage['content']}\n{content}")
+                passage['last_index'] = chunk_index
+            elif chunk_index is not None and passage['first_index'] is not None \
+                    and chunk_index == passage['first_index'] - 1:
+                passage['content'] = (merge_overlapping_text(content, passage['content'])
+                                      or f"{content}\n{passage['content']}")
+                passage['first_index'] = chunk_index
+            else:
+                text = (merge_overlapping_text(passage['content'], content)
+                        or merge_overlapping_text(content, passage['content']))
+                if text is None:
+                    continue
+                passage['content'] = text
+            passage['ids'].append(doc_id)
+            merged = True
+            break
+        if not merged:
+            passages.append({'ids': [doc_id], 'title': title, 'content': content, 'score': score,
+                             'media_id': media_id, 'first_index': chunk_index, 'last_index': chunk_index})
+    return passages
+
+
+def pack_context(relevant_docs: List[Tuple[int, str, str, float]], token_budget: Optional[int],
+                 token_counter: Callable[[str], int], metadata: Optional[Dict[int, Dict]] = None,
+                 dedup_threshold: float = 0.8, min_fill_tokens: int = 64) -> Tuple[
+        List[Tuple[int, str, str, float]], Dict[str, int]]:
+    """
+    Pack retrieved documents into a token budget for the RAG prompt.
+
+    Overlapping or adjacent chunks of the same media are merged, near-duplicates (passages whose word shingles
+    are at least dedup_threshold contained in a better-ranked passage) are dropped, then passages are taken by relevance
+    until the budget is full. A passage that no longer fits is cut down if at least min_fill_tokens remain,
+    otherwise skipped so a shorter, lower-ranked one can still fit.
+
+    :param relevant_docs: Retrieved (id, title, content, score) documents, best first
+    :param token_budget: Maximum tokens of context, None or 0 for no limit
+    :param token_counter: Counts tokens with the target model's tokenizer
+    :param metadata: Optional id -> metadata (media_id, chunk_index) from get_metadata_by_ids()
+    :param dedup_threshold: Shingle containment at or above which a passage counts as a duplicate
+    :param min_fill_tokens: Smallest remaining budget worth filling with a truncated passage
+    :return: (packed documents in the (id, title, content, score) shape build_rag_prompt takes, stats)
+    """
+    passages = merge_same_media_documents(relevant_docs, metadata or {})
+
+    unique_passages, kept_shingles = [], []
+    for passage in passages:
+        shingles = word_shingles(passage['content'])
+        if any(shingle_containment(shingles, kept) >= dedup_threshold for kept in kept_shingles):
+            continue
+        kept_shingles.append(shingles)
+        unique_passages.append(passage)
+
+    packed, used_tokens, truncated = [], 0, 0
+    separator_tokens = token_counter("\n\n")
+    for passage in unique_passages:
+        title, content = passage['title'], passage['content']
+        cost = token_counter(format_context_document(title, content)) + (separator_tokens if packed else 0)
+        if token_budget and used_tokens + cost > token_budget:
+            remaining = token_budget - used_tokens - (cost - token_counter(content))
+            if remaining < min_fill_tokens:
+                continue
+            content = truncate_to_budget(content, remaining, token_counter)
+            cost = token_counter(format_context_document(title, content)) + (separator_tokens if packed else 0)
+            if used_tokens + cost > token_budget:
+                continue
+            truncated += 1
+        packed.append((passage['ids'][0], title, content, passage['score']))
+        used_tokens += cost
+
+    stats = {
+        'input_documents': len(relevant_docs),
+        'merged_passages': len(passages),
+        'duplicates_dropped': len(passages) - len(unique_passages),
+        'packed_passages': len(packed),
+        'truncated_passages': truncated,
+        'context_tokens': used_tokens,
+    }
+    return packed, stats
+
+#
+# End of Context packing
+#######################################################################################################################
+#
+# Semantic answer cache
+#
+
+class SemanticAnswerCache:
+    """
+    Cache of LLM answers looked up by question similarity instead of exact text.
+
+    Answers are grouped by scope: a key for everything besides the question that shapes the answer (media item /
+    retrieved context, LLM, prompt). Within a scope, a question whose embedding has cosine similarity >= threshold
+    with a cached question gets that question's answer, skipping the LLM call entirely. Entries expire after
+    ttl_seconds and are tagged with the media they were answered from, so invalidate_media() (hooked to
+    SQLite_DB's media update notifications) drops answers about re-ingested or edited media.
+    """
+
+    def __init__(self, threshold: Optional[float] = None, ttl_seconds: Optional[float] = None,
+                 max_entries_per_scope: int = 256, model_name: Optional[str] = None):
+        """
+        :param threshold: Minimum cosine similarity for a hit (default RAG_ANSWER_CACHE_THRESHOLD or 0.92)
+        :param ttl_seconds: Entry lifetime (default RAG_ANSWER_CACHE_TTL or one day), 0 or None to never expire
+        :param max_entries_per_scope: Oldest entries of a scope are evicted beyond this
+        :param model_name: Embedding model used by encode() (default DEFAULT_MODEL_NAME)
+        """
+        self.threshold = threshold if threshold is not None else float(os.getenv('RAG_ANSWER_CACHE_THRESHOLD', '0.92'))
+        self.ttl_seconds = ttl_seconds if ttl_seconds is not None else float(os.getenv('RAG_ANSWER_CACHE_TTL', '86400'))
+        self.max_entries_per_scope = max_entries_per_scope
+        self.model_name = model_name
+        self.lock = threading.Lock()
+        # scope -> {'entries': [(embedding, answer, created_at, media_ids)], 'matrix': stacked embeddings or None}
+        self.scopes: Dict[str, Dict] = {}
+        self.lookups = 0
+        self.hits = 0
+        self.invalidations = 0
+
+    def encode(self, question: str) -> np.ndarray:
+        """Embed a question with the shared encoder (loaded on first use)."""
+        return np.asarray(get_embedding_encoder(self.model_name).encode([question])[0], dtype=np.float32)
+
+    def _live_entries(self, scope: Dict) -> List[Tuple]:
+        if self.ttl_seconds:
+            cutoff = time.time() - self.ttl_seconds
+            live = [entry for entry in scope['entries'] if entry[2] >= cutoff]
+            if len(live) != len(scope['entries']):
+                scope['entries'], scope['matrix'] = live, None
+        return scope['entries']
+
+    def get(self, scope_key: str, question_embedding: np.ndarray) -> Optional[str]:
+        """Cached answer of the most similar question in the scope, if it clears the threshold."""
+        query = normalize_rows(np.asarray(question_embedding, dtype=np.float32))
+        with self.lock:
+            self.lookups += 1
+            scope = self.scopes.get(scope_key)
+            if scope is None or not self._live_entries(scope):
+                return None
+            if scope['matrix'] is None:
+                scope['matrix'] = np.vstack([entry[0] for entry in scope['entries']])
+            similarities = scope['matrix'] @ query
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.threshold:
+                return None
+            self.hits += 1
+            return scope['entries'][best][1]
+
+    def put(self, scope_key: str, question_embedding: np.ndarray, answer: str, media_ids=()):
+        """
+        Cache an answer.
+
+        :param scope_key: Scope of the answer, see make_cache_key()
+        :param question_embedding: Embedding of the question
+        :param answer: The LLM's answer
+        :param media_ids: Media the answer was generated from, for invalidate_media()
+        """
+        embedding = normalize_rows(np.asarray(question_embedding, dtype=np.float32))
+        with self.lock:
+            scope = self.scopes.setdefault(scope_key, {'entries': [], 'matrix': None})
+            scope['entries'].append((embedding, answer, time.time(),
+                                     frozenset(int(media_id) for media_id in media_ids if media_id is not None)))
+            del scope['entries'][:-self.max_entries_per_scope]
+            scope['matrix'] = None
+
+    def invalidate_media(self, media_id: int):
+        """Drop every cached answer generated from `media_id`."""
+        media_id = int(media_id)
+        with self.lock:
+            for scope_key in list(self.scopes):
+                scope = self.scopes[scope_key]
+                kept = [entry for entry in scope['entries'] if media_id not in entry[3]]
+                if len(kept) != len(scope['entries']):
+                    self.invalidations += len(scope['entries']) - len(kept)
+                    scope['entries'], scope['matrix'] = kept, None
+                if not kept:
+                    del self.scopes[scope_key]
+        logger.info(f"Invalidated cached answers for media ID {media_id}")
+
+    def clear(self):
+        with self.lock:
+            self.scopes.clear()
+
+    def stats(self) -> Dict[str, float]:
+        with self.lock:
+            return {
+                'lookups': self.lookups,
+                'hits': self.hits,
+                'hit_rate': self.hits / self.lookups if self.lookups else 0.0,
+                'entries': sum(len(scope['entries']) for scope in self.scopes.values()),
+                'invalidations': self.invalidations,
+            }
+
+#
+# End of Semantic answer cache
+#######################################################################################################################
+#
+# Answering
+#
+# Shared by the single-store RAG systems and ShardedRAGSystem, which is not a BaseRAGSystem: the mixins only rely on
+# the methods and attributes both provide.
+
+class ContextPackingMixin:
+    """
+    Context packing and answer caching. Needs get_metadata_by_ids(), context_token_budget, token_counter and
+    answer_cache.
+    """
+
+    def cache_answer(self, scope_key: str, query_embedding: np.ndarray, response: str,
+                     packed_docs: List[Tuple[int, str, str, float]]):
+        if self.answer_cache is None:
+            return
+        metadata = self.get_metadata_by_ids([doc_id for doc_id, *_ in packed_docs])
+        self.answer_cache.put(scope_key, query_embedding, response,
+                              [info['media_id'] for info in metadata.values()])
+
+    def pack_documents(self, relevant_docs: List[Tuple[int, str, str, float]],
+                       token_budget: Optional[int] = None) -> List[Tuple[int, str, str, float]]:
+        """
+        Merge, de-duplicate and fit retrieved documents into the context token budget, see pack_context().
+
+        :param relevant_docs: Retrieved (id, title, content, score) documents, best first
+        :param token_budget: Overrides context_token_budget for this call
+        :return: Packed documents, ready for build_rag_prompt()
+        """
+        metadata = self.get_metadata_by_ids([doc_id for doc_id, *_ in relevant_docs])
+        packed, stats = pack_context(relevant_docs, self.context_token_budget if token_budget is None else token_budget,
+                                     self.token_counter, metadata)
+        logger.info(f"Packed RAG context: {stats}")
+        return packed
+
+
+class RAGQueryMixin(ContextPackingMixin):
+    """rag_query()/rag_query_batch() on top of get_relevant_documents(_batch)(), encode_query() and answer_scope()."""
+
+    def rag_query(self, query: str, llm_function: Callable[[str], str], top_k: int = 3,
+                  filters: Optional[Dict] = None) -> str:
+        try:
+            if self.answer_cache is not None:
+                scope_key = self.answer_scope(llm_function, top_k, filters)
+                query_embedding = self.encode_query(query)
+                cached = self.answer_cache.get(scope_key, query_embedding)
+                if cached is not None:
+                    logger.info(f"Served answer from the semantic answer cache: {self.answer_cache.stats()}")
+                    return cached
+
+            relevant_docs = self.get_relevant_documents(query, top_k, filters=filters)
+            packed_docs = self.pack_documents(relevant_docs)
+            llm_prompt = build_rag_prompt(query, packed_docs)
+
+            response = llm_function(llm_prompt)
+            if self.answer_cache is not None:
+                self.cache_answer(scope_key, query_embedding, response, packed_docs)
+            logger.info("Generated response for query")
+            return response
+        except Exception as e:
+            logger.error(f"Error in RAG query: {e}")
+            raise RAGException(f"RAG query failed: {e}")
+
+    def rag_query_batch(self, queries: List[str], llm_function: Callable[[str], str], top_k: int = 3,
+                        max_workers: int = 4, filters: Optional[Dict] = None) -> List[str]:
+        """
+        Answer many queries: batched retrieval, then LLM calls dispatched concurrently on a bounded pool.
+
+        :param queries: Queries to answer
+        :param llm_function: Function that takes a prompt and returns the LLM response
+        :param top_k: Number of documents of context per query
+        :param max_workers: Maximum number of LLM calls in flight at once
+        :param filters: Optional metadata filter shared by all queries
+        :return: Responses in the order of `queries`
+        """
+        if not queries:
+            return []
+        try:
+            relevant_docs_batch = self.get_relevant_documents_batch(queries, top_k, filters=filters)
+            llm_prompts = [build_rag_prompt(query, self.pack_documents(relevant_docs))
+                           for query, relevant_docs in zip(queries, relevant_docs_batch)]
+            with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(llm_prompts))),
+                                    thread_name_prefix='rag-llm') as pool:
+                responses = list(pool.map(llm_function, llm_prompts))
+            logger.info(f"Generated responses for {len(queries)} queries")
+            return responses
+        except Exception as e:
+            logger.error(f"Error in batch RAG query: {e}")
+            raise RAGException(f"Batch RAG query failed: {e}")
+
+#
+# End of Answering
+#######################################################################################################################
+
+
+class BaseRAGSystem(ContextPackingMixin):
     def __init__(self, db_path: str, model_name: Optional[str] = None):
         """
         Initialize the RAG system.
 
         :param db_path: Path to the SQLite database
-        :param model_name: Name of the SentenceTransformer model to use
+        :param model_name: Name of the SentenceTransformer model to use. If the database's vectors were made by
+            another model, queries keep using that model until the documents are re-embedded with a call to
+            start_reembedding(), then switch over
         """
         self.db_path = db_path
-        self.model_name = model_name or os.getenv('DEFAULT_MODEL_NAME', 'all-MiniLM-L6-v2')
+        self.model_name = model_name or default_model_name()
+        # Model the documents should be embedded with; differs from model_name while a re-embedding is pending
+        self.target_model_name = self.model_name
+        self.encoder_lock = threading.Lock()
+        self.vector_set_id = None
+        self.embedding_dim = None
+        self.reembed_thread = None
+        self.reembed_stop = threading.Event()
+        self.reembed_progress = {}
         try:
-            self.model = SentenceTransformer(self.model_name)
+            # Shared, lazily loaded model behind one dynamic batcher: concurrent queries and ingestion of every
+            # RAG system using this model are coalesced into shared encode calls
+            self.model = get_embedding_encoder(self.model_name)
             logger.info(f"Initialized SentenceTransformer with model: {self.model_name}")
         except Exception as e:
             logger.error(f"Failed to initialize SentenceTransformer: {e}")
             raise RAGException(f"Model initialization failed: {e}")
 
+        # Repeated questions (e.g. paging through results) skip the encoder
+        self.embedding_cache = create_embedding_cache()
+        # Optional SemanticAnswerCache consulted by rag_query before retrieval; None disables it
+        self.answer_cache: Optional[SemanticAnswerCache] = None
+        # Prompt context is packed into this many tokens of the target model's tokenizer (0 = no limit)
+        self.context_token_budget = int(os.getenv('RAG_CONTEXT_TOKEN_BUDGET', '3000'))
+        self.token_counter = functools.partial(count_tokens,
+                                               model=os.getenv('RAG_TOKENIZER_MODEL', DEFAULT_TOKENIZER_MODEL))
         self.init_db()
+        self.init_vector_sets()
+
+    def current_encoder(self) -> Tuple[str, object]:
+        """(model name, encoder) that queries must use: the model of the active vector set."""
+        self.refresh_vector_set()
+        with self.encoder_lock:
+            return self.model_name, self.model
+
+    def encode_query(self, query: str) -> np.ndarray:
+        """Embed a query, served from the embedding cache when the normalized query was seen before."""
+        model_name, model = self.current_encoder()
+        key = make_cache_key(model_name, normalize_query(query))
+        embedding = self.embedding_cache.get(key)
+        if embedding is None:
+            embedding = np.asarray(model.encode([query])[0], dtype=np.float32)
+            self.embedding_cache.put(key, embedding)
+        return embedding
+
+    def encode_queries(self, queries: List[str]) -> np.ndarray:
+        """Embed many queries; only cache misses are encoded, in a single batch."""
+        model_name, model = self.current_encoder()
+        keys = [make_cache_key(model_name, normalize_query(query)) for query in queries]
+        embeddings = [self.embedding_cache.get(key) for key in keys]
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if missing:
+            encoded = model.encode([queries[i] for i in missing])
+            for i, embedding in zip(missing, encoded):
+                embeddings[i] = np.asarray(embedding, dtype=np.float32)
+                self.embedding_cache.put(keys[i], embeddings[i])
+        return np.vstack(embeddings)
 
     @contextmanager
     def get_db_connection(self):
@@ -66,21 +876,126 @@ class BaseRAGSystem:
                     embedding BLOB
                 )
                 ''')
+                # Chunk metadata used to pre-filter searches, mirroring the Media / MediaKeywords tables
+                self.add_missing_columns(cursor, 'documents', {
+                    'media_id': 'INTEGER',
+                    'media_type': 'TEXT',
+                    'ingestion_date': 'TEXT',
+                    'chunk_index': 'INTEGER',
+                    'vector_set_id': 'INTEGER',
+                    'collection': 'TEXT',
+                })
+                # One row per embedding model the documents were (or are being) embedded with; exactly one is
+                # 'active' and its vectors are the ones in documents.embedding
+                cursor.execute('''
+                CREATE TABLE IF NOT EXISTS vector_sets (
+                    id INTEGER PRIMARY KEY,
+                    model_name TEXT NOT NULL,
+                    dimension INTEGER,
+                    status TEXT NOT NULL CHECK (status IN ('building', 'active', 'retired')),
+                    created_at TEXT,
+                    activated_at TEXT
+                )
+                ''')
+                # Vectors of a 'building' set, staged side by side until the set is activated
+                cursor.execute('''
+                CREATE TABLE IF NOT EXISTS vector_set_embeddings (
+                    vector_set_id INTEGER NOT NULL,
+                    document_id INTEGER NOT NULL,
+                    embedding BLOB,
+                    PRIMARY KEY (vector_set_id, document_id)
+                ) WITHOUT ROWID
+                ''')
+                cursor.execute('''
+                CREATE TABLE IF NOT EXISTS document_keywords (
+                    document_id INTEGER NOT NULL,
+                    keyword TEXT NOT NULL,
+                    PRIMARY KEY (keyword, document_id)
+                ) WITHOUT ROWID
+                ''')
+                cursor.execute('CREATE INDEX IF NOT EXISTS idx_documents_media_id ON documents(media_id)')
+                cursor.execute('CREATE INDEX IF NOT EXISTS idx_documents_media_type ON documents(media_type)')
+                cursor.execute('CREATE INDEX IF NOT EXISTS idx_documents_ingestion_date ON documents(ingestion_date)')
+                cursor.execute('CREATE INDEX IF NOT EXISTS idx_documents_collection ON documents(collection)')
+                cursor.execute('CREATE INDEX IF NOT EXISTS idx_document_keywords_document_id '
+                               'ON document_keywords(document_id)')
+                # Lexical (BM25) index over the same rows, mirrors media_fts in SQLite_DB
+                cursor.execute('CREATE VIRTUAL TABLE IF NOT EXISTS documents_fts USING fts5(title, content)')
+                # Backfill rows that were added before the FTS index existed
+                cursor.execute('''
+                INSERT INTO documents_fts (rowid, title, content)
+                SELECT id, title, content FROM documents
+                WHERE id NOT IN (SELECT rowid FROM documents_fts)
+                ''')
                 conn.commit()
             logger.info("Initialized database schema")
         except sqlite3.Error as e:
             logger.error(f"Failed to initialize database schema: {e}")
             raise RAGException(f"Database schema initialization failed: {e}")
 
-    def add_documents(self, documents: List[Tuple[str, str]]):
+    def add_missing_columns(self, cursor: sqlite3.Cursor, table: str, columns: Dict[str, str]):
+        """Add any of `columns` (name -> SQL type) that an older database is missing from `table`."""
+        existing = {row[1] for row in cursor.execute(f'PRAGMA table_info({table})').fetchall()}
+        for name, column_type in columns.items():
+            if name not in existing:
+                cursor.execute(f'ALTER TABLE {table} ADD COLUMN {name} {column_type}')
+                logger.info(f"Added column {name} to {table}")
+
+    def embedding_columns(self, embedding: np.ndarray) -> Dict[str, object]:
+        """Column values stored in the documents table for one embedding."""
+        return {'embedding': np.asarray(embedding, dtype=np.float32).tobytes()}
+
+    def metadata_columns(self, metadata: Optional[Dict]) -> Dict[str, object]:
+        """Column values stored in the documents table for one chunk's metadata."""
+        metadata = metadata or {}
+        return {
+            'media_id': metadata.get('media_id'),
+            'media_type': metadata.get('media_type'),
+            'ingestion_date': metadata.get('ingestion_date') or datetime.now().strftime('%Y-%m-%d'),
+            'chunk_index': metadata.get('chunk_index'),
+            'collection': None if metadata.get('collection') is None else str(metadata['collection']),
+        }
+
+    def add_documents(self, documents: List[Tuple[str, str]], metadata: Optional[List[Dict]] = None):
+        """
+        Embed and store documents (chunks), with optional metadata for filtered search.
+
+        :param documents: List of (title, content)
+        :param metadata: Optional list, parallel to `documents`, of dicts with media_id, media_type,
+            keywords (list or comma separated string), ingestion_date ('%Y-%m-%d', defaults to today),
+            chunk_index (position of the chunk within its media, used to merge adjacent chunks in the prompt) and
+            collection (any grouping label, filterable like media_type)
+        """
+        if metadata is not None and len(metadata) != len(documents):
+            raise RAGException("metadata must have one entry per document")
         try:
-            embeddings = self.model.encode([content for _, content in documents])
             with self.get_db_connection() as conn:
                 cursor = conn.cursor()
-                cursor.executemany(
-                    'INSERT INTO documents (title, content, embedding) VALUES (?, ?, ?)',
-                    [(title, content, embedding.tobytes()) for (title, content), embedding in zip(documents, embeddings)]
-                )
+                # Another process may activate a new vector set while this batch is encoded: encode, then check
+                # under the write lock that the model is still the active one, otherwise re-encode
+                while True:
+                    self.refresh_vector_set()
+                    with self.encoder_lock:
+                        vector_set_id, model = self.vector_set_id, self.model
+                    embeddings = model.encode([content for _, content in documents])
+                    cursor.execute('BEGIN IMMEDIATE')
+                    if self.active_vector_set(cursor)[0] == vector_set_id:
+                        break
+                    conn.rollback()
+                for i, ((title, content), embedding) in enumerate(zip(documents, embeddings)):
+                    document_metadata = metadata[i] if metadata else None
+                    columns = {'title': title, 'content': content, **self.embedding_columns(embedding),
+                               **self.metadata_columns(document_metadata), 'vector_set_id': vector_set_id}
+                    cursor.execute(
+                        f'INSERT INTO documents ({", ".join(columns)}) VALUES ({", ".join("?" * len(columns))})',
+                        list(columns.values())
+                    )
+                    doc_id = cursor.lastrowid
+                    cursor.execute('INSERT INTO documents_fts (rowid, title, content) VALUES (?, ?, ?)',
+                                   (doc_id, title, content))
+                    keywords = normalize_keywords((document_metadata or {}).get('keywords'))
+                    cursor.executemany('INSERT OR IGNORE INTO document_keywords (document_id, keyword) VALUES (?, ?)',
+                                       [(doc_id, keyword) for keyword in keywords])
                 conn.commit()
             logger.info(f"Added {len(documents)} documents in batch")
         except Exception as e:
@@ -100,104 +1015,1455 @@ class BaseRAGSystem:
             logger.error(f"Failed to retrieve documents: {e}")
             raise RAGException(f"Document retrieval failed: {e}")
 
-    def close(self):
+    def get_documents_by_ids(self, ids: List[int]) -> Dict[int, Tuple[str, str]]:
+        """
+        Fetch title/content for a set of document ids.
+
+        :param ids: Document ids to fetch
+        :return: Mapping of id -> (title, content)
+        """
+        if not ids:
+            return {}
         try:
-            self.conn.close()
-            logger.info("Closed database connection")
+            with self.get_db_connection() as conn:
+                cursor = conn.cursor()
+                placeholders = ','.join('?' * len(ids))
+                cursor.execute(f'SELECT id, title, content FROM documents WHERE id IN ({placeholders})',
+                               [int(doc_id) for doc_id in ids])
+                return {id: (title, content) for id, title, content in cursor.fetchall()}
         except sqlite3.Error as e:
-            logger.error(f"Error closing database connection: {e}")
+            logger.error(f"Failed to fetch documents by id: {e}")
+            raise RAGException(f"Document fetch failed: {e}")
 
+    def get_embeddings_by_ids(self, ids: List[int]) -> Dict[int, np.ndarray]:
+        """
+        Fetch the full-precision embeddings of a set of documents.
 
-class StandardRAGSystem(BaseRAGSystem):
-    def get_relevant_documents(self, query: str, top_k: int = 3) -> List[Tuple[int, str, str, float]]:
+        :param ids: Document ids to fetch
+        :return: Mapping of id -> float32 embedding
+        """
+        if not ids:
+            return {}
         try:
-            query_embedding = self.model.encode([query])[0]
-            documents = self.get_documents()
-            similarities = [
-                (id, title, content, cosine_similarity([query_embedding], [doc_embedding])[0][0])
-                for id, title, content, doc_embedding in documents
-            ]
-            similarities.sort(key=lambda x: x[3], reverse=True)
-            logger.info(f"Retrieved top {top_k} relevant documents for query")
-            return similarities[:top_k]
-        except Exception as e:
-            logger.error(f"Error in getting relevant documents: {e}")
-            raise RAGException(f"Retrieval of relevant documents failed: {e}")
+            with self.get_db_connection() as conn:
+                cursor = conn.cursor()
+                placeholders = ','.join('?' * len(ids))
+                cursor.execute(f'SELECT id, embedding FROM documents WHERE id IN ({placeholders})',
+                               [int(doc_id) for doc_id in ids])
+                return {id: np.frombuffer(embedding, dtype=np.float32) for id, embedding in cursor.fetchall()}
+        except sqlite3.Error as e:
+            logger.error(f"Failed to fetch embeddings by id: {e}")
+            raise RAGException(f"Embedding fetch failed: {e}")
+
+    def get_metadata_by_ids(self, ids: List[int]) -> Dict[int, Dict]:
+        """
+        Fetch the metadata of a set of documents.
 
-    def rag_query(self, query: str, llm_function: Callable[[str], str], top_k: int = 3) -> str:
+        :param ids: Document ids to fetch
+        :return: Mapping of id -> {'media_id', 'media_type', 'ingestion_date', 'chunk_index', 'collection',
+            'keywords'}
+        """
+        if not ids:
+            return {}
         try:
-            relevant_docs = self.get_relevant_documents(query, top_k)
-            context = "\n\n".join([f"Title: {title}\nContent: {content}" for _, title, content, _ in relevant_docs])
+            with self.get_db_connection() as conn:
+                cursor = conn.cursor()
+                placeholders = ','.join('?' * len(ids))
+                params = [int(doc_id) for doc_id in ids]
+                cursor.execute(f'SELECT id, media_id, media_type, ingestion_date, chunk_index, collection '
+                               f'FROM documents WHERE id IN ({placeholders})', params)
+                metadata = {id: {'media_id': media_id, 'media_type': media_type, 'ingestion_date': ingestion_date,
+                                 'chunk_index': chunk_index, 'collection': collection, 'keywords': []}
+                            for id, media_id, media_type, ingestion_date, chunk_index, collection
+                            in cursor.fetchall()}
+                cursor.execute(f'SELECT document_id, keyword FROM document_keywords '
+                               f'WHERE document_id IN ({placeholders})', params)
+                for doc_id, keyword in cursor.fetchall():
+                    metadata[doc_id]['keywords'].append(keyword)
+                return metadata
+        except sqlite3.Error as e:
+            logger.error(f"Failed to fetch metadata by id: {e}")
+            raise RAGException(f"Metadata fetch failed: {e}")
 
-            llm_prompt = f"Based on the following context, please answer the query:\n\nContext:\n{context}\n\nQuery: {query}"
+    def filter_document_ids(self, filters: Dict) -> np.ndarray:
+        """
+        Resolve a metadata filter to the sorted ids of matching documents, using the metadata indexes.
 
-            response = llm_function(llm_prompt)
-            logger.info("Generated response for query")
-            return response
-        except Exception as e:
-            logger.error(f"Error in RAG query: {e}")
-            raise RAGException(f"RAG query failed: {e}")
+        :param filters: Metadata filter, see build_metadata_filter()
+        :return: Sorted int64 array of document ids
+        """
+        condition, params = build_metadata_filter(filters)
+        try:
+            with self.get_db_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(f'SELECT id FROM documents WHERE {condition} ORDER BY id', params)
+                return np.array([row[0] for row in cursor.fetchall()], dtype=np.int64)
+        except sqlite3.Error as e:
+            logger.error(f"Failed to apply metadata filter: {e}")
+            raise RAGException(f"Metadata filtering failed: {e}")
 
+    def answer_scope(self, llm_function: Callable, top_k: int, filters: Optional[Dict]) -> str:
+        """Answer cache scope for rag_query: same database, retrieval settings and LLM."""
+        return make_cache_key(type(self).__name__, os.path.abspath(self.db_path), llm_function_id(llm_function),
+                              top_k, sorted((filters or {}).items(), key=lambda item: item[0]))
 
-class HyDERAGSystem(BaseRAGSystem):
-    def generate_hypothetical_document(self, query: str, llm_function: Callable[[str], str]) -> str:
-        try:
-            prompt = f"Given the question '{query}', write a short paragraph that would answer this question. Do not include the question itself in your response."
-            hypothetical_doc = llm_function(prompt)
-            logger.info("Generated hypothetical document")
-            return hypothetical_doc
-        except Exception as e:
-            logger.error(f"Error generating hypothetical document: {e}")
-            raise RAGException(f"Hypothetical document generation failed: {e}")
+    def load_embedding_matrix(self, filters: Optional[Dict] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Load document embeddings as one L2-normalized matrix.
 
-    def get_relevant_documents(self, query: str, llm_function: Callable[[str], str], top_k: int = 3) -> List[
-        Tuple[int, str, str, float]]:
+        :param filters: Optional metadata filter; only the matching rows are read from SQLite
+        :return: (ids, matrix) where matrix[i] is the unit-length embedding of ids[i]
+        """
+        condition, params = build_metadata_filter(filters)
         try:
-            hypothetical_doc = self.generate_hypothetical_document(query, llm_function)
-            hyde_embedding = self.model.encode([hypothetical_doc])[0]
-
-            documents = self.get_documents()
-            similarities = [
-                (id, title, content, cosine_similarity([hyde_embedding], [doc_embedding])[0][0])
-                for id, title, content, doc_embedding in documents
-            ]
-            similarities.sort(key=lambda x: x[3], reverse=True)
-            logger.info(f"Retrieved top {top_k} relevant documents using HyDE")
-            return similarities[:top_k]
-        except Exception as e:
-            logger.error(f"Error in getting relevant documents with HyDE: {e}")
-            raise RAGException(f"HyDE retrieval of relevant documents failed: {e}")
+            with self.get_db_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(f'SELECT id, embedding FROM documents WHERE {condition}', params)
+                rows = cursor.fetchall()
+        except sqlite3.Error as e:
+            logger.error(f"Failed to load embeddings: {e}")
+            raise RAGException(f"Embedding load failed: {e}")
+        return embedding_rows_to_matrix(rows)
 
-    def rag_query(self, query: str, llm_function: Callable[[str], str], top_k: int = 3) -> str:
-        try:
-            relevant_docs = self.get_relevant_documents(query, llm_function, top_k)
-            context = "\n\n".join([f"Title: {title}\nContent: {content}" for _, title, content, _ in relevant_docs])
+    def vector_search(self, query_embedding: np.ndarray, top_k: int = 3,
+                      filters: Optional[Dict] = None) -> List[Tuple[int, float]]:
+        """
+        Exact cosine-similarity search over the stored embeddings.
 
-            llm_prompt = f"Based on the following context, please answer the query:\n\nContext:\n{context}\n\nQuery: {query}"
+        :param query_embedding: Embedding of the query
+        :param top_k: Number of results to return
+        :param filters: Optional metadata filter applied before scoring, so only matching documents are scored
+        :return: List of (document id, similarity), best first
+        """
+        ids, matrix = self.load_embedding_matrix(filters)
+        if len(ids) == 0:
+            return []
+        scores = matrix @ normalize_rows(np.asarray(query_embedding, dtype=np.float32))
+        return [(int(ids[i]), float(scores[i])) for i in top_k_indices(scores, top_k)]
 
-            response = llm_function(llm_prompt)
-            logger.info("Generated response for query using HyDE")
-            return response
-        except Exception as e:
-            logger.error(f"Error in HyDE RAG query: {e}")
-            raise RAGException(f"HyDE RAG query failed: {e}")
+    def vector_search_batch(self, query_embeddings: np.ndarray, top_k: int = 3, block_size: int = 256,
+                            filters: Optional[Dict] = None) -> List[List[Tuple[int, float]]]:
+        """
+        Exact cosine-similarity search for many queries at once.
 
+        The embedding matrix is loaded once and each block of queries is scored with a single matrix-matrix
+        product; block_size bounds the size of the (queries x documents) score matrix held in memory.
 
-# Example usage with error handling
-def mock_llm(prompt: str) -> str:
-    if "write a short paragraph" in prompt:
-        return "Paris, the capital of France, is renowned for its iconic Eiffel Tower and rich cultural heritage."
-    else:
-        return f"This is a mock LLM response for the prompt: {prompt}"
+        :param query_embeddings: (num_queries, dim) array of query embeddings
+        :param top_k: Number of results to return per query
+        :param block_size: Number of queries scored per matrix product
+        :param filters: Optional metadata filter shared by all queries, applied before scoring
+        :return: One list of (document id, similarity) per query, best first
+        """
+        query_matrix = normalize_rows(np.atleast_2d(np.asarray(query_embeddings, dtype=np.float32)))
+        ids, matrix = self.load_embedding_matrix(filters)
+        if len(ids) == 0:
+            return [[] for _ in range(len(query_matrix))]
+        results = []
+        for block_start in range(0, len(query_matrix), block_size):
+            block_scores = query_matrix[block_start:block_start + block_size] @ matrix.T
+            for scores in block_scores:
+                results.append([(int(ids[i]), float(scores[i])) for i in top_k_indices(scores, top_k)])
+        return results
 
+    def lexical_search(self, query: str, top_k: int = 3, filters: Optional[Dict] = None) -> List[Tuple[int, float]]:
+        """
+        BM25 search over the FTS5 index of the documents table.
 
-def main():
-    use_hyde = False  # Set this to True when you want to enable HyDE
+        :param query: Free-text query; its terms are OR'ed together
+        :param top_k: Number of results to return
+        :param filters: Optional metadata filter; non-matching documents are excluded before ranking
+        :return: List of (document id, score), best first
+        """
+        match_expression = build_fts_query(query)
+        if not match_expression:
+            return []
+        condition, params = build_metadata_filter(filters)
+        filter_clause = f'AND rowid IN (SELECT id FROM documents WHERE {condition})' if filters else ''
+        try:
+            with self.get_db_connection() as conn:
+                cursor = conn.cursor()
+                # FTS5's bm25() is lower-is-better, negate it so every score here is higher-is-better
+                cursor.execute(f'''
+                SELECT rowid, -bm25(documents_fts) AS score
+                FROM documents_fts
+                WHERE documents_fts MATCH ? {filter_clause}
+                ORDER BY score DESC
+                LIMIT ?
+                ''', (match_expression, *params, top_k))
+                return [(int(rowid), float(score)) for rowid, score in cursor.fetchall()]
+        except sqlite3.Error as e:
+            logger.error(f"Failed lexical search: {e}")
+            raise RAGException(f"Lexical search failed: {e}")
 
-    try:
-        if use_hyde:
-            rag_system = HyDERAGSystem('rag_database.db')
-            logger.info("Using HyDE RAG System")
+    ###################################################################################################################
+    # Vector sets & background re-embedding
+    #
+    # Vectors made by different models (or dimensions) are not comparable, so every document records the vector set
+    # its embedding belongs to, and vector_sets records each set's model and dimension. Changing the model starts a
+    # 'building' set: start_reembedding() starts a background job that embeds the documents into
+    # vector_set_embeddings in small batches, throttled to a fraction of one core, while searches keep using the
+    # active set and its model. Other stored vectors (stage_extras) are embedded the same way. When everything is
+    # staged, one transaction encodes the few rows added meanwhile, copies the staged vectors over in batches and
+    # swaps the set statuses, so readers see either the old or the new set, never a mix.
+
+    # Staged vectors copied per statement when a vector set is activated
+    ACTIVATION_BATCH_SIZE = 1000
+
+    def init_vector_sets(self):
+        """Record the active vector set, or register the existing embeddings as one."""
+        try:
+            with self.get_db_connection() as conn:
+                cursor = conn.cursor()
+                active = self.active_vector_set(cursor)
+                if active is None:
+                    # New database, or one from before vector sets: assume its vectors came from the configured model
+                    row = cursor.execute('SELECT embedding FROM documents WHERE embedding IS NOT NULL LIMIT 1').fetchone()
+                    dimension = len(row[0]) // 4 if row else embedding_dimension(self.model)
+                    now = datetime.now().isoformat()
+                    cursor.execute("INSERT INTO vector_sets (model_name, dimension, status, created_at, activated_at) "
+                                   "VALUES (?, ?, 'active', ?, ?)", (self.model_name, dimension, now, now))
+                    active = (cursor.lastrowid, self.model_name, dimension)
+                    cursor.execute('UPDATE documents SET vector_set_id = ? WHERE vector_set_id IS NULL', (active[0],))
+                    conn.commit()
+        except sqlite3.Error as e:
+            logger.error(f"Failed to initialize vector sets: {e}")
+            raise RAGException(f"Vector set initialization failed: {e}")
+
+        self.use_vector_set(*active)
+        if active[1] != self.target_model_name:
+            logger.warning(f"Documents are embedded with {active[1]}, not {self.target_model_name}; searches use "
+                           f"{active[1]} until start_reembedding() has re-embedded them")
+
+    @staticmethod
+    def active_vector_set(cursor: sqlite3.Cursor) -> Optional[Tuple[int, str, int]]:
+        return cursor.execute("SELECT id, model_name, dimension FROM vector_sets WHERE status = 'active' "
+                              "ORDER BY id DESC LIMIT 1").fetchone()
+
+    def use_vector_set(self, vector_set_id: int, model_name: str, dimension: int):
+        """Point query encoding at the model of `vector_set_id`."""
+        with self.encoder_lock:
+            if vector_set_id == self.vector_set_id:
+                return
+            if model_name != self.model_name:
+                self.model = get_embedding_encoder(model_name)
+                self.model_name = model_name
+            self.vector_set_id, self.embedding_dim = vector_set_id, dimension
+        self.on_vector_set_activated()
+        logger.info(f"Using vector set {vector_set_id} ({model_name}, dimension {dimension})")
+
+    def refresh_vector_set(self):
+        """Follow a vector set activated by another process (one indexed lookup, done before every encode)."""
+        try:
+            with self.get_db_connection() as conn:
+                active = self.active_vector_set(conn.cursor())
+        except sqlite3.Error as e:
+            logger.warning(f"Failed to check the active vector set: {e}")
+            return
+        if active is not None and active[0] != self.vector_set_id:
+            self.use_vector_set(*active)
+
+    def on_vector_set_activated(self):
+        """Hook for subclasses holding state derived from the embeddings (e.g. in-memory indexes)."""
+
+    def stage_extras(self, cursor: sqlite3.Cursor, vector_set_id: int, encoder) -> int:
+        """Hook to stage other stored vectors (e.g. media summaries) for `vector_set_id`; returns how many."""
+        return 0
+
+    def activate_extras(self, cursor: sqlite3.Cursor, vector_set_id: int):
+        """Hook to copy the vectors staged by stage_extras() in place, inside the activation transaction."""
+
+    def start_reembedding(self, model_name: Optional[str] = None, batch_size: Optional[int] = None,
+                          cpu_fraction: Optional[float] = None) -> threading.Thread:
+        """
+        Re-embed all documents with `model_name` in a background thread and activate the new vectors when done.
+
+        :param model_name: Model to migrate to (default: the model this system was created with)
+        :param batch_size: Documents embedded per step (default: env RAG_REEMBED_BATCH_SIZE, 64)
+        :param cpu_fraction: Share of wall time spent encoding; the job sleeps the rest
+            (default: env RAG_REEMBED_CPU_FRACTION, 0.25)
+        :return: The running thread; progress is reported by reembedding_status()
+        """
+        model_name = model_name or self.target_model_name
+        batch_size = batch_size or int(os.getenv('RAG_REEMBED_BATCH_SIZE', '64'))
+        cpu_fraction = cpu_fraction or float(os.getenv('RAG_REEMBED_CPU_FRACTION', '0.25'))
+        if not 0 < cpu_fraction <= 1:
+            raise RAGException("cpu_fraction must be in (0, 1]")
+        if self.reembed_thread is not None and self.reembed_thread.is_alive():
+            raise RAGException("A re-embedding job is already running")
+        self.target_model_name = model_name
+        self.reembed_stop.clear()
+        self.reembed_thread = threading.Thread(target=self.reembed_documents,
+                                               args=(model_name, batch_size, cpu_fraction),
+                                               name=f"reembed-{model_name}", daemon=True)
+        self.reembed_thread.start()
+        return self.reembed_thread
+
+    def reembed_documents(self, model_name: str, batch_size: int = 64, cpu_fraction: float = 0.25) -> bool:
+        """
+        Build the vector set for `model_name` side by side with the active one, then activate it.
+
+        Resumable: staged vectors survive restarts, and documents added meanwhile are picked up before activation.
+
+        :return: True if the new set was activated, False if the job was stopped first
+        """
+        self.reembed_progress = {'state': 'starting', 'staged': 0, 'total': 0}
+        try:
+            encoder = get_embedding_encoder(model_name)
+            with self.get_db_connection() as conn:
+                cursor = conn.cursor()
+                active = self.active_vector_set(cursor)
+                if active is not None and active[1] == model_name:
+                    self.reembed_progress['state'] = 'done'
+                    return True
+                row = cursor.execute("SELECT id FROM vector_sets WHERE status = 'building' AND model_name = ? "
+                                     "ORDER BY id DESC LIMIT 1", (model_name,)).fetchone()
+                if row:
+                    vector_set_id = row[0]
+                else:
+                    cursor.execute("INSERT INTO vector_sets (model_name, dimension, status, created_at) "
+                                   "VALUES (?, ?, 'building', ?)",
+                                   (model_name, embedding_dimension(encoder), datetime.now().isoformat()))
+                    vector_set_id = cursor.lastrowid
+                    conn.commit()
+                self.reembed_progress.update(vector_set_id=vector_set_id, state='building')
+                logger.info(f"Re-embedding documents with {model_name} into vector set {vector_set_id}")
+
+                while not self.reembed_stop.is_set():
+                    started = time.perf_counter()
+                    staged = self.stage_embeddings(cursor, vector_set_id, encoder, batch_size)
+                    conn.commit()
+                    if staged < batch_size:
+                        # Caught up: stage the other vectors outside the write lock too, then stage the last
+                        # stragglers and swap the sets in one write transaction
+                        self.stage_extras(cursor, vector_set_id, encoder)
+                        conn.commit()
+                        cursor.execute('BEGIN IMMEDIATE')
+                        self.stage_embeddings(cursor, vector_set_id, encoder, None)
+                        self.stage_extras(cursor, vector_set_id, encoder)
+                        self.activate_vector_set(cursor, vector_set_id)
+                        conn.commit()
+                        break
+                    # Throttle: sleep so encoding takes about cpu_fraction of the wall time
+                    self.reembed_stop.wait((time.perf_counter() - started) * (1 / cpu_fraction - 1))
+                else:
+                    self.reembed_progress['state'] = 'stopped'
+                    logger.info(f"Stopped re-embedding into vector set {vector_set_id}")
+                    return False
+        except Exception as e:
+            self.reembed_progress.update(state='failed', error=str(e))
+            logger.error(f"Re-embedding with {model_name} failed: {e}")
+            return False
+
+        self.refresh_vector_set()
+        self.reembed_progress['state'] = 'done'
+        logger.info(f"Activated vector set {vector_set_id} ({model_name})")
+        return True
+
+    def stage_embeddings(self, cursor: sqlite3.Cursor, vector_set_id: int, encoder, limit: Optional[int]) -> int:
+        """Embed up to `limit` (None: all) documents not yet staged for `vector_set_id`; returns how many."""
+        cursor.execute('SELECT id, content FROM documents WHERE id NOT IN '
+                       '(SELECT document_id FROM vector_set_embeddings WHERE vector_set_id = ?) '
+                       'ORDER BY id LIMIT ?', (vector_set_id, -1 if limit is None else limit))
+        rows = cursor.fetchall()
+        if rows:
+            embeddings = encoder.encode([content for _, content in rows])
+            cursor.executemany('INSERT OR REPLACE INTO vector_set_embeddings (vector_set_id, document_id, embedding) '
+                               'VALUES (?, ?, ?)',
+                               [(vector_set_id, doc_id, np.asarray(embedding, dtype=np.float32).tobytes())
+                                for (doc_id, _), embedding in zip(rows, embeddings)])
+        total, staged = cursor.execute('SELECT (SELECT COUNT(*) FROM documents), (SELECT COUNT(*) FROM '
+                                       'vector_set_embeddings WHERE vector_set_id = ?)', (vector_set_id,)).fetchone()
+        self.reembed_progress.update(staged=staged, total=total)
+        return len(rows)
+
+    def activate_vector_set(self, cursor: sqlite3.Cursor, vector_set_id: int):
+        """Copy a fully staged set into documents and make it the active one; the caller owns the transaction."""
+        existing = {row[1] for row in cursor.execute('PRAGMA table_info(documents)').fetchall()}
+        last_id = -1
+        while True:
+            # Keyset pagination, so only one batch of vectors is in memory at a time
+            rows = cursor.execute('SELECT document_id, embedding FROM vector_set_embeddings '
+                                  'WHERE vector_set_id = ? AND document_id > ? ORDER BY document_id LIMIT ?',
+                                  (vector_set_id, last_id, self.ACTIVATION_BATCH_SIZE)).fetchall()
+            if not rows:
+                break
+            updates = []
+            for doc_id, embedding in rows:
+                columns = self.embedding_columns(np.frombuffer(embedding, dtype=np.float32))
+                # Quantized codes this class does not compute are cleared and backfilled by QuantizedRAGSystem
+                columns.update({name: None for name in QUANTIZED_COLUMNS if name in existing and name not in columns})
+                columns['vector_set_id'] = vector_set_id
+                updates.append([*columns.values(), doc_id])
+            cursor.executemany(f'UPDATE documents SET {", ".join(f"{name} = ?" for name in columns)} WHERE id = ?',
+                               updates)
+            last_id = rows[-1][0]
+        self.activate_extras(cursor, vector_set_id)
+        now = datetime.now().isoformat()
+        cursor.execute("UPDATE vector_sets SET status = 'retired' WHERE status IN ('active', 'building') AND id != ?",
+                       (vector_set_id,))
+        cursor.execute("UPDATE vector_sets SET status = 'active', activated_at = ? WHERE id = ?", (now, vector_set_id))
+        cursor.execute('DELETE FROM vector_set_embeddings')
+
+    def stop_reembedding(self, timeout: Optional[float] = 10.0):
+        """Stop a running re-embedding job; staged vectors are kept and the job resumes on the next start."""
+        self.reembed_stop.set()
+        if self.reembed_thread is not None:
+            self.reembed_thread.join(timeout)
+
+    def reembedding_status(self) -> Dict:
+        """Active vector set plus progress of the current (or last) re-embedding job."""
+        return {'active_vector_set': self.vector_set_id, 'model_name': self.model_name,
+                'dimension': self.embedding_dim, 'target_model_name': self.target_model_name,
+                'running': self.reembed_thread is not None and self.reembed_thread.is_alive(),
+                **self.reembed_progress}
+
+    def close(self):
+        self.stop_reembedding()
+        # Connections are opened per operation by get_db_connection(), nothing is held open between calls
+        logger.info("Closed RAG system")
+
+
+class StandardRAGSystem(RAGQueryMixin, BaseRAGSystem):
+    def get_relevant_documents(self, query: str, top_k: int = 3,
+                               filters: Optional[Dict] = None) -> List[Tuple[int, str, str, float]]:
+        try:
+            query_embedding = self.encode_query(query)
+            hits = self.vector_search(query_embedding, top_k, filters=filters)
+            documents = self.get_documents_by_ids([doc_id for doc_id, _ in hits])
+            similarities = [(doc_id, *documents[doc_id], score) for doc_id, score in hits if doc_id in documents]
+            logger.info(f"Retrieved top {top_k} relevant documents for query")
+            return similarities
+        except Exception as e:
+            logger.error(f"Error in getting relevant documents: {e}")
+            raise RAGException(f"Retrieval of relevant documents failed: {e}")
+
+    def get_relevant_documents_batch(self, queries: List[str], top_k: int = 3,
+                                     filters: Optional[Dict] = None) -> List[List[Tuple[int, str, str, float]]]:
+        """
+        Retrieve documents for many queries with one encode batch and one similarity product.
+
+        :param queries: Queries to retrieve documents for
+        :param top_k: Number of documents per query
+        :param filters: Optional metadata filter shared by all queries
+        :return: One list of (id, title, content, score) per query, in the order of `queries`
+        """
+        if not queries:
+            return []
+        try:
+            query_embeddings = self.encode_queries(list(queries))
+            hits_per_query = self.vector_search_batch(query_embeddings, top_k, filters=filters)
+            # One fetch for every document any query needs
+            needed_ids = {doc_id for hits in hits_per_query for doc_id, _ in hits}
+            documents = self.get_documents_by_ids(list(needed_ids))
+            logger.info(f"Retrieved top {top_k} relevant documents for {len(queries)} queries")
+            return [[(doc_id, *documents[doc_id], score) for doc_id, score in hits if doc_id in documents]
+                    for hits in hits_per_query]
+        except Exception as e:
+            logger.error(f"Error in batch retrieval of relevant documents: {e}")
+            raise RAGException(f"Batch retrieval of relevant documents failed: {e}")
+
+
+class HyDERAGSystem(BaseRAGSystem):
+    HYDE_PROMPT_TEMPLATE = "Given the question '{query}', write a short paragraph that would answer this question. Do not include the question itself in your response."
+
+    def __init__(self, db_path: str, model_name: Optional[str] = None):
+        super().__init__(db_path, model_name)
+        # Generations are keyed by normalized query + LLM + prompt template, so re-asked questions skip the LLM
+        self.hyde_cache = create_text_cache('hyde_documents')
+
+    def generate_hypothetical_document(self, query: str, llm_function: Callable[[str], str]) -> str:
+        try:
+            key = make_cache_key(normalize_query(query), llm_function_id(llm_function), self.HYDE_PROMPT_TEMPLATE)
+            hypothetical_doc = self.hyde_cache.get(key)
+            if hypothetical_doc is not None:
+                logger.info("Using cached hypothetical document")
+                return hypothetical_doc
+            prompt = self.HYDE_PROMPT_TEMPLATE.format(query=query)
+            hypothetical_doc = llm_function(prompt)
+            self.hyde_cache.put(key, hypothetical_doc)
+            logger.info("Generated hypothetical document")
+            return hypothetical_doc
+        except Exception as e:
+            logger.error(f"Error generating hypothetical document: {e}")
+            raise RAGException(f"Hypothetical document generation failed: {e}")
+
+    def get_relevant_documents(self, query: str, llm_function: Callable[[str], str], top_k: int = 3,
+                               filters: Optional[Dict] = None) -> List[Tuple[int, str, str, float]]:
+        try:
+            hypothetical_doc = self.generate_hypothetical_document(query, llm_function)
+            hyde_embedding = self.encode_query(hypothetical_doc)
+
+            hits = self.vector_search(hyde_embedding, top_k, filters=filters)
+            documents = self.get_documents_by_ids([doc_id for doc_id, _ in hits])
+            similarities = [(doc_id, *documents[doc_id], score) for doc_id, score in hits if doc_id in documents]
+            logger.info(f"Retrieved top {top_k} relevant documents using HyDE")
+            return similarities
+        except Exception as e:
+            logger.error(f"Error in getting relevant documents with HyDE: {e}")
+            raise RAGException(f"HyDE retrieval of relevant documents failed: {e}")
+
+    def rag_query(self, query: str, llm_function: Callable[[str], str], top_k: int = 3,
+                  filters: Optional[Dict] = None) -> str:
+        try:
+            if self.answer_cache is not None:
+                # Looked up by the question itself, so a hit also skips generating the hypothetical document
+                scope_key = self.answer_scope(llm_function, top_k, filters)
+                query_embedding = self.encode_query(query)
+                cached = self.answer_cache.get(scope_key, query_embedding)
+                if cached is not None:
+                    logger.info(f"Served answer from the semantic answer cache: {self.answer_cache.stats()}")
+                    return cached
+
+            relevant_docs = self.get_relevant_documents(query, llm_function, top_k, filters=filters)
+            packed_docs = self.pack_documents(relevant_docs)
+            llm_prompt = build_rag_prompt(query, packed_docs)
+
+            response = llm_function(llm_prompt)
+            if self.answer_cache is not None:
+                self.cache_answer(scope_key, query_embedding, response, packed_docs)
+            logger.info("Generated response for query using HyDE")
+            return response
+        except Exception as e:
+            logger.error(f"Error in HyDE RAG query: {e}")
+            raise RAGException(f"HyDE RAG query failed: {e}")
+
+
+class HybridRAGSystem(StandardRAGSystem):
+    """
+    Lexical (FTS5/BM25) + vector retrieval, run concurrently and fused into one ranking.
+
+    BM25 catches exact names and numbers that embeddings blur together, the vector side catches paraphrases.
+    Per-stage timings of the last query are kept in `last_timings` (milliseconds).
+    """
+
+    def __init__(self, db_path: str, model_name: Optional[str] = None, fusion: str = 'rrf', alpha: float = 0.5,
+                 rrf_k: int = 60, candidate_multiplier: int = 4):
+        """
+        Initialize the hybrid RAG system.
+
+        :param db_path: Path to the SQLite database
+        :param model_name: Name of the SentenceTransformer model to use
+        :param fusion: 'rrf' (reciprocal rank fusion) or 'weighted' (weighted sum of normalized scores)
+        :param alpha: Weight of the vector results, the lexical results get 1 - alpha
+        :param rrf_k: Damping constant for reciprocal rank fusion
+        :param candidate_multiplier: Each retriever returns top_k * candidate_multiplier candidates for fusion
+        """
+        if fusion not in ('rrf', 'weighted'):
+            raise RAGException(f"Unknown fusion method: {fusion}")
+        super().__init__(db_path, model_name)
+        self.fusion = fusion
+        self.alpha = alpha
+        self.rrf_k = rrf_k
+        self.candidate_multiplier = candidate_multiplier
+        self.executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='hybrid-rag')
+        self.last_timings: Dict[str, float] = {}
+
+    def _timed(self, func: Callable, *args) -> Tuple[list, float]:
+        start = time.perf_counter()
+        result = func(*args)
+        return result, (time.perf_counter() - start) * 1000
+
+    def _vector_candidates(self, query: str, num_candidates: int,
+                           filters: Optional[Dict] = None) -> List[Tuple[int, float]]:
+        return self.vector_search(self.encode_query(query), num_candidates, filters=filters)
+
+    def get_relevant_documents_with_timings(self, query: str, top_k: int = 3, filters: Optional[Dict] = None) -> Tuple[
+        List[Tuple[int, str, str, float]], Dict[str, float]]:
+        try:
+            start = time.perf_counter()
+            num_candidates = top_k * self.candidate_multiplier
+            lexical_future = self.executor.submit(self._timed, self.lexical_search, query, num_candidates, filters)
+            vector_future = self.executor.submit(self._timed, self._vector_candidates, query, num_candidates,
+                                                 filters)
+            lexical_hits, lexical_ms = lexical_future.result()
+            vector_hits, vector_ms = vector_future.result()
+
+            fusion_start = time.perf_counter()
+            if self.fusion == 'rrf':
+                fused = reciprocal_rank_fusion([vector_hits, lexical_hits], k=self.rrf_k,
+                                               weights=[self.alpha, 1 - self.alpha])
+            else:
+                fused = weighted_score_fusion([vector_hits, lexical_hits], weights=[self.alpha, 1 - self.alpha])
+            fused = fused[:top_k]
+            documents = self.get_documents_by_ids([doc_id for doc_id, _ in fused])
+            results = [(doc_id, *documents[doc_id], score) for doc_id, score in fused if doc_id in documents]
+            fusion_ms = (time.perf_counter() - fusion_start) * 1000
+
+            timings = {
+                'lexical_ms': lexical_ms,
+                'vector_ms': vector_ms,
+                'fusion_ms': fusion_ms,
+                'total_ms': (time.perf_counter() - start) * 1000,
+            }
+            logger.info(f"Retrieved top {top_k} relevant documents with hybrid search "
+                        f"({len(lexical_hits)} lexical / {len(vector_hits)} vector candidates): {timings}")
+            return results, timings
+        except RAGException:
+            raise
+        except Exception as e:
+            logger.error(f"Error in hybrid retrieval: {e}")
+            raise RAGException(f"Hybrid retrieval of relevant documents failed: {e}")
+
+    def get_relevant_documents(self, query: str, top_k: int = 3,
+                               filters: Optional[Dict] = None) -> List[Tuple[int, str, str, float]]:
+        results, self.last_timings = self.get_relevant_documents_with_timings(query, top_k, filters)
+        return results
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        super().close()
+
+
+class QuantizedRAGSystem(StandardRAGSystem):
+    """
+    Vector search over compact quantized codes, re-scored against full-precision vectors.
+
+    Only the codes are held in memory: int8 codes are ~4x smaller than float32, sign-bit codes ~32x.
+    The first pass scores every code (int8 dot products or popcount Hamming distances), then the best
+    top_k * rescore_multiplier candidates have their float32 embeddings loaded from SQLite and are re-ranked
+    by exact cosine similarity.
+    """
+
+    QUANTIZATIONS = ('int8', 'binary')
+
+    def __init__(self, db_path: str, model_name: Optional[str] = None, quantization: str = 'int8',
+                 rescore_multiplier: Optional[int] = None, block_size: int = 65536):
+        """
+        Initialize the quantized RAG system.
+
+        :param db_path: Path to the SQLite database
+        :param model_name: Name of the SentenceTransformer model to use
+        :param quantization: 'int8' (scalar) or 'binary' (sign bit)
+        :param rescore_multiplier: Candidates re-scored per result; defaults to 4 for int8 and 10 for binary
+        :param block_size: Rows scored per block in the first pass, bounds temporary memory
+        """
+        if quantization not in self.QUANTIZATIONS:
+            raise RAGException(f"Unknown quantization: {quantization}")
+        self.quantization = quantization
+        self.rescore_multiplier = rescore_multiplier or (4 if quantization == 'int8' else 10)
+        self.block_size = block_size
+        self.index_lock = threading.Lock()
+        self.index = None
+        super().__init__(db_path, model_name)
+
+    def init_db(self):
+        super().init_db()
+        try:
+            with self.get_db_connection() as conn:
+                cursor = conn.cursor()
+                self.add_missing_columns(cursor, 'documents', {
+                    'embedding_int8': 'BLOB',
+                    'embedding_scale': 'REAL',
+                    'embedding_binary': 'BLOB',
+                })
+                conn.commit()
+        except sqlite3.Error as e:
+            logger.error(f"Failed to add quantization columns: {e}")
+            raise RAGException(f"Database schema initialization failed: {e}")
+
+    def embedding_columns(self, embedding: np.ndarray) -> Dict[str, object]:
+        columns = super().embedding_columns(embedding)
+        codes, scales = quantize_int8(embedding)
+        columns['embedding_int8'] = codes[0].tobytes()
+        columns['embedding_scale'] = float(scales[0])
+        columns['embedding_binary'] = quantize_binary(embedding)[0].tobytes()
+        return columns
+
+    def add_documents(self, documents: List[Tuple[str, str]], metadata: Optional[List[Dict]] = None):
+        super().add_documents(documents, metadata)
+        with self.index_lock:
+            self.index = None
+
+    def on_vector_set_activated(self):
+        with self.index_lock:
+            self.index = None
+
+    def backfill_codes(self):
+        """Quantize rows that were stored before quantization was enabled."""
+        with self.get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT id, embedding FROM documents '
+                           'WHERE embedding_int8 IS NULL OR embedding_binary IS NULL')
+            rows = cursor.fetchall()
+            for doc_id, embedding in rows:
+                columns = self.embedding_columns(np.frombuffer(embedding, dtype=np.float32))
+                cursor.execute('UPDATE documents SET embedding_int8 = ?, embedding_scale = ?, embedding_binary = ? '
+                               'WHERE id = ?', (columns['embedding_int8'], columns['embedding_scale'],
+                                                columns['embedding_binary'], doc_id))
+            conn.commit()
+        if rows:
+            logger.info(f"Backfilled quantized codes for {len(rows)} documents")
+
+    def load_index(self) -> Dict[str, np.ndarray]:
+        """Load (once) the in-memory code index; the float32 embeddings are never loaded here."""
+        with self.index_lock:
+            if self.index is not None:
+                return self.index
+            try:
+                self.backfill_codes()
+                with self.get_db_connection() as conn:
+                    cursor = conn.cursor()
+                    if self.quantization == 'int8':
+                        cursor.execute('SELECT id, embedding_int8, embedding_scale FROM documents ORDER BY id')
+                        rows = cursor.fetchall()
+                        index = {
+                            'ids': np.array([row[0] for row in rows], dtype=np.int64),
+                            'codes': np.vstack([np.frombuffer(row[1], dtype=np.int8) for row in rows])
+                            if rows else np.empty((0, 0), dtype=np.int8),
+                            'scales': np.array([row[2] for row in rows], dtype=np.float32),
+                        }
+                    else:
+                        cursor.execute('SELECT id, embedding_binary FROM documents ORDER BY id')
+                        rows = cursor.fetchall()
+                        index = {
+                            'ids': np.array([row[0] for row in rows], dtype=np.int64),
+                            'codes': np.vstack([np.frombuffer(row[1], dtype=np.uint8) for row in rows])
+                            if rows else np.empty((0, 0), dtype=np.uint8),
+                        }
+            except sqlite3.Error as e:
+                logger.error(f"Failed to load quantized index: {e}")
+                raise RAGException(f"Quantized index load failed: {e}")
+            self.index = index
+            logger.info(f"Loaded {self.quantization} index of {len(index['ids'])} documents "
+                        f"({self.index_nbytes()} bytes)")
+            return index
+
+    def index_nbytes(self) -> int:
+        """Memory held by the in-memory code index, in bytes."""
+        return sum(array.nbytes for array in (self.index or {}).values())
+
+    def filter_positions(self, filters: Optional[Dict]) -> Optional[np.ndarray]:
+        """
+        Rows of the in-memory index that match a metadata filter.
+
+        :param filters: Optional metadata filter
+        :return: Positions into the index (ids are sorted, so a binary search maps ids to rows), or None if unfiltered
+        """
+        if not filters:
+            return None
+        index_ids = self.load_index()['ids']
+        matching_ids = self.filter_document_ids(filters)
+        positions = np.searchsorted(index_ids, matching_ids)
+        in_range = positions < len(index_ids)
+        positions, matching_ids = positions[in_range], matching_ids[in_range]
+        return positions[index_ids[positions] == matching_ids]
+
+    def approximate_scores(self, query_embedding: np.ndarray,
+                           positions: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        First-pass scores of the indexed documents against the query; higher is better.
+
+        :param query_embedding: Embedding of the query
+        :param positions: Optional index rows to score (see filter_positions); all rows when None
+        :return: (ids, scores) of the scored rows
+        """
+        index = self.load_index()
+        ids, codes = index['ids'], index['codes']
+        scales = index.get('scales')
+        if positions is not None:
+            # Pre-filtered: only the matching rows are gathered and scored
+            ids, codes = ids[positions], codes[positions]
+            scales = scales[positions] if scales is not None else None
+        if len(ids) == 0:
+            return ids, np.empty(0, dtype=np.float32)
+        if self.quantization == 'int8':
+            query_codes, query_scales = quantize_int8(query_embedding)
+            query_codes = query_codes[0].astype(np.int32)
+            scores = np.empty(len(ids), dtype=np.float32)
+            for start in range(0, len(ids), self.block_size):
+                block = codes[start:start + self.block_size].astype(np.int32)
+                scores[start:start + self.block_size] = block @ query_codes
+            return ids, scores * scales * query_scales[0]
+        query_code = quantize_binary(query_embedding)[0]
+        distances = np.empty(len(ids), dtype=np.int32)
+        for start in range(0, len(ids), self.block_size):
+            distances[start:start + self.block_size] = hamming_distances(codes[start:start + self.block_size],
+                                                                         query_code)
+        return ids, -distances.astype(np.float32)
+
+    def vector_search(self, query_embedding: np.ndarray, top_k: int = 3, rescore: bool = True,
+                      filters: Optional[Dict] = None, positions: Optional[np.ndarray] = None) -> List[
+        Tuple[int, float]]:
+        if positions is None:
+            positions = self.filter_positions(filters)
+        ids, scores = self.approximate_scores(query_embedding, positions)
+        if len(ids) == 0:
+            return []
+        if not rescore:
+            return [(int(ids[i]), float(scores[i])) for i in top_k_indices(scores, top_k)]
+
+        candidate_ids = [int(ids[i]) for i in top_k_indices(scores, top_k * self.rescore_multiplier)]
+        embeddings = self.get_embeddings_by_ids(candidate_ids)
+        candidate_ids = [doc_id for doc_id in candidate_ids if doc_id in embeddings]
+        if not candidate_ids:
+            return []
+        matrix = normalize_rows(np.vstack([embeddings[doc_id] for doc_id in candidate_ids]))
+        exact_scores = matrix @ normalize_rows(np.asarray(query_embedding, dtype=np.float32))
+        return [(candidate_ids[i], float(exact_scores[i])) for i in top_k_indices(exact_scores, top_k)]
+
+    def vector_search_batch(self, query_embeddings: np.ndarray, top_k: int = 3, block_size: int = 256,
+                            filters: Optional[Dict] = None) -> List[List[Tuple[int, float]]]:
+        # Resolve the filter once for the whole batch
+        positions = self.filter_positions(filters)
+        return [self.vector_search(query_embedding, top_k, positions=positions)
+                for query_embedding in np.atleast_2d(np.asarray(query_embeddings, dtype=np.float32))]
+
+
+class HierarchicalRAGSystem(StandardRAGSystem):
+    """
+    Summary-first retrieval: find candidate media by their summary embeddings, then search only their chunks.
+
+    Media summaries live in media_summaries (one row per media item, synced from the media database's
+    MediaModifications / MediaVersion summaries). The summary matrix is small (one row per media item) and kept in
+    memory; chunk search is restricted to the candidate media through the media_id pre-filter, so per-query
+    scoring cost follows the number of relevant media rather than the total chunk count.
+    """
+
+    def __init__(self, db_path: str, model_name: Optional[str] = None, num_candidate_media: int = 5):
+        """
+        Initialize the hierarchical RAG system.
+
+        :param db_path: Path to the SQLite database
+        :param model_name: Name of the SentenceTransformer model to use
+        :param num_candidate_media: Number of media whose chunks are searched per query
+        """
+        self.num_candidate_media = num_candidate_media
+        self.summary_lock = threading.Lock()
+        self.summary_index = None
+        self.summary_index_version = None
+        super().__init__(db_path, model_name)
+
+    def init_db(self):
+        super().init_db()
+        try:
+            with self.get_db_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                CREATE TABLE IF NOT EXISTS media_summaries (
+                    media_id INTEGER PRIMARY KEY,
+                    title TEXT,
+                    summary TEXT,
+                    summary_hash TEXT,
+                    embedding BLOB,
+                    updated_at TEXT
+                )
+                ''')
+                # Summary vectors of a 'building' vector set, staged by stage_extras() like vector_set_embeddings
+                cursor.execute('''
+                CREATE TABLE IF NOT EXISTS vector_set_summary_embeddings (
+                    vector_set_id INTEGER NOT NULL,
+                    media_id INTEGER NOT NULL,
+                    summary_hash TEXT,
+                    embedding BLOB,
+                    PRIMARY KEY (vector_set_id, media_id)
+                ) WITHOUT ROWID
+                ''')
+                conn.commit()
+        except sqlite3.Error as e:
+            logger.error(f"Failed to create media_summaries table: {e}")
+            raise RAGException(f"Database schema initialization failed: {e}")
+
+    def add_media_summaries(self, summaries: List[Tuple[int, str, str]]):
+        """
+        Embed and store (or replace) media summaries.
+
+        :param summaries: List of (media_id, title, summary)
+        """
+        if not summaries:
+            return
+        try:
+            embeddings = self.model.encode([f"{title}\n{summary}" for _, title, summary in summaries])
+            # Microseconds, so load_summary_index() notices back-to-back replacements
+            updated_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')
+            with self.get_db_connection() as conn:
+                conn.executemany(
+                    'INSERT OR REPLACE INTO media_summaries (media_id, title, summary, summary_hash, embedding, '
+                    'updated_at) VALUES (?, ?, ?, ?, ?, ?)',
+                    [(int(media_id), title, summary, make_cache_key(title, summary),
+                      np.asarray(embedding, dtype=np.float32).tobytes(), updated_at)
+                     for (media_id, title, summary), embedding in zip(summaries, embeddings)]
+                )
+                conn.commit()
+            logger.info(f"Stored {len(summaries)} media summaries")
+        except Exception as e:
+            logger.error(f"Failed to add media summaries: {e}")
+            raise RAGException(f"Media summary addition failed: {e}")
+
+    def stage_extras(self, cursor: sqlite3.Cursor, vector_set_id: int, encoder) -> int:
+        """Embed the summaries not staged yet for `vector_set_id`, or changed since they were staged."""
+        rows = cursor.execute('''
+        SELECT media_id, title, summary, summary_hash FROM media_summaries
+        WHERE NOT EXISTS (SELECT 1 FROM vector_set_summary_embeddings AS staged
+                          WHERE staged.vector_set_id = ? AND staged.media_id = media_summaries.media_id
+                          AND staged.summary_hash IS media_summaries.summary_hash)
+        ''', (vector_set_id,)).fetchall()
+        if rows:
+            embeddings = encoder.encode([f"{title}\n{summary}" for _, title, summary, _ in rows])
+            cursor.executemany('INSERT OR REPLACE INTO vector_set_summary_embeddings '
+                               '(vector_set_id, media_id, summary_hash, embedding) VALUES (?, ?, ?, ?)',
+                               [(vector_set_id, media_id, summary_hash,
+                                 np.asarray(embedding, dtype=np.float32).tobytes())
+                                for (media_id, _, _, summary_hash), embedding in zip(rows, embeddings)])
+        return len(rows)
+
+    def activate_extras(self, cursor: sqlite3.Cursor, vector_set_id: int):
+        updated_at = datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')
+        cursor.execute('''
+        UPDATE media_summaries SET updated_at = ?, embedding = (
+            SELECT embedding FROM vector_set_summary_embeddings AS staged
+            WHERE staged.vector_set_id = ? AND staged.media_id = media_summaries.media_id)
+        WHERE media_id IN (SELECT media_id FROM vector_set_summary_embeddings WHERE vector_set_id = ?)
+        ''', (updated_at, vector_set_id, vector_set_id))
+        cursor.execute('DELETE FROM vector_set_summary_embeddings')
+
+    def sync_media_summaries(self, media_db_path: Optional[str] = None) -> int:
+        """
+        Bring media_summaries up to date with the latest summary of each media item in the media database.
+
+        The latest MediaModifications summary wins, then the latest MediaVersion, then Media.summary. Only new or
+        changed summaries are re-embedded; media that no longer exist are removed.
+
+        :param media_db_path: Path to the media database (default: DB_NAME, like SQLite_DB)
+        :return: Number of summaries (re-)embedded
+        """
+        media_db_path = media_db_path or os.getenv('DB_NAME', 'media_summary.db')
+        try:
+            with closing(sqlite3.connect(media_db_path)) as media_conn:
+                rows = media_conn.execute('''
+                SELECT Media.id, Media.title, COALESCE(
+                    (SELECT summary FROM MediaModifications
+                     WHERE media_id = Media.id AND summary IS NOT NULL AND summary != ''
+                     ORDER BY id DESC LIMIT 1),
+                    (SELECT summary FROM MediaVersion
+                     WHERE media_id = Media.id AND summary IS NOT NULL AND summary != ''
+                     ORDER BY version DESC LIMIT 1),
+                    NULLIF(Media.summary, '')
+                ) AS summary
+                FROM Media
+                ''').fetchall()
+            with self.get_db_connection() as conn:
+                stored = dict(conn.execute('SELECT media_id, summary_hash FROM media_summaries').fetchall())
+                current_ids = {media_id for media_id, _, summary in rows if summary}
+                removed = [(media_id,) for media_id in stored if media_id not in current_ids]
+                conn.executemany('DELETE FROM media_summaries WHERE media_id = ?', removed)
+                conn.commit()
+        except sqlite3.Error as e:
+            logger.error(f"Failed to sync media summaries: {e}")
+            raise RAGException(f"Media summary sync failed: {e}")
+
+        changed = [(media_id, title, summary) for media_id, title, summary in rows
+                   if summary and stored.get(media_id) != make_cache_key(title, summary)]
+        self.add_media_summaries(changed)
+        logger.info(f"Synced media summaries: {len(changed)} embedded, {len(removed)} removed")
+        return len(changed)
+
+    def load_summary_index(self) -> Tuple[np.ndarray, np.ndarray]:
+        """The (media ids, normalized summary matrix) index, reloaded only when media_summaries changed."""
+        try:
+            with self.get_db_connection() as conn:
+                version = conn.execute('SELECT COUNT(*), MAX(updated_at) FROM media_summaries').fetchone()
+                with self.summary_lock:
+                    if self.summary_index is not None and self.summary_index_version == version:
+                        return self.summary_index
+                    rows = conn.execute('SELECT media_id, embedding FROM media_summaries').fetchall()
+                    self.summary_index = embedding_rows_to_matrix(rows)
+                    self.summary_index_version = version
+                    return self.summary_index
+        except sqlite3.Error as e:
+            logger.error(f"Failed to load media summary index: {e}")
+            raise RAGException(f"Media summary index load failed: {e}")
+
+    def candidate_media(self, query_embedding: np.ndarray, num_media: Optional[int] = None,
+                        allowed_media: Optional[List[int]] = None) -> List[Tuple[int, float]]:
+        """
+        First level: the media whose summaries best match the query.
+
+        :param query_embedding: Embedding of the query
+        :param num_media: Number of media to return (default num_candidate_media)
+        :param allowed_media: Only consider these media ids
+        :return: List of (media id, similarity), best first; empty if no summaries are stored
+        """
+        media_ids, matrix = self.load_summary_index()
+        if allowed_media is not None and len(media_ids):
+            keep = np.isin(media_ids, np.asarray(allowed_media, dtype=np.int64))
+            media_ids, matrix = media_ids[keep], matrix[keep]
+        if len(media_ids) == 0:
+            return []
+        scores = matrix @ normalize_rows(np.asarray(query_embedding, dtype=np.float32))
+        return [(int(media_ids[i]), float(scores[i]))
+                for i in top_k_indices(scores, num_media or self.num_candidate_media)]
+
+    def get_relevant_documents(self, query: str, top_k: int = 3, filters: Optional[Dict] = None,
+                               num_media: Optional[int] = None) -> List[Tuple[int, str, str, float]]:
+        try:
+            query_embedding = self.encode_query(query)
+            chunk_filters = dict(filters or {})
+            allowed_media = None
+            if chunk_filters.get('media_id') is not None:
+                allowed_media = [int(media_id) for media_id in _as_list(chunk_filters['media_id'])]
+            candidates = self.candidate_media(query_embedding, num_media, allowed_media)
+            if candidates:
+                chunk_filters['media_id'] = [media_id for media_id, _ in candidates]
+            # Without (matching) summaries this is a plain filtered search over all chunks
+            hits = self.vector_search(query_embedding, top_k, filters=chunk_filters)
+            documents = self.get_documents_by_ids([doc_id for doc_id, _ in hits])
+            logger.info(f"Retrieved top {top_k} relevant documents from {len(candidates)} candidate media")
+            return [(doc_id, *documents[doc_id], score) for doc_id, score in hits if doc_id in documents]
+        except RAGException:
+            raise
+        except Exception as e:
+            logger.error(f"Error in hierarchical retrieval: {e}")
+            raise RAGException(f"Hierarchical retrieval of relevant documents failed: {e}")
+
+    def get_relevant_documents_batch(self, queries: List[str], top_k: int = 3,
+                                     filters: Optional[Dict] = None) -> List[List[Tuple[int, str, str, float]]]:
+        # Each query searches its own candidate media, so queries can't share one similarity product
+        self.encode_queries(list(queries))
+        return [self.get_relevant_documents(query, top_k, filters) for query in queries]
+
+
+class ShardedRAGSystem(RAGQueryMixin):
+    """
+    RAG store partitioned into shards, each a RAG system with its own SQLite file, queried by scatter-gather.
+
+    Documents are routed to a shard by a stable hash of their media_id (or of their 'collection' metadata), so all
+    chunks of one media item live together and a filter on the shard key only queries the shards that can match;
+    the filter itself is still applied within those shards, as every other metadata filter is. A query is encoded
+    once per embedding model in use, every shard searches in parallel on a thread pool (NumPy scoring and SQLite
+    release the GIL), and the per-shard top-k lists are merged into the global top-k.
+
+    Document ids are global: local_id * num_shards + shard. Per-shard latencies of recent queries are kept for
+    shard_latency_stats(), and the timings of the last query in `last_timings` (milliseconds).
+    """
+
+    SHARD_KEYS = ('media_id', 'collection')
+
+    def __init__(self, db_path: str, model_name: Optional[str] = None, num_shards: int = 4,
+                 shard_class: type = StandardRAGSystem, shard_by: str = 'media_id', max_workers: Optional[int] = None,
+                 shard_kwargs: Optional[Dict] = None, latency_window: int = 1000):
+        """
+        Initialize the sharded RAG system.
+
+        :param db_path: Base path of the shard databases; shard i is stored in '<db_path>.shard<i>.db'
+        :param model_name: Name of the SentenceTransformer model to use
+        :param num_shards: Number of shards; changing it for an existing store requires re-ingestion
+        :param shard_class: RAG system class of every shard, e.g. StandardRAGSystem or QuantizedRAGSystem
+        :param shard_by: Metadata key documents are routed by: 'media_id' or 'collection'
+        :param max_workers: Threads querying shards in parallel (default: one per shard)
+        :param shard_kwargs: Extra keyword arguments for shard_class, e.g. {'quantization': 'binary'}
+        :param latency_window: Number of recent per-shard latencies kept for shard_latency_stats()
+        """
+        if num_shards < 1:
+            raise RAGException("num_shards must be at least 1")
+        if shard_by not in self.SHARD_KEYS:
+            raise RAGException(f"Unknown shard key: {shard_by}")
+        self.db_path = db_path
+        self.num_shards = num_shards
+        self.shard_by = shard_by
+        self.shards = [shard_class(self.shard_path(shard), model_name, **(shard_kwargs or {}))
+                       for shard in range(num_shards)]
+        self.executor = ThreadPoolExecutor(max_workers=max_workers or num_shards, thread_name_prefix='rag-shard')
+        self.latencies = [deque(maxlen=latency_window) for _ in range(num_shards)]
+        self.last_timings: Dict[str, float] = {}
+        self.answer_cache: Optional[SemanticAnswerCache] = None
+        self.context_token_budget = self.shards[0].context_token_budget
+        self.token_counter = self.shards[0].token_counter
+        logger.info(f"Initialized {num_shards} {shard_class.__name__} shards at {db_path}")
+
+    def shard_path(self, shard: int) -> str:
+        return f"{self.db_path}.shard{shard}.db"
+
+    def shard_for_key(self, value) -> int:
+        """Shard owning a media_id / collection value; crc32 is stable across processes, unlike hash()."""
+        return zlib.crc32(str(value).encode('utf-8')) % self.num_shards
+
+    def shard_for(self, title: str, content: str, metadata: Optional[Dict]) -> int:
+        value = (metadata or {}).get(self.shard_by)
+        if value is None:
+            # Unkeyed documents are spread by content
+            return zlib.crc32(f"{title}\x1f{content}".encode('utf-8')) % self.num_shards
+        return self.shard_for_key(value)
+
+    def global_id(self, shard: int, local_id: int) -> int:
+        return int(local_id) * self.num_shards + shard
+
+    def local_id(self, global_id: int) -> Tuple[int, int]:
+        """(shard, id within the shard) of a global document id."""
+        return int(global_id) % self.num_shards, int(global_id) // self.num_shards
+
+    def add_documents(self, documents: List[Tuple[str, str]], metadata: Optional[List[Dict]] = None):
+        """
+        Route documents to their shards and add them there (shards are written in parallel).
+
+        :param documents: List of (title, content)
+        :param metadata: Optional list of metadata dicts, see BaseRAGSystem.add_documents(); with shard_by='collection'
+            the 'collection' key also selects the shard
+        """
+        if metadata is not None and len(metadata) != len(documents):
+            raise RAGException("metadata must have one entry per document")
+        batches = {}
+        for i, (title, content) in enumerate(documents):
+            document_metadata = metadata[i] if metadata else None
+            docs, metas = batches.setdefault(self.shard_for(title, content, document_metadata), ([], []))
+            docs.append((title, content))
+            metas.append(document_metadata or {})
+        futures = [self.executor.submit(self.shards[shard].add_documents, docs, metas)
+                   for shard, (docs, metas) in batches.items()]
+        for future in futures:
+            future.result()
+        logger.info(f"Added {len(documents)} documents to {len(batches)} shards")
+
+    def target_shards(self, filters: Optional[Dict]) -> Tuple[List[int], Optional[Dict]]:
+        """Shards that can match `filters` (pruned by the shard key), and the filters to pass on to them."""
+        filters = dict(filters or {})
+        if self.shard_by == 'collection' and filters.get('collection') is not None:
+            # Several collections can share a shard, so the collection filter is passed on as well
+            shards = sorted({self.shard_for_key(value) for value in _as_list(filters['collection'])})
+        elif self.shard_by == 'media_id' and filters.get('media_id') is not None:
+            shards = sorted({self.shard_for_key(int(value)) for value in _as_list(filters['media_id'])})
+        else:
+            shards = list(range(self.num_shards))
+        return shards, filters or None
+
+    def encode_query(self, query: str) -> np.ndarray:
+        return self.shards[0].encode_query(query)
+
+    def shard_query_embeddings(self, shards: List[int], encode: Callable) -> Dict[int, np.ndarray]:
+        """Query embedding(s) per shard, encoded once per model (shards can differ while they re-embed)."""
+        by_model = {}
+        for shard in shards:
+            by_model.setdefault(self.shards[shard].current_encoder()[0], []).append(shard)
+        embeddings = {}
+        for model_shards in by_model.values():
+            embedding = encode(self.shards[model_shards[0]])
+            embeddings.update({shard: embedding for shard in model_shards})
+        return embeddings
+
+    def _timed_search(self, shard: int, search: Callable, *args, **kwargs):
+        start = time.perf_counter()
+        result = search(*args, **kwargs)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        self.latencies[shard].append(elapsed_ms)
+        return result, elapsed_ms
+
+    def vector_search(self, query_embedding: Optional[np.ndarray], top_k: int = 3, filters: Optional[Dict] = None,
+                      query: Optional[str] = None) -> List[Tuple[int, float]]:
+        """
+        Scatter a vector search to the shards and merge their top-k lists.
+
+        :param query_embedding: Query embedding, or None to encode `query` with each shard's model
+        :return: (global id, score) pairs, best first
+        """
+        hits, _ = self.scatter_gather(query_embedding, top_k, filters, query)
+        return hits
+
+    def scatter_gather(self, query_embedding: Optional[np.ndarray], top_k: int, filters: Optional[Dict],
+                       query: Optional[str] = None) -> Tuple[List[Tuple[int, float]], Dict[str, float]]:
+        shards, shard_filters = self.target_shards(filters)
+        if query_embedding is None:
+            embeddings = self.shard_query_embeddings(shards, lambda system: system.encode_query(query))
+        else:
+            embeddings = {shard: query_embedding for shard in shards}
+        futures = {shard: self.executor.submit(self._timed_search, shard, self.shards[shard].vector_search,
+                                               embeddings[shard], top_k, filters=shard_filters)
+                   for shard in shards}
+        merged, timings = [], {}
+        for shard, future in futures.items():
+            shard_hits, timings[f'shard_{shard}_ms'] = future.result()
+            merged.extend((self.global_id(shard, doc_id), score) for doc_id, score in shard_hits)
+        merged.sort(key=lambda hit: hit[1], reverse=True)
+        return merged[:top_k], timings
+
+    def get_relevant_documents_with_timings(self, query: str, top_k: int = 3, filters: Optional[Dict] = None) -> Tuple[
+        List[Tuple[int, str, str, float]], Dict[str, float]]:
+        try:
+            start = time.perf_counter()
+            hits, timings = self.scatter_gather(None, top_k, filters, query)
+            documents = self.get_documents_by_ids([doc_id for doc_id, _ in hits])
+            results = [(doc_id, *documents[doc_id], score) for doc_id, score in hits if doc_id in documents]
+            timings['total_ms'] = (time.perf_counter() - start) * 1000
+            logger.info(f"Retrieved top {top_k} relevant documents from {len(timings) - 1} shards: {timings}")
+            return results, timings
+        except RAGException:
+            raise
+        except Exception as e:
+            logger.error(f"Error in sharded retrieval: {e}")
+            raise RAGException(f"Sharded retrieval of relevant documents failed: {e}")
+
+    def get_relevant_documents(self, query: str, top_k: int = 3,
+                               filters: Optional[Dict] = None) -> List[Tuple[int, str, str, float]]:
+        results, self.last_timings = self.get_relevant_documents_with_timings(query, top_k, filters)
+        return results
+
+    def get_relevant_documents_batch(self, queries: List[str], top_k: int = 3,
+                                     filters: Optional[Dict] = None) -> List[List[Tuple[int, str, str, float]]]:
+        """Batched retrieval: every shard scores all queries in one vector_search_batch call, in parallel."""
+        if not queries:
+            return []
+        try:
+            shards, shard_filters = self.target_shards(filters)
+            embeddings = self.shard_query_embeddings(shards, lambda system: system.encode_queries(list(queries)))
+            futures = {shard: self.executor.submit(self._timed_search, shard, self.shards[shard].vector_search_batch,
+                                                   embeddings[shard], top_k, filters=shard_filters)
+                       for shard in shards}
+            merged = [[] for _ in queries]
+            for shard, future in futures.items():
+                hits_per_query, _ = future.result()
+                for query_hits, hits in zip(merged, hits_per_query):
+                    query_hits.extend((self.global_id(shard, doc_id), score) for doc_id, score in hits)
+            hits_per_query = [sorted(hits, key=lambda hit: hit[1], reverse=True)[:top_k] for hits in merged]
+            documents = self.get_documents_by_ids(list({doc_id for hits in hits_per_query for doc_id, _ in hits}))
+            logger.info(f"Retrieved top {top_k} relevant documents for {len(queries)} queries from {len(shards)} shards")
+            return [[(doc_id, *documents[doc_id], score) for doc_id, score in hits if doc_id in documents]
+                    for hits in hits_per_query]
+        except Exception as e:
+            logger.error(f"Error in sharded batch retrieval: {e}")
+            raise RAGException(f"Sharded batch retrieval of relevant documents failed: {e}")
+
+    def _by_shard(self, global_ids: List[int]) -> Dict[int, Dict[int, int]]:
+        """shard -> {local id: global id}"""
+        grouped = {}
+        for global_id in global_ids:
+            shard, local_id = self.local_id(global_id)
+            grouped.setdefault(shard, {})[local_id] = int(global_id)
+        return grouped
+
+    def get_documents_by_ids(self, ids: List[int]) -> Dict[int, Tuple[str, str]]:
+        documents = {}
+        for shard, local_ids in self._by_shard(ids).items():
+            for local_id, document in self.shards[shard].get_documents_by_ids(list(local_ids)).items():
+                documents[local_ids[local_id]] = document
+        return documents
+
+    def get_metadata_by_ids(self, ids: List[int]) -> Dict[int, Dict]:
+        metadata = {}
+        for shard, local_ids in self._by_shard(ids).items():
+            for local_id, info in self.shards[shard].get_metadata_by_ids(list(local_ids)).items():
+                metadata[local_ids[local_id]] = info
+        return metadata
+
+    def shard_latency_stats(self) -> Dict[int, Dict[str, float]]:
+        """p50 / p95 / max search latency (ms) of each shard over its recent queries."""
+        stats = {}
+        for shard, latencies in enumerate(self.latencies):
+            if latencies:
+                p50, p95 = np.percentile(latencies, [50, 95])
+                stats[shard] = {'queries': len(latencies), 'p50_ms': float(p50), 'p95_ms': float(p95),
+                                'max_ms': float(max(latencies))}
+        return stats
+
+    def answer_scope(self, llm_function: Callable, top_k: int, filters: Optional[Dict]) -> str:
+        return make_cache_key(type(self).__name__, os.path.abspath(self.db_path), self.num_shards,
+                              llm_function_id(llm_function), top_k,
+                              sorted((filters or {}).items(), key=lambda item: item[0]))
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        for shard in self.shards:
+            shard.close()
+        logger.info("Closed sharded RAG system")
+
+
+class AsyncRAGSystem:
+    """
+    asyncio front end over one of the RAG systems above, for serving many concurrent chat/RAG users.
+
+    Nothing blocks the event loop: query encoding and NumPy scoring run on a thread executor, SQLite reads use
+    aiosqlite when it is installed (the executor otherwise), and LLM calls run concurrently up to a limit.
+    LLM functions may be plain functions (run on their own executor) or coroutine functions (awaited directly);
+    every call is cancellable and can be given a timeout. A cancelled plain function keeps running in its
+    thread until it returns, but its result is dropped and its concurrency slot is released immediately.
+    """
+
+    def __init__(self, rag_system: BaseRAGSystem, max_concurrent_llm_calls: int = 8,
+                 llm_timeout: Optional[float] = None, executor=None):
+        """
+        Initialize the async RAG service.
+
+        :param rag_system: The synchronous RAG system whose database, model and caches are used
+        :param max_concurrent_llm_calls: Maximum number of LLM calls in flight at once
+        :param llm_timeout: Seconds before an LLM call is cancelled, None to wait indefinitely
+        :param executor: ThreadPoolExecutor for encoding, scoring and fallback SQLite reads; a small one is created
+            when not given. Process pools are rejected: the work runs bound methods of rag_system, whose model,
+            locks and caches cannot be pickled or shared with another process
+        """
+        if executor is not None and not isinstance(executor, ThreadPoolExecutor):
+            raise RAGException(f"AsyncRAGSystem needs a ThreadPoolExecutor, not {type(executor).__name__}")
+        self.rag_system = rag_system
+        self.llm_timeout = llm_timeout
+        self.owns_executor = executor is None
+        self.executor = executor or ThreadPoolExecutor(max_workers=max(2, (os.cpu_count() or 2) // 2),
+                                                       thread_name_prefix='async-rag')
+        # Blocking LLM clients get their own pool, so slow generations never starve encoding
+        self.llm_executor = ThreadPoolExecutor(max_workers=max_concurrent_llm_calls, thread_name_prefix='async-rag-llm')
+        self.llm_semaphore = asyncio.Semaphore(max_concurrent_llm_calls)
+
+    async def run_in_executor(self, func: Callable, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    async def fetch_all(self, sql: str, params=()) -> list:
+        """Run a read-only query against the RAG database without blocking the event loop."""
+        try:
+            if aiosqlite is not None:
+                async with aiosqlite.connect(self.rag_system.db_path) as db:
+                    async with db.execute(sql, params) as cursor:
+                        return list(await cursor.fetchall())
+            return await self.run_in_executor(self._fetch_all_sync, sql, params)
+        except sqlite3.Error as e:
+            logger.error(f"Failed async database read: {e}")
+            raise RAGException(f"Database read failed: {e}")
+
+    def _fetch_all_sync(self, sql: str, params) -> list:
+        with self.rag_system.get_db_connection() as conn:
+            return conn.execute(sql, params).fetchall()
+
+    async def encode_query(self, query: str) -> np.ndarray:
+        return await self.run_in_executor(self.rag_system.encode_query, query)
+
+    async def vector_search(self, query_embedding: np.ndarray, top_k: int = 3,
+                            filters: Optional[Dict] = None) -> List[Tuple[int, float]]:
+        """Exact search reads the embeddings asynchronously; other index types run their own search on the executor."""
+        if type(self.rag_system).vector_search is not BaseRAGSystem.vector_search:
+            return await self.run_in_executor(self.rag_system.vector_search, query_embedding, top_k, filters=filters)
+        condition, params = build_metadata_filter(filters)
+        rows = await self.fetch_all(f'SELECT id, embedding FROM documents WHERE {condition}', params)
+        return await self.run_in_executor(self._score_rows, rows, query_embedding, top_k)
+
+    @staticmethod
+    def _score_rows(rows: List[Tuple[int, bytes]], query_embedding: np.ndarray, top_k: int) -> List[Tuple[int, float]]:
+        ids, matrix = embedding_rows_to_matrix(rows)
+        if len(ids) == 0:
+            return []
+        scores = matrix @ normalize_rows(np.asarray(query_embedding, dtype=np.float32))
+        return [(int(ids[i]), float(scores[i])) for i in top_k_indices(scores, top_k)]
+
+    async def get_documents_by_ids(self, ids: List[int]) -> Dict[int, Tuple[str, str]]:
+        if not ids:
+            return {}
+        rows = await self.fetch_all(f'SELECT id, title, content FROM documents WHERE id IN ({",".join("?" * len(ids))})',
+                                    [int(doc_id) for doc_id in ids])
+        return {id: (title, content) for id, title, content in rows}
+
+    async def call_llm(self, llm_function: Callable, prompt: str) -> str:
+        """
+        Call an LLM without blocking the loop, bounded by the concurrency limit and the timeout.
+
+        :raises asyncio.TimeoutError: If the call exceeds llm_timeout
+        """
+        async with self.llm_semaphore:
+            if inspect.iscoroutinefunction(llm_function):
+                call = llm_function(prompt)
+            else:
+                call = asyncio.get_running_loop().run_in_executor(self.llm_executor, llm_function, prompt)
+            return await asyncio.wait_for(call, timeout=self.llm_timeout)
+
+    async def hypothetical_document(self, query: str, llm_function: Callable) -> str:
+        """HyDE generation, sharing the HyDE system's generation cache."""
+        rag_system = self.rag_system
+        key = make_cache_key(normalize_query(query), llm_function_id(llm_function), rag_system.HYDE_PROMPT_TEMPLATE)
+        hypothetical_doc = rag_system.hyde_cache.get(key)
+        if hypothetical_doc is None:
+            hypothetical_doc = await self.call_llm(llm_function,
+                                                   rag_system.HYDE_PROMPT_TEMPLATE.format(query=query))
+            rag_system.hyde_cache.put(key, hypothetical_doc)
+        return hypothetical_doc
+
+    async def get_relevant_documents(self, query: str, top_k: int = 3, filters: Optional[Dict] = None,
+                                     llm_function: Optional[Callable] = None) -> List[Tuple[int, str, str, float]]:
+        """
+        Retrieve documents for a query.
+
+        :param query: The query
+        :param top_k: Number of documents to return
+        :param filters: Optional metadata filter
+        :param llm_function: Needed when the wrapped system is a HyDERAGSystem
+        :return: List of (id, title, content, score), best first
+        """
+        try:
+            if isinstance(self.rag_system, (HybridRAGSystem, HierarchicalRAGSystem, ShardedRAGSystem)):
+                # Multi-stage retrieval runs as a whole on the executor
+                return await self.run_in_executor(self.rag_system.get_relevant_documents, query, top_k, filters)
+            if isinstance(self.rag_system, HyDERAGSystem):
+                if llm_function is None:
+                    raise RAGException("HyDE retrieval needs an llm_function")
+                query = await self.hypothetical_document(query, llm_function)
+            hits = await self.vector_search(await self.encode_query(query), top_k, filters)
+            documents = await self.get_documents_by_ids([doc_id for doc_id, _ in hits])
+            return [(doc_id, *documents[doc_id], score) for doc_id, score in hits if doc_id in documents]
+        except (RAGException, asyncio.CancelledError, asyncio.TimeoutError):
+            raise
+        except Exception as e:
+            logger.error(f"Error in async retrieval of relevant documents: {e}")
+            raise RAGException(f"Async retrieval of relevant documents failed: {e}")
+
+    async def rag_query(self, query: str, llm_function: Callable, top_k: int = 3,
+                        filters: Optional[Dict] = None) -> str:
+        try:
+            answer_cache = self.rag_system.answer_cache
+            if answer_cache is not None:
+                scope_key = self.rag_system.answer_scope(llm_function, top_k, filters)
+                query_embedding = await self.encode_query(query)
+                cached = answer_cache.get(scope_key, query_embedding)
+                if cached is not None:
+                    return cached
+
+            relevant_docs = await self.get_relevant_documents(query, top_k, filters, llm_function)
+            packed_docs = await self.run_in_executor(self.rag_system.pack_documents, relevant_docs)
+            response = await self.call_llm(llm_function, build_rag_prompt(query, packed_docs))
+            if answer_cache is not None:
+                await self.run_in_executor(self.rag_system.cache_answer, scope_key, query_embedding, response,
+                                           packed_docs)
+            logger.info("Generated async response for query")
+            return response
+        except (RAGException, asyncio.CancelledError):
+            raise
+        except asyncio.TimeoutError:
+            logger.error(f"LLM call timed out after {self.llm_timeout}s")
+            raise RAGException(f"RAG query timed out after {self.llm_timeout}s")
+        except Exception as e:
+            logger.error(f"Error in async RAG query: {e}")
+            raise RAGException(f"Async RAG query failed: {e}")
+
+    async def rag_query_many(self, queries: List[str], llm_function: Callable, top_k: int = 3,
+                             filters: Optional[Dict] = None) -> List[str]:
+        """
+        Answer many queries concurrently; if one fails, the others are cancelled and the error is raised.
+
+        :return: Responses in the order of `queries`
+        """
+        tasks = [asyncio.ensure_future(self.rag_query(query, llm_function, top_k, filters)) for query in queries]
+        try:
+            return list(await asyncio.gather(*tasks))
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+    def close(self):
+        self.llm_executor.shutdown(wait=False)
+        if self.owns_executor:
+            self.executor.shutdown(wait=False)
+        logger.info("Closed async RAG system")
+
+
+# Example usage with error handling
+def mock_llm(prompt: str) -> str:
+    if "write a short paragraph" in prompt:
+        return "Paris, the capital of France, is renowned for its iconic Eiffel Tower and rich cultural heritage."
+    else:
+        return f"This is a mock LLM response for the prompt: {prompt}"
+
+
+def main():
+    use_hyde = False  # Set this to True when you want to enable HyDE
+
+    try:
+        if use_hyde:
+            rag_system = HyDERAGSystem('rag_database.db')
+            logger.info("Using HyDE RAG System")
         else:
             rag_system = StandardRAGSystem('rag_database.db')
             logger.info("Using Standard RAG System")
@@ -233,463 +2499,6 @@ if __name__ == "__main__":
 
 
 
-####################################################################################
-# async:
-
-# import os
-# import asyncio
-# from typing import List, Tuple, Callable, Optional
-# import aiosqlite
-# import numpy as np
-# from sentence_transformers import SentenceTransformer
-# from sklearn.metrics.pairwise import cosine_similarity
-# import logging
-# from dotenv import load_dotenv
-#
-# load_dotenv()
-#
-# logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-# logger = logging.getLogger(__name__)
-#
-#
-# class RAGException(Exception):
-#     """Custom exception class for RAG-related errors"""
-#     pass
-#
-#
-# class BaseRAGSystem:
-#     def __init__(self, db_path: str, model_name: Optional[str] = None):
-#         """
-#         Initialize the RAG system.
-#
-#         :param db_path: Path to the SQLite database
-#         :param model_name: Name of the SentenceTransformer model to use
-#         """
-#         self.db_path = db_path
-#         self.model_name = model_name or os.getenv('DEFAULT_MODEL_NAME', 'all-MiniLM-L6-v2')
-#         try:
-#             self.model = SentenceTransformer(self.model_name)
-#             logger.info(f"Initialized SentenceTransformer with model: {self.model_name}")
-#         except Exception as e:
-#             logger.error(f"Failed to initialize SentenceTransformer: {e}")
-#             raise RAGException(f"Model initialization failed: {e}")
-#
-#     async def init_db(self):
-#         try:
-#             async with aiosqlite.connect(self.db_path) as db:
-#                 await db.execute('''
-#                 CREATE TABLE IF NOT EXISTS documents (
-#                     id INTEGER PRIMARY KEY,
-#                     title TEXT,
-#                     content TEXT,
-#                     embedding BLOB
-#                 )
-#                 ''')
-#                 await db.commit()
-#             logger.info("Initialized database schema")
-#         except aiosqlite.Error as e:
-#             logger.error(f"Failed to initialize database schema: {e}")
-#             raise RAGException(f"Database schema initialization failed: {e}")
-#
-#     async def add_documents(self, documents: List[Tuple[str, str]]):
-#         try:
-#             embeddings = self.model.encode([content for _, content in documents])
-#             async with aiosqlite.connect(self.db_path) as db:
-#                 await db.executemany(
-#                     'INSERT INTO documents (title, content, embedding) VALUES (?, ?, ?)',
-#                     [(title, content, embedding.tobytes()) for (title, content), embedding in
-#                      zip(documents, embeddings)]
-#                 )
-#                 await db.commit()
-#             logger.info(f"Added {len(documents)} documents in batch")
-#         except Exception as e:
-#             logger.error(f"Failed to add documents in batch: {e}")
-#             raise RAGException(f"Batch document addition failed: {e}")
-#
-# async def get_documents(self) -> List[Tuple[int, str, str, np.ndarray, str]]:
-#     try:
-#         async with aiosqlite.connect(self.db_path) as db:
-#             async with db.execute('SELECT id, title, content, embedding, source FROM documents') as cursor:
-#                 documents = [
-#                     (id, title, content, np.frombuffer(embedding, dtype=np.float32), source)
-#                     async for id, title, content, embedding, source in cursor
-#                 ]
-#         logger.info(f"Retrieved {len(documents)} documents")
-#         return documents
-#     except aiosqlite.Error as e:
-#         logger.error(f"Failed to retrieve documents: {e}")
-#         raise RAGException(f"Document retrieval failed: {e}")
-#
-#
-# class AsyncStandardRAGSystem(BaseRAGSystem):
-#     async def get_relevant_documents(self, query: str, top_k: int = 3) -> List[Tuple[int, str, str, float]]:
-#         try:
-#             query_embedding = self.model.encode([query])[0]
-#             documents = await self.get_documents()
-#             similarities = [
-#                 (id, title, content, cosine_similarity([query_embedding], [doc_embedding])[0][0])
-#                 for id, title, content, doc_embedding in documents
-#             ]
-#             similarities.sort(key=lambda x: x[3], reverse=True)
-#             logger.info(f"Retrieved top {top_k} relevant documents for query")
-#             return similarities[:top_k]
-#         except Exception as e:
-#             logger.error(f"Error in getting relevant documents: {e}")
-#             raise RAGException(f"Retrieval of relevant documents failed: {e}")
-#
-#     async def rag_query(self, query: str, llm_function: Callable[[str], str], top_k: int = 3) -> str:
-#         try:
-#             relevant_docs = await self.get_relevant_documents(query, top_k)
-#             context = "\n\n".join([f"Title: {title}\nContent: {content}\nSource: {source}" for _, title, content, _, source in relevant_docs])
-#
-#             llm_prompt = f"Based on the following context, please answer the query. Include citations in your response using [Source] format:\n\nContext:\n{context}\n\nQuery: {query}"
-#
-#             response = llm_function(llm_prompt)
-#             logger.info("Generated response for query")
-#             return response
-#         except Exception as e:
-#             logger.error(f"Error in RAG query: {e}")
-#             raise RAGException(f"RAG query failed: {e}")
-#
-#
-# class AsyncHyDERAGSystem(BaseRAGSystem):
-#     async def generate_hypothetical_document(self, query: str, llm_function: Callable[[str], str]) -> str:
-#         try:
-#             prompt = f"Given the question '{query}', write a short paragraph that would answer this question. Do not include the question itself in your response."
-#             hypothetical_doc = llm_function(prompt)
-#             logger.info("Generated hypothetical document")
-#             return hypothetical_doc
-#         except Exception as e:
-#             logger.error(f"Error generating hypothetical document: {e}")
-#             raise RAGException(f"Hypothetical document generation failed: {e}")
-#
-#     async def get_relevant_documents(self, query: str, llm_function: Callable[[str], str], top_k: int = 3) -> List[
-#         Tuple[int, str, str, float]]:
-#         try:
-#             hypothetical_doc = await self.generate_hypothetical_document(query, llm_function)
-#             hyde_embedding = self.model.encode([hypothetical_doc])[0]
-#
-#             documents = await self.get_documents()
-#             similarities = [
-#                 (id, title, content, cosine_similarity([hyde_embedding], [doc_embedding])[0][0])
-#                 for id, title, content, doc_embedding in documents
-#             ]
-#             similarities.sort(key=lambda x: x[3], reverse=True)
-#             logger.info(f"Retrieved top {top_k} relevant documents using HyDE")
-#             return similarities[:top_k]
-#         except Exception as e:
-#             logger.error(f"Error in getting relevant documents with HyDE: {e}")
-#             raise RAGException(f"HyDE retrieval of relevant documents failed: {e}")
-#
-#     async def rag_query(self, query: str, llm_function: Callable[[str], str], top_k: int = 3) -> str:
-#         try:
-#             relevant_docs = await self.get_relevant_documents(query, llm_function, top_k)
-#             context = "\n\n".join([f"Title: {title}\nContent: {content}" for _, title, content, _ in relevant_docs])
-#
-#             llm_prompt = f"Based on the following context, please answer the query:\n\nContext:\n{context}\n\nQuery: {query}"
-#
-#             response = llm_function(llm_prompt)
-#             logger.info("Generated response for query using HyDE")
-#             return response
-#         except Exception as e:
-#             logger.error(f"Error in HyDE RAG query: {e}")
-#             raise RAGException(f"HyDE RAG query failed: {e}")
-#
-#
-# # Example usage with error handling
-# def mock_llm(prompt: str) -> str:
-#     if "write a short paragraph" in prompt:
-#         return "Paris, the capital of France, is renowned for its iconic Eiffel Tower and rich cultural heritage."
-#     else:
-#         return f"This is a mock LLM response for the prompt: {prompt}"
-#
-#
-# async def main():
-#     use_hyde = False  # Set this to True when you want to enable HyDE
-#
-#     try:
-#         if use_hyde:
-#             rag_system = AsyncHyDERAGSystem('rag_database.db')
-#             logger.info("Using Async HyDE RAG System")
-#         else:
-#             rag_system = AsyncStandardRAGSystem('rag_database.db')
-#             logger.info("Using Async Standard RAG System")
-#
-#         await rag_system.init_db()
-#
-#         # Add sample documents
-#         sample_docs = [
-#             ("Paris", "Paris is the capital of France and is known for the Eiffel Tower."),
-#             ("London", "London is the capital of the United Kingdom and home to Big Ben."),
-#             ("Tokyo", "Tokyo is the capital of Japan and is famous for its bustling city life.")
-#         ]
-#
-#         await rag_system.add_documents(sample_docs)
-#
-#         query = "What is the capital of France?"
-#         result = await rag_system.rag_query(query, mock_llm)
-#         print(f"Query: {query}")
-#         print(f"Result: {result}")
-#
-#     except RAGException as e:
-#         logger.error(f"RAG system error: {e}")
-#         print(f"An error occurred: {e}")
-#     except Exception as e:
-#         logger.error(f"Unexpected error: {e}")
-#         print(f"An unexpected error occurred: {e}")
-#
-#
-# if __name__ == "__main__":
-#     asyncio.run(main())
-
-
-
-#
-# from fastapi import FastAPI, HTTPException
-#
-# app = FastAPI()
-# rag_system = AsyncStandardRAGSystem('rag_database.db')
-#
-# @app.on_event("startup")
-# async def startup_event():
-#     await rag_system.init_db()
-#
-# @app.get("/query")
-# async def query(q: str):
-#     try:
-#         result = await rag_system.rag_query(q, mock_llm)
-#         return {"query": q, "result": result}
-#     except RAGException as e:
-#         raise HTTPException(status_code=500, detail=str(e))
-#
-
-
-############################################################################################
-# Using FAISS
-#
-#
-#
-# Update DB
-# async def init_db(self):
-#     try:
-#         async with aiosqlite.connect(self.db_path) as db:
-#             await db.execute('''
-#             CREATE TABLE IF NOT EXISTS documents (
-#                 id INTEGER PRIMARY KEY,
-#                 title TEXT,
-#                 content TEXT,
-#                 embedding BLOB,
-#                 source TEXT
-#             )
-#             ''')
-#             await db.commit()
-#         logger.info("Initialized database schema")
-#     except aiosqlite.Error as e:
-#         logger.error(f"Failed to initialize database schema: {e}")
-#         raise RAGException(f"Database schema initialization failed: {e}")
-#
-#
-
-# import os
-# import asyncio
-# from typing import List, Tuple, Callable, Optional
-# import aiosqlite
-# import numpy as np
-# from sentence_transformers import SentenceTransformer
-# import faiss
-# import logging
-# from dotenv import load_dotenv
-#
-# load_dotenv()
-#
-# logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-# logger = logging.getLogger(__name__)
-#
-#
-# class RAGException(Exception):
-#     """Custom exception class for RAG-related errors"""
-#     pass
-#
-#
-# class AsyncFAISSRAGSystem:
-#     def __init__(self, db_path: str, model_name: Optional[str] = None):
-#         self.db_path = db_path
-#         self.model_name = model_name or os.getenv('DEFAULT_MODEL_NAME', 'all-MiniLM-L6-v2')
-#         try:
-#             self.model = SentenceTransformer(self.model_name)
-#             logger.info(f"Initialized SentenceTransformer with model: {self.model_name}")
-#         except Exception as e:
-#             logger.error(f"Failed to initialize SentenceTransformer: {e}")
-#             raise RAGException(f"Model initialization failed: {e}")
-#
-#         self.index = None
-#         self.document_lookup = {}
-#
-#     async def init_db(self):
-#         try:
-#             async with aiosqlite.connect(self.db_path) as db:
-#                 await db.execute('''
-#                 CREATE TABLE IF NOT EXISTS documents (
-#                     id INTEGER PRIMARY KEY,
-#                     title TEXT,
-#                     content TEXT
-#                 )
-#                 ''')
-#                 await db.commit()
-#             logger.info("Initialized database schema")
-#         except aiosqlite.Error as e:
-#             logger.error(f"Failed to initialize database schema: {e}")
-#             raise RAGException(f"Database schema initialization failed: {e}")
-#
-# async def add_documents(self, documents: List[Tuple[str, str, str]]):
-#     try:
-#         embeddings = self.model.encode([content for _, content, _ in documents])
-#         async with aiosqlite.connect(self.db_path) as db:
-#             await db.executemany(
-#                 'INSERT INTO documents (title, content, embedding, source) VALUES (?, ?, ?, ?)',
-#                 [(title, content, embedding.tobytes(), source) for (title, content, source), embedding in
-#                  zip(documents, embeddings)]
-#             )
-#             await db.commit()
-#         logger.info(f"Added {len(documents)} documents in batch")
-#     except Exception as e:
-#         logger.error(f"Failed to add documents in batch: {e}")
-#         raise RAGException(f"Batch document addition failed: {e}")
-#
-#     async def get_relevant_documents(self, query: str, top_k: int = 3) -> List[Tuple[int, str, str, float, str]]:
-#         try:
-#             query_embedding = self.model.encode([query])[0]
-#             documents = await self.get_documents()
-#             similarities = [
-#                 (id, title, content, cosine_similarity([query_embedding], [doc_embedding])[0][0], source)
-#                 for id, title, content, doc_embedding, source in documents
-#             ]
-#             similarities.sort(key=lambda x: x[3], reverse=True)
-#             logger.info(f"Retrieved top {top_k} relevant documents for query")
-#             return similarities[:top_k]
-#         except Exception as e:
-#             logger.error(f"Error in getting relevant documents: {e}")
-#             raise RAGException(f"Retrieval of relevant documents failed: {e}")
-#
-#     async def rag_query(self, query: str, llm_function: Callable[[str], str], top_k: int = 3) -> str:
-#         try:
-#             relevant_docs = await self.get_relevant_documents(query, top_k)
-#             context = "\n\n".join([f"Title: {title}\nContent: {content}" for _, title, content, _ in relevant_docs])
-#
-#             llm_prompt = f"Based on the following context, please answer the query:\n\nContext:\n{context}\n\nQuery: {query}"
-#
-#             response = llm_function(llm_prompt)
-#             logger.info("Generated response for query")
-#             return response
-#         except Exception as e:
-#             logger.error(f"Error in RAG query: {e}")
-#             raise RAGException(f"RAG query failed: {e}")
-#
-#
-# class AsyncFAISSHyDERAGSystem(AsyncFAISSRAGSystem):
-#     async def generate_hypothetical_document(self, query: str, llm_function: Callable[[str], str]) -> str:
-#         try:
-#             prompt = f"Given the question '{query}', write a short paragraph that would answer this question. Do not include the question itself in your response."
-#             hypothetical_doc = llm_function(prompt)
-#             logger.info("Generated hypothetical document")
-#             return hypothetical_doc
-#         except Exception as e:
-#             logger.error(f"Error generating hypothetical document: {e}")
-#             raise RAGException(f"Hypothetical document generation failed: {e}")
-#
-#     async def get_relevant_documents(self, query: str, llm_function: Callable[[str], str], top_k: int = 3) -> List[
-#         Tuple[int, str, str, float]]:
-#         try:
-#             hypothetical_doc = await self.generate_hypothetical_document(query, llm_function)
-#             hyde_embedding = self.model.encode([hypothetical_doc])[0]
-#
-#             distances, indices = self.index.search(np.array([hyde_embedding]), top_k)
-#
-#             results = []
-#             for i, idx in enumerate(indices[0]):
-#                 doc_id = list(self.document_lookup.keys())[idx]
-#                 title, content = self.document_lookup[doc_id]
-#                 results.append((doc_id, title, content, distances[0][i]))
-#
-#             logger.info(f"Retrieved top {top_k} relevant documents using HyDE")
-#             return results
-#         except Exception as e:
-#             logger.error(f"Error in getting relevant documents with HyDE: {e}")
-#             raise RAGException(f"HyDE retrieval of relevant documents failed: {e}")
-#
-#
-# # Example usage
-# def mock_llm(prompt: str) -> str:
-#     if "write a short paragraph" in prompt:
-#         return "Paris, the capital of France, is renowned for its iconic Eiffel Tower and rich cultural heritage."
-#     else:
-#         return f"This is a mock LLM response for the prompt: {prompt}"
-#
-#
-# async def main():
-#     use_hyde = False  # Set this to True when you want to enable HyDE
-#
-#     try:
-#         if use_hyde:
-#             rag_system = AsyncFAISSHyDERAGSystem('rag_database.db')
-#             logger.info("Using Async FAISS HyDE RAG System")
-#         else:
-#             rag_system = AsyncFAISSRAGSystem('rag_database.db')
-#             logger.info("Using Async FAISS RAG System")
-#
-#         await rag_system.init_db()
-#
-#         # Add sample documents
-#         sample_docs = [
-#             ("Paris", "Paris is the capital of France and is known for the Eiffel Tower."),
-#             ("London", "London is the capital of the United Kingdom and home to Big Ben."),
-#             ("Tokyo", "Tokyo is the capital of Japan and is famous for its bustling city life.")
-#         ]
-#
-#         await rag_system.add_documents(sample_docs)
-#
-#         query = "What is the capital of France?"
-#         result = await rag_system.rag_query(query, mock_llm)
-#         print(f"Query: {query}")
-#         print(f"Result: {result}")
-#
-#     except RAGException as e:
-#         logger.error(f"RAG system error: {e}")
-#         print(f"An error occurred: {e}")
-#     except Exception as e:
-#         logger.error(f"Unexpected error: {e}")
-#         print(f"An unexpected error occurred: {e}")
-#
-#
-# if __name__ == "__main__":
-#     asyncio.run(main())
-
-
-"""
-Key changes in this FAISS-integrated version:
-
-We've replaced the cosine similarity search with FAISS indexing and search.
-The add_documents method now adds embeddings to the FAISS index as well as storing documents in the SQLite database.
-We maintain a document_lookup dictionary to quickly retrieve document content based on FAISS search results.
-The get_relevant_documents method now uses FAISS for similarity search instead of computing cosine similarities manually.
-We've kept the asynchronous structure for database operations, while FAISS operations remain synchronous (as FAISS doesn't have built-in async support).
-
-Benefits of using FAISS:
-
-Scalability: FAISS can handle millions of vectors efficiently, making it suitable for large document collections.
-Speed: FAISS is optimized for fast similarity search, which can significantly improve query times as your dataset grows.
-Memory Efficiency: FAISS provides various index types that can trade off between search accuracy and memory usage, allowing you to optimize for your specific use case.
-
-Considerations:
-
-This implementation uses a simple IndexFlatL2 FAISS index, which performs exact search. For larger datasets, you might want to consider approximate search methods like IndexIVFFlat for better scalability.
-The current implementation keeps all document content in memory (in the document_lookup dictionary). For very large datasets, you might want to modify this to fetch document content from the database as needed.
-If you're dealing with a very large number of documents, you might want to implement batch processing for adding documents to the FAISS index.
-
-This FAISS-integrated version should provide better performance for similarity search, especially as your document collection grows larger
-"""
-
-
 ###############################################################################################################
 # Web Search
 # Output from Sonnet 3.5 regarding how to add web searches to the RAG system
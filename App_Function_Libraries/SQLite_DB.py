@@ -38,8 +38,11 @@
 # 28. update_media_content(media_id: int, content: str, prompt: str, summary: str)
 # 29. search_media_database(query: str) -> List[Tuple[int, str, str]]
 # 30. load_media_content(media_id: int)
-# 31.
-# 32.
+# 31. register_media_update_listener(listener)
+# 32. notify_media_updated(media_id: int)
+# 33. get_media_chunks(content: str, chunk_options: Dict[str, Any], media_id: Optional[int] = None)
+# 34. delete_media_chunks(media_id: int)
+# 35. store_media_chunks(content: str, chunk_options: Dict[str, Any], chunks: List[Dict[str, Any]], media_id=None)
 #
 #
 #####################
@@ -54,7 +57,7 @@ import time
 import traceback
 from contextlib import contextmanager
 from datetime import datetime
-from typing import List, Tuple, Dict, Any
+from typing import List, Tuple, Dict, Any, Optional
 
 # Third-Party Libraries
 import gradio as gr
@@ -129,6 +132,12 @@ db = Database()
 
 # Function to create tables with the new media schema
 def create_tables() -> None:
+    # MediaChunks only caches chunking results: a table from before media_id was part of its key is rebuilt
+    with db.get_connection() as conn:
+        media_chunks_columns = conn.execute("PRAGMA table_info(MediaChunks)").fetchall()
+    if media_chunks_columns and not any(column[1] == 'media_id' and column[5] for column in media_chunks_columns):
+        db.execute_query("DROP TABLE MediaChunks")
+
     table_queries = [
         '''
         CREATE TABLE IF NOT EXISTS Media (
@@ -244,6 +253,35 @@ def create_tables() -> None:
         ''',
         '''
         CREATE INDEX IF NOT EXISTS idx_chatmessages_conversation_id ON ChatMessages(conversation_id);
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS MediaChunks (
+            content_hash TEXT NOT NULL,
+            chunk_options TEXT NOT NULL,
+            media_id INTEGER NOT NULL DEFAULT 0,
+            chunks TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (content_hash, chunk_options, media_id)
+        )
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_mediachunks_media_id ON MediaChunks(media_id);
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS BoilerplateDocuments (
+            uploader TEXT NOT NULL,
+            document_key TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (uploader, document_key)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS BoilerplateShingles (
+            uploader TEXT NOT NULL,
+            shingle_hash INTEGER NOT NULL,
+            document_count INTEGER NOT NULL DEFAULT 1,
+            PRIMARY KEY (uploader, shingle_hash)
+        ) WITHOUT ROWID
         '''
     ]
     for query in table_queries:
@@ -254,6 +292,97 @@ def create_tables() -> None:
 create_tables()
 
 
+# Callbacks run with the media id whenever an existing media item's content or summary changes (re-ingest, edit),
+# so caches derived from it (e.g. semantic answer caches) can drop their stale entries
+media_update_listeners = []
+
+
+def register_media_update_listener(listener) -> None:
+    if listener not in media_update_listeners:
+        media_update_listeners.append(listener)
+
+
+def notify_media_updated(media_id: int) -> None:
+    for listener in media_update_listeners:
+        try:
+            listener(media_id)
+        except Exception as e:
+            logging.error(f"Media update listener failed for media ID {media_id}: {e}")
+
+
+#######################################################################################################################
+# Chunk cache
+#
+# Chunking results (character spans and token counts, not the text) are stored in MediaChunks, keyed by the hash of
+# the chunked content and the canonical chunk options, so every feature chunking the same content the same way
+# (re-summarization, chat, indexing) reuses one result. Changed content hashes differently and is never served stale
+# chunks. Each media item keeps its own row (media_id 0: content not tied to a media item), so two items with the
+# same content share the result but not the row, and an item's rows are dropped when it is updated.
+
+def get_media_chunks(content: str, chunk_options: Dict[str, Any], media_id: Optional[int] = None) -> List[
+    Dict[str, Any]]:
+    """
+    improved_chunking_process(content, chunk_options), with a 'token_count' in each chunk's metadata.
+
+    :param content: The text to chunk (usually Media.content)
+    :param chunk_options: Chunk options as for improved_chunking_process
+    :param media_id: The media item the content belongs to, so its chunks are dropped when it is updated
+    """
+    # Imported here: Chunk_Lib pulls in the NLP stack, which the rest of this module does not need
+    from App_Function_Libraries.Chunk_Lib import improved_chunking_spans, canonical_chunk_options, content_hash, \
+        serialize_chunks, deserialize_chunks, chunk_dicts_with_token_counts, count_tokens_batch
+
+    key = (content_hash(content), canonical_chunk_options(chunk_options), media_id or 0)
+    try:
+        with db.get_connection() as conn:
+            # Any item's row will do, this item's own row first
+            row = conn.execute("SELECT media_id, chunks FROM MediaChunks WHERE content_hash = ? AND chunk_options = ? "
+                               "ORDER BY media_id = ? DESC LIMIT 1", key).fetchone()
+        if row:
+            if row[0] != key[2]:
+                db.execute_query("INSERT OR IGNORE INTO MediaChunks (content_hash, chunk_options, media_id, chunks) "
+                                 "VALUES (?, ?, ?, ?)", (*key, row[1]))
+            return chunk_dicts_with_token_counts(*deserialize_chunks(content, row[1]))
+    except (DatabaseError, sqlite3.Error, ValueError) as e:
+        logging.warning(f"Chunk cache lookup failed, re-chunking: {e}")
+
+    chunks = improved_chunking_spans(content, chunk_options)
+    token_counts = count_tokens_batch([chunk.text for chunk in chunks], chunk_options.get('tokenizer'))
+    try:
+        db.execute_query("INSERT OR REPLACE INTO MediaChunks (content_hash, chunk_options, media_id, chunks) "
+                         "VALUES (?, ?, ?, ?)", (*key, serialize_chunks(chunks, token_counts)))
+    except DatabaseError as e:
+        logging.warning(f"Could not cache chunks: {e}")
+    return chunk_dicts_with_token_counts(chunks, token_counts)
+
+
+def store_media_chunks(content: str, chunk_options: Dict[str, Any], chunks: List[Dict[str, Any]],
+                       media_id: Optional[int] = None) -> None:
+    """
+    Cache chunks computed elsewhere (e.g. by Chunk_Lib.chunk_files_parallel during a bulk ingest), so
+    get_media_chunks() serves them instead of chunking the content again. Without a media_id they are cached for the
+    content alone, and get_media_chunks() copies them to a media item the first time it is asked for its chunks.
+
+    :param chunks: Chunk dicts of `content` with a 'token_count' in their metadata, as get_media_chunks() returns
+    """
+    from App_Function_Libraries.Chunk_Lib import canonical_chunk_options, content_hash, serialize_chunks, \
+        chunk_dicts_to_spans
+
+    try:
+        db.execute_query("INSERT OR REPLACE INTO MediaChunks (content_hash, chunk_options, media_id, chunks) "
+                         "VALUES (?, ?, ?, ?)", (content_hash(content), canonical_chunk_options(chunk_options),
+                                                 media_id or 0, serialize_chunks(*chunk_dicts_to_spans(content, chunks))))
+    except DatabaseError as e:
+        logging.warning(f"Could not cache chunks: {e}")
+
+
+def delete_media_chunks(media_id: int) -> None:
+    db.execute_query("DELETE FROM MediaChunks WHERE media_id = ?", (media_id,))
+
+
+register_media_update_listener(delete_media_chunks)
+
+
 #######################################################################################################################
 # Keyword-related Functions
 #
@@ -395,6 +524,8 @@ def add_media_with_keywords(url, title, media_type, content, keywords, prompt, s
 
             conn.commit()
             logging.info(f"Media '{title}' successfully added/updated with ID: {media_id}")
+            if existing_media:
+                notify_media_updated(media_id)
 
             return f"Media '{title}' added/updated successfully with keywords: {', '.join(keyword_list)}"
 
@@ -877,6 +1008,7 @@ def update_media_content(selected_item, item_mapping, content_input, prompt_inpu
                     """, (media_id, prompt_input, summary_input))
 
                 conn.commit()
+            notify_media_updated(media_id)
 
             return f"Content updated successfully for media ID: {media_id}"
         else:
@@ -1073,6 +1205,8 @@ def import_obsidian_note_to_db(note_data):
             cursor.execute('INSERT OR REPLACE INTO media_fts (rowid, title, content) VALUES (?, ?, ?)',
                            (media_id, note_data['title'], note_data['content']))
 
+        if existing_note:
+            notify_media_updated(media_id)
         action = "Updated" if existing_note else "Imported"
         logger.info(f"{action} Obsidian note: {note_data['title']}")
         return True, None
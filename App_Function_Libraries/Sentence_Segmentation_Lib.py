@@ -0,0 +1,199 @@
+# Sentence_Segmentation_Lib.py
+#########################################
+# Sentence Segmentation Library
+# Splits text into sentences for the chunkers, without touching the network or re-loading models per call.
+#
+# The segmenter for a language is resolved once per process and then reused:
+#   punkt  - NLTK's Punkt model, loaded from local NLTK data ('punkt_tab' on NLTK >= 3.8.2, 'punkt' pickles before)
+#   regex  - a fast rule based splitter (sentence punctuation followed by whitespace, skipping common abbreviations
+#            and initials), used when no Punkt data is installed or when asked for explicitly
+# Sentences are returned as character spans into the original text, so chunkers never have to search for them.
+#
+# Settings (environment / .env):
+#   SENTENCE_SEGMENTER     - 'auto' (default: punkt if its data is installed, else regex), 'punkt' or 'regex'
+#   NLTK_AUTO_DOWNLOAD     - 'true' to download missing Punkt data once, when the segmenter is first resolved
+#                            (default false: fully offline; install with prepare_sentence_segmenter(download=True))
+#
+####
+import functools
+import logging
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional, Tuple
+
+####################
+# Function List
+#
+# 1. prepare_sentence_segmenter(language='english', download=False)
+# 2. get_segmenter(language='english')
+# 3. sentence_spans(text, language='english', start=0, end=None)
+# 4. split_sentences(text, language='english')
+# 5. sentence_spans_batch(texts, language='english', max_workers=1)
+#
+####################
+
+
+#######################################################################################################################
+# Function Definitions
+#
+
+# Words that end with a period without ending the sentence (compared lower-cased, without the period)
+ABBREVIATIONS = frozenset([
+    'mr', 'mrs', 'ms', 'dr', 'prof', 'sr', 'jr', 'st', 'mt', 'vs', 'etc', 'fig', 'figs', 'nos', 'vol', 'vols',
+    'ch', 'approx', 'dept', 'inc', 'ltd', 'corp', 'gov', 'sgt', 'capt', 'lt', 'jan', 'feb', 'apr', 'jun', 'jul',
+    'aug', 'sep', 'sept', 'oct', 'nov', 'dec', 'e.g', 'i.e', 'cf', 'ca', 'u.s', 'u.k', 'a.m', 'p.m',
+])
+# Abbreviations that are also common words ("no.", "mar."): only taken as abbreviations when capitalised ("Gen.
+# Grant") or followed by a lower-case word or a number ("no. 5", "et al. found")
+AMBIGUOUS_ABBREVIATIONS = frozenset(['no', 'est', 'co', 'al', 'col', 'gen', 'rev', 'sec', 'mar'])
+# Sentence punctuation, closing quotes/brackets, then the whitespace separating it from the next sentence
+SENTENCE_END_PATTERN = re.compile(r'[.!?…]+["\'’”)\]]*(?=\s)')
+# The word just before a period, to check it against the abbreviations
+LAST_WORD_PATTERN = re.compile(r'(\S+)$')
+# The first character after a period and the whitespace following it
+NEXT_CHARACTER_PATTERN = re.compile(r'\s*(\S)')
+
+
+class RegexSegmenter:
+    """Rule based sentence splitter; needs no model data."""
+
+    name = 'regex'
+
+    def spans(self, text: str, start: int = 0, end: Optional[int] = None) -> List[Tuple[int, int]]:
+        end = len(text) if end is None else end
+        spans = []
+        sentence_start = start
+        for match in SENTENCE_END_PATTERN.finditer(text, start, end):
+            if match.group()[0] == '.' and self._is_abbreviation(text, sentence_start, match.start(), match.end(),
+                                                                 end):
+                continue
+            self._append(text, sentence_start, match.end(), spans)
+            sentence_start = match.end()
+        self._append(text, sentence_start, end, spans)
+        return spans
+
+    @staticmethod
+    def _is_abbreviation(text: str, sentence_start: int, period: int, after: int, end: int) -> bool:
+        word = LAST_WORD_PATTERN.search(text, sentence_start, period)
+        if not word:
+            return False
+        word = word.group(1).lstrip('("\'')
+        # Initials ("J. R. R. Tolkien") and known abbreviations
+        if (len(word) == 1 and word.isupper()) or word.lower() in ABBREVIATIONS:
+            return True
+        if word.lower() not in AMBIGUOUS_ABBREVIATIONS:
+            return False
+        if word[0].isupper():
+            return True
+        following = NEXT_CHARACTER_PATTERN.match(text, after, end)
+        return bool(following) and (following.group(1).islower() or following.group(1).isdigit())
+
+    @staticmethod
+    def _append(text: str, start: int, end: int, spans: List[Tuple[int, int]]):
+        while start < end and text[start].isspace():
+            start += 1
+        while end > start and text[end - 1].isspace():
+            end -= 1
+        if start < end:
+            spans.append((start, end))
+
+
+class PunktSegmenter:
+    """NLTK Punkt model, loaded once from local NLTK data."""
+
+    name = 'punkt'
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+
+    def spans(self, text: str, start: int = 0, end: Optional[int] = None) -> List[Tuple[int, int]]:
+        end = len(text) if end is None else end
+        return [(start + span_start, start + span_end)
+                for span_start, span_end in self.tokenizer.span_tokenize(text[start:end])]
+
+
+def _load_punkt(language: str, download: bool):
+    """The Punkt tokenizer for `language` from local NLTK data, or None when nltk or the data is missing."""
+    try:
+        import nltk
+        from nltk.tokenize import punkt
+    except ImportError:
+        return None
+    for attempt in range(2):
+        try:
+            if hasattr(punkt, 'PunktTokenizer'):
+                # NLTK >= 3.8.2 ships the model as 'punkt_tab' and no longer loads the pickled 'punkt' models
+                return punkt.PunktTokenizer(language)
+            return nltk.data.load(f'tokenizers/punkt/{language}.pickle')
+        except (LookupError, OSError):
+            pass
+        if attempt or not download:
+            return None
+        logging.info("Downloading NLTK Punkt sentence tokenizer data")
+        for package in ('punkt_tab', 'punkt'):
+            try:
+                nltk.download(package, quiet=True)
+            except Exception as e:
+                logging.warning(f"Could not download NLTK {package}: {e}")
+    return None
+
+
+@functools.lru_cache(maxsize=None)
+def get_segmenter(language: str = 'english'):
+    """The sentence segmenter for `language` (see SENTENCE_SEGMENTER), resolved on first use and shared afterwards."""
+    choice = os.getenv('SENTENCE_SEGMENTER', 'auto').lower()
+    if choice != 'regex':
+        download = os.getenv('NLTK_AUTO_DOWNLOAD', 'false').lower() in ('true', '1', 'yes')
+        tokenizer = _load_punkt(language, download)
+        if tokenizer is not None:
+            logging.info(f"Sentence segmentation: NLTK Punkt ({language})")
+            return PunktSegmenter(tokenizer)
+        if choice == 'punkt':
+            raise LookupError(f"NLTK Punkt data for {language} is not installed; "
+                              f"run prepare_sentence_segmenter(download=True) once")
+        logging.warning(f"NLTK Punkt data for {language} not found, using the regex sentence splitter")
+    return RegexSegmenter()
+
+
+def prepare_sentence_segmenter(language: str = 'english', download: bool = False):
+    """Resolve (and with download=True, install if missing) the segmenter ahead of time, e.g. at startup."""
+    if download and _load_punkt(language, True) is not None:
+        get_segmenter.cache_clear()
+    return get_segmenter(language)
+
+
+def sentence_spans(text: str, language: str = 'english', start: int = 0,
+                   end: Optional[int] = None) -> List[Tuple[int, int]]:
+    """(start, end) offsets of the sentences in text[start:end]."""
+    return get_segmenter(language).spans(text, start, end)
+
+
+def split_sentences(text: str, language: str = 'english') -> List[str]:
+    return [text[start:end] for start, end in sentence_spans(text, language)]
+
+
+def _sentence_spans_task(args: Tuple[str, str]) -> List[Tuple[int, int]]:
+    text, language = args
+    return sentence_spans(text, language)
+
+
+def sentence_spans_batch(texts: List[str], language: str = 'english',
+                         max_workers: int = 1) -> List[List[Tuple[int, int]]]:
+    """
+    Sentence spans of many documents.
+
+    :param texts: The documents
+    :param language: Language of the documents
+    :param max_workers: Processes to segment on; Punkt is pure Python, so large batches scale with processes
+    """
+    segmenter = get_segmenter(language)
+    if max_workers <= 1 or len(texts) < 2:
+        return [segmenter.spans(text) for text in texts]
+    with ProcessPoolExecutor(max_workers=min(max_workers, len(texts))) as executor:
+        chunksize = max(1, len(texts) // (4 * max_workers))
+        return list(executor.map(_sentence_spans_task, [(text, language) for text in texts], chunksize=chunksize))
+
+#
+# End of Sentence Segmentation Library
+#######################################################################################################################
@@ -13,6 +13,8 @@ import configparser
 # 3. summarize_with_anthropic(api_key, file_path, model, custom_prompt_arg, max_retries=3, retry_delay=5)
 # 4. summarize_with_cohere(api_key, file_path, model, custom_prompt_arg)
 # 5. summarize_with_groq(api_key, file_path, model, custom_prompt_arg)
+# 6. extract_timed_segments(input_data)
+# 7. summarize_transcript_by_time(api_name, segments, custom_prompt_input, api_key, chunk_options)
 #
 #
 ####################
@@ -26,7 +28,9 @@ from requests import RequestException
 
 from App_Function_Libraries.Audio_Transcription_Lib import convert_to_wav, speech_to_text
 from App_Function_Libraries.Chunk_Lib import semantic_chunking, rolling_summarize, recursive_summarize_chunks, \
-    improved_chunking_process
+    improved_chunking_process, chunk_transcript, format_timestamp, compress_chunks, extractive_compress, \
+    EXTRACTIVE_COMPRESSION_RATIO
+from App_Function_Libraries.Tokenization_Methods_Lib import tokenizer_for_api
 from App_Function_Libraries.Diarization_Lib import combine_transcription_and_diarization
 from App_Function_Libraries.Local_Summarization_Lib import summarize_with_llama, summarize_with_kobold, \
     summarize_with_oobabooga, summarize_with_tabbyapi, summarize_with_vllm, summarize_with_local_llm
@@ -990,13 +994,49 @@ def extract_metadata_and_content(input_data):
     return metadata, content
 
 
+def extract_timed_segments(input_data):
+    """The transcript segments of `input_data` (as accepted by perform_summarization) if they carry timestamps."""
+    data = input_data
+    if isinstance(input_data, str):
+        try:
+            if os.path.exists(input_data):
+                with open(input_data, 'r', encoding='utf-8') as file:
+                    data = json.load(file)
+            else:
+                data = json.loads(input_data)
+        except (json.JSONDecodeError, OSError):
+            return None
+    if not isinstance(data, dict):
+        return None
+    segments = data.get('transcription', data.get('segments'))
+    if isinstance(segments, list) and segments and isinstance(segments[0], dict) \
+            and ('Time_Start' in segments[0] or 'start' in segments[0]):
+        return segments
+    return None
+
+
+def summarize_transcript_by_time(api_name, segments, custom_prompt_input, api_key, chunk_options):
+    """Summarize a transcript chunk by chunk; each summary is headed by the time range it covers."""
+    chunks = compress_chunks(chunk_transcript(segments, chunk_options),
+                             chunk_options.get('compression_ratio', EXTRACTIVE_COMPRESSION_RATIO),
+                             chunk_options.get('tokenizer'), chunk_options.get('language', 'english'))
+    sections = []
+    for chunk in chunks:
+        chunk_summary = summarize_chunk(api_name, chunk['text'], custom_prompt_input, api_key)
+        if chunk_summary:
+            time_range = f"{format_timestamp(chunk['metadata']['start'])} - {format_timestamp(chunk['metadata']['end'])}"
+            sections.append(f"**[{time_range}]**\n{chunk_summary}")
+    return "\n\n".join(sections) if sections else None
+
+
 def format_input_with_metadata(metadata, content):
     formatted_input = f"Title: {metadata.get('title', 'No title available')}\n"
     formatted_input += f"Author: {metadata.get('author', 'Unknown author')}\n\n"
     formatted_input += content
     return formatted_input
 
-def perform_summarization(api_name, input_data, custom_prompt_input, api_key, recursive_summarization=False):
+def perform_summarization(api_name, input_data, custom_prompt_input, api_key, recursive_summarization=False,
+                          chunk_options=None):
     loaded_config_data = load_and_log_configs()
     logging.info("Starting summarization process...")
     if custom_prompt_input is None:
@@ -1028,24 +1068,41 @@ def perform_summarization(api_name, input_data, custom_prompt_input, api_key, re
         logging.debug(f"Extracted metadata: {metadata}")
         logging.debug(f"Extracted content (first 500 chars): {content[:500]}...")
 
+        # Optional extractive pre-compression: the least central sentences of each chunk are dropped before the LLM
+        # sees them ('compression_ratio' in chunk_options, else EXTRACTIVE_COMPRESSION_RATIO; 1.0 is off)
+        compression_ratio = (chunk_options or {}).get('compression_ratio', EXTRACTIVE_COMPRESSION_RATIO)
+
         # Prepare a structured input for summarization
         structured_input = format_input_with_metadata(metadata, content)
 
+        # Transcripts chunked with method 'transcript' are summarized per time range
+        timed_segments = extract_timed_segments(input_data) \
+            if chunk_options and chunk_options.get('method') == 'transcript' else None
+
         # Perform summarization on the structured input
-        if recursive_summarization:
+        if timed_segments:
+            summary = summarize_transcript_by_time(api_name, timed_segments, custom_prompt_input, api_key,
+                                                   dict(chunk_options, tokenizer=tokenizer_for_api(api_name)))
+        elif recursive_summarization:
             chunk_options = {
                 'method': 'words',  # or 'sentences', 'paragraphs', 'tokens' based on your preference
                 'max_size': 1000,  # adjust as needed
                 'overlap': 100,  # adjust as needed
                 'adaptive': False,
                 'multi_level': False,
-                'language': 'english'
+                'language': 'english',
+                'tokenizer': tokenizer_for_api(api_name)
             }
-            chunks = improved_chunking_process(structured_input, chunk_options)
+            chunks = compress_chunks(improved_chunking_process(structured_input, chunk_options), compression_ratio,
+                                     chunk_options['tokenizer'])
             summary = recursive_summarize_chunks([chunk['text'] for chunk in chunks],
                                                  lambda x: summarize_chunk(api_name, x, custom_prompt_input, api_key),
                                                  custom_prompt_input)
         else:
+            if compression_ratio < 1.0:
+                # Sent in one request, but ranked per window of sentences (see extractive_compress)
+                structured_input = format_input_with_metadata(
+                    metadata, extractive_compress(content, compression_ratio, tokenizer_for_api(api_name)))
             summary = summarize_chunk(api_name, structured_input, custom_prompt_input, api_key)
 
         if summary:
@@ -3,16 +3,42 @@
 # Tokenization Methods Library
 # This library is used to handle tokenization of text for summarization.
 #
+# Tokenizers are looked up by a spec string '<backend>:<name>' and loaded once per process:
+#   tiktoken:gpt-4o                 - OpenAI models / tiktoken encodings (cl100k_base, o200k_base, ...)
+#   hf:mistralai/Mistral-7B-v0.1    - Hugging Face fast tokenizers (transformers)
+#   llama:/models/llama3.gguf       - the vocabulary of a local GGUF model (llama-cpp-python)
+#   estimate:3.8                    - no tokenizer at all: characters / chars-per-token, for cheap budget checks
+# A bare name is resolved to a backend (gpt-*/encoding names -> tiktoken, *.gguf -> llama, org/model -> hf).
+# The tokenizer for an LLM provider (tokenizer_for_api) comes from the [Tokenizers] section of config.txt, e.g.
+#   [Tokenizers]
+#   openai = tiktoken:gpt-4o
+#   llama = llama:/models/Meta-Llama-3-8B-Instruct.Q8_0.gguf
+# falling back to the provider's configured model, or to a calibrated estimate.
+#
 ####
-import tiktoken
+import abc
+import functools
+import math
+import os
+import threading
+import logging
+from typing import List, Optional, Dict, Iterable
 
-# Import Local
-from typing import List
+import tiktoken
 
 ####################
 # Function List
 #
 # 1. openai_tokenize(text: str) -> List[str]
+# 2. get_tiktoken_encoding(model: str)
+# 3. resolve_tokenizer_spec(spec: str) -> str
+# 4. estimate_spec() -> str
+# 5. get_tokenizer(spec: str) -> TokenCounter
+# 6. register_tokenizer(spec: str, tokenizer: TokenCounter)
+# 7. tokenizer_for_api(api_name: str) -> str
+# 8. calibrate_estimator(reference: str, samples: List[str]) -> EstimateTokenizer
+# 9. count_tokens(text: str, model: str) -> int
+# 10. count_tokens_batch(texts: List[str], model: str) -> List[int]
 #
 ####################
 
@@ -21,10 +47,277 @@ from typing import List
 # Function Definitions
 #
 
+DEFAULT_TOKENIZER_MODEL = 'gpt-4-turbo'
+# Average characters per token of English prose for cl100k-style BPE vocabularies
+DEFAULT_CHARS_PER_TOKEN = 4.0
+
+
+@functools.lru_cache(maxsize=None)
+def get_tiktoken_encoding(model: str = DEFAULT_TOKENIZER_MODEL):
+    """Encoding for `model`, built once per model; unknown (e.g. local) models fall back to cl100k_base."""
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        try:
+            return tiktoken.get_encoding(model)
+        except ValueError:
+            return tiktoken.get_encoding('cl100k_base')
+
+
 def openai_tokenize(text: str) -> List[str]:
-    encoding = tiktoken.encoding_for_model('gpt-4-turbo')
+    encoding = get_tiktoken_encoding()
     return encoding.encode(text)
 
+
+class TokenCounter(abc.ABC):
+    """Interface every tokenizer backend offers: counting and truncating to a token budget."""
+
+    def __init__(self, name: str):
+        self.name = name
+
+    @abc.abstractmethod
+    def count(self, text: str) -> int:
+        """Number of tokens in `text`."""
+
+    def count_batch(self, texts: List[str]) -> List[int]:
+        return [self.count(text) for text in texts]
+
+    @abc.abstractmethod
+    def truncate(self, text: str, max_tokens: int) -> str:
+        """Cut `text` to at most `max_tokens` tokens."""
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.name!r})"
+
+
+class Tokenizer(TokenCounter):
+    """Backends with a vocabulary, which also encode and decode; subclasses implement encode() and decode()."""
+
+    @abc.abstractmethod
+    def encode(self, text: str) -> List[int]:
+        """Token ids of `text`."""
+
+    @abc.abstractmethod
+    def decode(self, tokens: List[int]) -> str:
+        """Text of the token ids `tokens`."""
+
+    def encode_batch(self, texts: List[str]) -> List[List[int]]:
+        return [self.encode(text) for text in texts]
+
+    def count(self, text: str) -> int:
+        return len(self.encode(text))
+
+    def count_batch(self, texts: List[str]) -> List[int]:
+        return [len(tokens) for tokens in self.encode_batch(list(texts))]
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        tokens = self.encode(text)
+        if len(tokens) <= max_tokens:
+            return text
+        return self.decode(tokens[:max(0, max_tokens)])
+
+
+class TiktokenTokenizer(Tokenizer):
+    def __init__(self, name: str):
+        super().__init__(name)
+        self.encoding = get_tiktoken_encoding(name)
+
+    def encode(self, text: str) -> List[int]:
+        return self.encoding.encode(text, disallowed_special=())
+
+    def encode_batch(self, texts: List[str]) -> List[List[int]]:
+        # Encoded on tiktoken's own thread pool, outside the GIL
+        return self.encoding.encode_batch(list(texts), disallowed_special=())
+
+    def decode(self, tokens: List[int]) -> str:
+        return self.encoding.decode(tokens)
+
+
+class HuggingFaceTokenizer(Tokenizer):
+    def __init__(self, name: str):
+        super().__init__(name)
+        try:
+            from transformers import AutoTokenizer
+        except ImportError as e:
+            raise ImportError("Hugging Face tokenizers need the transformers package") from e
+        self.tokenizer = AutoTokenizer.from_pretrained(name, use_fast=True)
+
+    def encode(self, text: str) -> List[int]:
+        return self.tokenizer.encode(text, add_special_tokens=False)
+
+    def encode_batch(self, texts: List[str]) -> List[List[int]]:
+        # Fast (Rust) tokenizers encode a batch in parallel
+        return self.tokenizer(list(texts), add_special_tokens=False)['input_ids'] if texts else []
+
+    def decode(self, tokens: List[int]) -> str:
+        return self.tokenizer.decode(tokens)
+
+
+class LlamaCppTokenizer(Tokenizer):
+    def __init__(self, name: str):
+        super().__init__(name)
+        try:
+            from llama_cpp import Llama
+        except ImportError as e:
+            raise ImportError("llama tokenizers need the llama-cpp-python package") from e
+        # Vocabulary only: no weights are loaded
+        self.model = Llama(model_path=name, vocab_only=True, verbose=False)
+
+    def encode(self, text: str) -> List[int]:
+        return self.model.tokenize(text.encode('utf-8'), add_bos=False)
+
+    def decode(self, tokens: List[int]) -> str:
+        return self.model.detokenize(tokens).decode('utf-8', errors='ignore')
+
+
+class EstimateTokenizer(TokenCounter):
+    """Token counts estimated from the character count; no vocabulary is loaded, so it only counts and truncates."""
+
+    def __init__(self, name: str = ''):
+        super().__init__(name)
+        self.chars_per_token = float(name) if name else DEFAULT_CHARS_PER_TOKEN
+        if self.chars_per_token <= 0:
+            raise ValueError("chars_per_token must be positive")
+
+    def count(self, text: str) -> int:
+        return math.ceil(len(text) / self.chars_per_token)
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        return text[:int(max(0, max_tokens) * self.chars_per_token)]
+
+
+TOKENIZER_BACKENDS = {
+    'tiktoken': TiktokenTokenizer,
+    'hf': HuggingFaceTokenizer,
+    'llama': LlamaCppTokenizer,
+    'estimate': EstimateTokenizer,
+}
+
+_tokenizers: Dict[str, TokenCounter] = {}
+_tokenizers_lock = threading.Lock()
+
+
+def resolve_tokenizer_spec(spec: Optional[str] = None) -> str:
+    """
+    Normalize a tokenizer spec to '<backend>:<name>'.
+
+    :param spec: A spec, a bare model/encoding name, or None for env TOKENIZER (default tiktoken:gpt-4-turbo)
+    """
+    spec = spec or os.getenv('TOKENIZER', f'tiktoken:{DEFAULT_TOKENIZER_MODEL}')
+    backend, separator, name = spec.partition(':')
+    if separator and backend in TOKENIZER_BACKENDS:
+        return f"{backend}:{name}"
+    if spec.endswith('.gguf'):
+        return f"llama:{spec}"
+    if '/' in spec and not os.path.exists(spec):
+        return f"hf:{spec}"
+    # OpenAI model and tiktoken encoding names; anything else falls back to cl100k_base in get_tiktoken_encoding
+    return f"tiktoken:{spec}"
+
+
+def estimate_spec() -> str:
+    """Spec of the character estimate (env TOKENIZER_CHARS_PER_TOKEN), used when no real tokenizer is available."""
+    return f"estimate:{os.getenv('TOKENIZER_CHARS_PER_TOKEN', DEFAULT_CHARS_PER_TOKEN)}"
+
+
+def get_tokenizer(spec: Optional[str] = None) -> TokenCounter:
+    """
+    The tokenizer for `spec` (see resolve_tokenizer_spec), loaded on first use and shared afterwards. Every backend
+    counts and truncates; only vocabulary backends (isinstance Tokenizer) encode and decode, 'estimate' does not.
+    A tokenizer that cannot be loaded (missing package, gated or unreachable model) is replaced by the estimate.
+    """
+    spec = resolve_tokenizer_spec(spec)
+    tokenizer = _tokenizers.get(spec)
+    if tokenizer is None:
+        with _tokenizers_lock:
+            tokenizer = _tokenizers.get(spec)
+            if tokenizer is None:
+                backend, _, name = spec.partition(':')
+                try:
+                    tokenizer = TOKENIZER_BACKENDS[backend](name)
+                    logging.info(f"Loaded tokenizer {spec}")
+                except Exception as e:
+                    if backend == 'estimate':
+                        raise
+                    fallback = estimate_spec()
+                    logging.warning(f"Could not load tokenizer {spec}, using {fallback} instead: {e}")
+                    # A registered (calibrated) estimator is used if there is one
+                    tokenizer = _tokenizers.get(fallback) or EstimateTokenizer(fallback.partition(':')[2])
+                # The fallback is cached under the spec too, so a failing load is not retried on every call
+                _tokenizers[spec] = tokenizer
+    return tokenizer
+
+
+def register_tokenizer(spec: str, tokenizer: TokenCounter):
+    """Serve `tokenizer` for `spec`, e.g. a calibrated estimator or a preloaded tokenizer."""
+    with _tokenizers_lock:
+        _tokenizers[resolve_tokenizer_spec(spec)] = tokenizer
+
+
+# Config keys holding each provider's model name, used when [Tokenizers] has no entry for the provider
+PROVIDER_MODEL_KEYS = {
+    'openai': ('API', 'openai_model'),
+    'huggingface': ('API', 'huggingface_model'),
+}
+
+
+@functools.lru_cache(maxsize=1)
+def _load_tokenizer_config():
+    try:
+        # Imported here: Utils pulls in the download stack, which token counting does not need
+        from App_Function_Libraries.Utils import load_comprehensive_config
+        return load_comprehensive_config()
+    except Exception as e:
+        logging.debug(f"No config for tokenizer lookup: {e}")
+        return None
+
+
+def tokenizer_for_api(api_name: Optional[str]) -> str:
+    """
+    Tokenizer spec for an LLM provider (api_name as used by the summarization functions).
+
+    [Tokenizers] in config.txt wins; otherwise OpenAI models use tiktoken, Hugging Face models their own tokenizer,
+    and every other provider the character estimate (estimate_spec(), which register_tokenizer can calibrate).
+    config.txt is read once per process.
+    """
+    if not api_name:
+        return resolve_tokenizer_spec(None)
+    key = api_name.lower().replace('.', '').replace(' ', '')
+    config = _load_tokenizer_config()
+    if config is not None:
+        configured = config.get('Tokenizers', key, fallback=None)
+        if configured:
+            return resolve_tokenizer_spec(configured)
+        if key in PROVIDER_MODEL_KEYS:
+            model = config.get(*PROVIDER_MODEL_KEYS[key], fallback=None)
+            if model:
+                return f"tiktoken:{model}" if key == 'openai' else f"hf:{model}"
+    if key == 'openai':
+        return f"tiktoken:{DEFAULT_TOKENIZER_MODEL}"
+    return estimate_spec()
+
+
+def calibrate_estimator(reference: str, samples: Iterable[str]) -> EstimateTokenizer:
+    """
+    Estimator whose chars-per-token ratio is measured against a real tokenizer on sample texts.
+
+    :param reference: Spec of the tokenizer to match
+    :param samples: Representative texts (a few pages is enough)
+    """
+    samples = [sample for sample in samples if sample]
+    tokens = sum(get_tokenizer(reference).count_batch(samples))
+    if not tokens:
+        return EstimateTokenizer()
+    return EstimateTokenizer(str(sum(len(sample) for sample in samples) / tokens))
+
+
+def count_tokens(text: str, model: str = DEFAULT_TOKENIZER_MODEL) -> int:
+    return get_tokenizer(model).count(text)
+
+
+def count_tokens_batch(texts: List[str], model: str = DEFAULT_TOKENIZER_MODEL) -> List[int]:
+    return get_tokenizer(model).count_batch(list(texts))
+
 #
 #
 #######################################################################################################################
@@ -0,0 +1,267 @@
+# RAG_Benchmark.py
+#########################################
+# RAG Retrieval Benchmark
+# Measures the retrieval modes of RAG_Library on a synthetic (or loaded) corpus and writes the results as JSON,
+#   so runs from different versions can be compared for regressions.
+#
+# For every mode it reports: index build time, in-memory index size, database size, peak memory allocated during a
+#   query, p50/p95/p99 query latency and recall@k against exact brute-force search.
+#
+# Usage (from the repository root):
+#   python Helper_Scripts/RAG_Benchmark.py --num-docs 20000 --num-queries 300 --output rag_benchmark.json
+#   python Helper_Scripts/RAG_Benchmark.py --corpus docs.jsonl --model all-MiniLM-L6-v2 --modes exact,int8,hybrid
+#
+# --corpus takes JSON lines of {"title": ..., "content": ...}; --queries a text file with one query per line.
+# Without --model a deterministic bag-of-words encoder is used, so no model download is needed and large corpora
+#   embed in seconds; pass --model to benchmark with a real SentenceTransformer model.
+#
+####
+import argparse
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import zlib
+from datetime import datetime
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from App_Function_Libraries.Embedding_Models_Lib import get_embedding_model, register_embedding_model
+from App_Function_Libraries.RAG_Library import StandardRAGSystem, QuantizedRAGSystem, HybridRAGSystem, \
+    normalize_rows, top_k_indices
+
+####################
+# Function List
+#
+# 1. generate_corpus(num_docs, num_topics, seed)
+# 2. load_corpus(path)
+# 3. generate_queries(corpus, num_queries, seed)
+# 4. build_index(mode, db_path, model_name, documents, batch_size)
+# 5. benchmark_mode(mode, ...)
+# 6. run_benchmark(args)
+#
+####################
+
+SYLLABLES = ['ka', 'to', 'ri', 'mo', 'sen', 'lar', 'vi', 'do', 'pel', 'quo', 'ne', 'bra', 'tis', 'gu', 'fa', 'zen']
+
+
+class SyntheticEncoder:
+    """Deterministic bag-of-words encoder: each word maps to a fixed random vector, a text to their normalized sum."""
+
+    def __init__(self, dim: int = 384, seed: int = 0):
+        self.dim = dim
+        self.seed = seed
+        self.word_vectors = {}
+
+    def word_vector(self, word: str) -> np.ndarray:
+        vector = self.word_vectors.get(word)
+        if vector is None:
+            rng = np.random.default_rng(self.seed + zlib.crc32(word.encode()))
+            vector = self.word_vectors[word] = rng.standard_normal(self.dim).astype(np.float32)
+        return vector
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.dim
+
+    def encode(self, texts, **kwargs) -> np.ndarray:
+        embeddings = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for i, text in enumerate(texts):
+            words = text.lower().split()
+            if words:
+                embeddings[i] = np.sum([self.word_vector(word) for word in words], axis=0)
+        return normalize_rows(embeddings)
+
+
+def generate_corpus(num_docs: int, num_topics: int = 50, seed: int = 0):
+    """Topic-clustered documents of pseudo-words, so both lexical and vector retrieval have structure to find."""
+    rng = np.random.default_rng(seed)
+    vocabulary = list({''.join(rng.choice(SYLLABLES, size=rng.integers(2, 5))) for _ in range(20000)})
+    topic_words = [rng.choice(vocabulary, size=200, replace=False) for _ in range(num_topics)]
+    documents = []
+    for i in range(num_docs):
+        topic = rng.integers(num_topics)
+        length = int(rng.integers(80, 300))
+        from_topic = rng.random(length) < 0.8
+        words = np.where(from_topic, rng.choice(topic_words[topic], size=length), rng.choice(vocabulary, size=length))
+        documents.append((f"Document {i} (topic {topic})", ' '.join(words)))
+    return documents
+
+
+def load_corpus(path: str):
+    with open(path, 'r', encoding='utf-8') as file:
+        return [(record.get('title', ''), record['content']) for record in map(json.loads, file) if record]
+
+
+def generate_queries(corpus, num_queries: int, seed: int = 0):
+    """Short queries made of words sampled from random documents."""
+    rng = np.random.default_rng(seed + 1)
+    queries = []
+    for doc_index in rng.integers(len(corpus), size=num_queries):
+        words = corpus[doc_index][1].split()
+        queries.append(' '.join(rng.choice(words, size=min(len(words), int(rng.integers(3, 9))), replace=False)))
+    return queries
+
+
+# mode -> (factory(db_path, model_name), search(system, query, top_k) -> ids)
+MODES = {
+    'exact': (lambda db_path, model_name: StandardRAGSystem(db_path, model_name),
+              lambda system, query, top_k: [doc[0] for doc in system.get_relevant_documents(query, top_k)]),
+    'int8': (lambda db_path, model_name: QuantizedRAGSystem(db_path, model_name, quantization='int8'),
+             lambda system, query, top_k: [doc[0] for doc in system.get_relevant_documents(query, top_k)]),
+    'binary': (lambda db_path, model_name: QuantizedRAGSystem(db_path, model_name, quantization='binary'),
+               lambda system, query, top_k: [doc[0] for doc in system.get_relevant_documents(query, top_k)]),
+    # Approximate first pass only: the index's raw approximate-nearest-neighbour quality, without exact rescoring
+    'binary-approx': (lambda db_path, model_name: QuantizedRAGSystem(db_path, model_name, quantization='binary'),
+                      lambda system, query, top_k: [doc_id for doc_id, _ in system.vector_search(
+                          system.encode_query(query), top_k, rescore=False)]),
+    'hybrid': (lambda db_path, model_name: HybridRAGSystem(db_path, model_name),
+               lambda system, query, top_k: [doc[0] for doc in system.get_relevant_documents(query, top_k)]),
+}
+
+
+def index_nbytes(system, num_docs: int, dim: int) -> int:
+    """Bytes held in memory by the mode's index; exact search materializes ids + the float32 matrix per query."""
+    if isinstance(system, QuantizedRAGSystem):
+        return system.index_nbytes()
+    return num_docs * (dim * 4 + 8)
+
+
+def build_index(mode: str, db_path: str, model_name: str, documents, batch_size: int = 1000):
+    factory, search = MODES[mode]
+    start = time.perf_counter()
+    system = factory(db_path, model_name)
+    for batch_start in range(0, len(documents), batch_size):
+        system.add_documents(documents[batch_start:batch_start + batch_size])
+    if isinstance(system, QuantizedRAGSystem):
+        system.load_index()
+    return system, time.perf_counter() - start
+
+
+def percentiles_ms(latencies):
+    p50, p95, p99 = np.percentile(np.array(latencies) * 1000, [50, 95, 99])
+    return {'p50_ms': round(float(p50), 3), 'p95_ms': round(float(p95), 3), 'p99_ms': round(float(p99), 3),
+            'mean_ms': round(float(np.mean(latencies) * 1000), 3)}
+
+
+def benchmark_mode(mode: str, db_path: str, model_name: str, documents, queries, exact_ids, top_k: int, dim: int,
+                   warmup: int = 5):
+    _, search = MODES[mode]
+    system, build_seconds = build_index(mode, db_path, model_name, documents)
+    try:
+        for query in queries[:warmup]:
+            search(system, query, top_k)
+
+        latencies, recalls = [], []
+        for query, expected in zip(queries, exact_ids):
+            start = time.perf_counter()
+            ids = search(system, query, top_k)
+            latencies.append(time.perf_counter() - start)
+            recalls.append(len(set(ids) & expected) / max(1, len(expected)))
+
+        tracemalloc.start()
+        for query in queries[:warmup]:
+            search(system, query, top_k)
+        _, peak_query_bytes = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        return {
+            'build_seconds': round(build_seconds, 3),
+            'index_bytes': index_nbytes(system, len(documents), dim),
+            'db_bytes': os.path.getsize(db_path),
+            'peak_query_bytes': peak_query_bytes,
+            'latency': percentiles_ms(latencies),
+            f'recall@{top_k}': round(float(np.mean(recalls)), 4),
+        }
+    finally:
+        system.close()
+
+
+def git_version() -> str:
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def run_benchmark(args) -> dict:
+    if args.model:
+        model_name, encoder = args.model, get_embedding_model(args.model)
+    else:
+        model_name, encoder = f'synthetic-bow-{args.dim}', SyntheticEncoder(args.dim, args.seed)
+        register_embedding_model(model_name, encoder)
+
+    documents = load_corpus(args.corpus) if args.corpus else generate_corpus(args.num_docs, seed=args.seed)
+    if args.queries:
+        with open(args.queries, 'r', encoding='utf-8') as file:
+            queries = [line.strip() for line in file if line.strip()][:args.num_queries]
+    else:
+        queries = generate_queries(documents, args.num_queries, args.seed)
+
+    # Ground truth: exact cosine similarity over the full corpus, computed directly in NumPy
+    # (every mode builds a fresh database, so document i gets id i + 1)
+    doc_matrix = normalize_rows(np.asarray(encoder.encode([content for _, content in documents]), dtype=np.float32))
+    query_matrix = normalize_rows(np.asarray(encoder.encode(queries), dtype=np.float32))
+    exact_ids = [{int(i) + 1 for i in top_k_indices(doc_matrix @ query, args.top_k)} for query in query_matrix]
+    dim = doc_matrix.shape[1]
+
+    results = {}
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for mode in args.modes:
+            logging.warning(f"Benchmarking {mode} on {len(documents)} documents / {len(queries)} queries")
+            results[mode] = benchmark_mode(mode, os.path.join(temp_dir, f'{mode}.db'), model_name, documents,
+                                           queries, exact_ids, args.top_k, dim)
+    return {
+        'version': git_version(),
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'platform': {'python': platform.python_version(), 'machine': platform.machine(),
+                     'cpu_count': os.cpu_count(), 'numpy': np.__version__},
+        'config': {'num_docs': len(documents), 'num_queries': len(queries), 'dim': dim, 'top_k': args.top_k,
+                   'model': model_name, 'corpus': args.corpus or 'synthetic', 'seed': args.seed},
+        'results': results,
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark RAG_Library retrieval modes.')
+    parser.add_argument('--num-docs', type=int, default=10000, help='Size of the synthetic corpus')
+    parser.add_argument('--num-queries', type=int, default=200)
+    parser.add_argument('--dim', type=int, default=384, help='Embedding dimension of the synthetic encoder')
+    parser.add_argument('--top-k', type=int, default=10)
+    parser.add_argument('--modes', type=lambda value: value.split(','), default=list(MODES),
+                        help=f"Comma separated modes out of: {', '.join(MODES)}")
+    parser.add_argument('--corpus', help='JSON lines file of {"title", "content"} instead of a synthetic corpus')
+    parser.add_argument('--queries', help='Text file with one query per line instead of sampled queries')
+    parser.add_argument('--model', help='SentenceTransformer model to use instead of the synthetic encoder')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='Write the JSON results here instead of stdout')
+    args = parser.parse_args(argv)
+    unknown = set(args.modes) - set(MODES)
+    if unknown:
+        parser.error(f"Unknown modes: {', '.join(sorted(unknown))}")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    # Per-query INFO logging from RAG_Library would dominate the latencies being measured
+    logging.getLogger().setLevel(logging.WARNING)
+    report = run_benchmark(args)
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            file.write(output)
+        print(f"Wrote benchmark results to {args.output}")
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()